@@ -0,0 +1,70 @@
+'''Collect calls over a short window and hand each group over in one call'''
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+
+class Batcher(object):
+    '''Groups submitted items by key for up to window seconds, or until
+    max_size are waiting, then calls fn(key, items) once for the group.
+
+    fn returns one result per item, in order.  If fn raises, every item in
+    the group gets the exception.
+    '''
+
+    def __init__(
+        self,
+        fn: Callable[[Hashable, List[Any]], Awaitable[List[Any]]],
+        window: float = 2.0,
+        max_size: int = 50
+    ):
+        self.fn = fn
+        self.window = window
+        self.max_size = max_size
+        self.pending: Dict[Hashable, List[Tuple[Any, asyncio.Future]]] = {}
+        self.timers: Dict[Hashable, asyncio.Task] = {}
+        self.tasks = set()
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(key, []).append((item, future))
+        if len(self.pending[key]) >= self.max_size:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = self._spawn(self._flush_later(key))
+        # Shielded, one caller giving up must not cancel the group
+        return await asyncio.shield(future)
+
+    def flush(self, key: Hashable):
+        '''Send key's group now'''
+        timer = self.timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            self._spawn(self._send(key, batch))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        # Keep a reference, the loop only holds tasks weakly
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _flush_later(self, key: Hashable):
+        await asyncio.sleep(self.window)
+        self.flush(key)
+
+    async def _send(self, key: Hashable, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.fn(key, [item for item, _ in batch])
+            if len(results) != len(batch):
+                raise Exception(f'Batch for {key} returned {len(results)} results for {len(batch)} items')
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,136 @@
+'''SQLite store of completed pipeline steps, so a redelivered run resumes'''
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+from .envelope import dumps, loads
+
+log = logging.getLogger()
+
+# Used when checkpoint_path isn't configured, not relative to wherever the driver was started
+DEFAULT_CHECKPOINT_PATH = os.path.join(tempfile.gettempdir(), 'provisioner_checkpoints.sqlite3')
+DEFAULT_CHECKPOINT_RETENTION = 7 * 24 * 3600.0  # seconds a finished run is kept
+DEFAULT_ABANDONED_RETENTION = 24 * 3600.0       # seconds an unfinished run is kept, e.g. dead-lettered
+PRUNE_INTERVAL = 3600.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_key TEXT PRIMARY KEY,
+    account_id TEXT,
+    ip TEXT,
+    message_id TEXT,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_key TEXT NOT NULL,
+    step TEXT NOT NULL,
+    outputs BLOB NOT NULL,
+    PRIMARY KEY (run_key, step)
+);
+'''
+
+
+class CheckpointStore(object):
+    '''Completed step outputs per run, keyed by account, lease IP and message ID
+
+    SQLite calls run in a worker thread, one at a time, so the event loop
+    never blocks on disk.  Finished runs are pruned after retention seconds,
+    and runs that never finished (failed for good, or dead-lettered) after
+    abandoned_retention, checked at most every PRUNE_INTERVAL.
+    '''
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CHECKPOINT_PATH,
+        retention: float = DEFAULT_CHECKPOINT_RETENTION,
+        abandoned_retention: float = DEFAULT_ABANDONED_RETENTION
+    ):
+        self.path = path
+        self.retention = retention
+        self.abandoned_retention = abandoned_retention
+        self.lock = asyncio.Lock()
+        self.db: Optional[sqlite3.Connection] = None
+        self.pruned: Optional[float] = None
+
+    @staticmethod
+    def run_key(account_id, ip, message_id) -> str:
+        return f'{account_id}:{ip}:{message_id}'
+
+    async def _run(self, fn, *args):
+        async with self.lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        if self.pruned is None or time.monotonic() - self.pruned >= PRUNE_INTERVAL:
+            self._prune()
+        return self.db
+
+    def _prune(self):
+        now = time.time()
+        with self.db:
+            old = [row[0] for row in self.db.execute(
+                'SELECT run_key FROM runs WHERE (status = ? AND updated < ?) OR (status != ? AND updated < ?)',
+                ('done', now - self.retention, 'done', now - self.abandoned_retention)
+            )]
+            self.db.executemany('DELETE FROM steps WHERE run_key = ?', [(x,) for x in old])
+            self.db.executemany('DELETE FROM runs WHERE run_key = ?', [(x,) for x in old])
+        self.pruned = time.monotonic()
+        if old:
+            log.info(f"Pruned {len(old)} provisioning checkpoints")
+
+    def _start(self, run_key: str, account_id, ip, message_id) -> Dict[str, Dict[str, Any]]:
+        db = self._connect()
+        row = db.execute('SELECT status FROM runs WHERE run_key = ?', (run_key,)).fetchone()
+        with db:
+            if row is not None and row[0] != 'running':
+                # Delivered again after it finished, so run it again from scratch
+                db.execute('DELETE FROM steps WHERE run_key = ?', (run_key,))
+                db.execute('DELETE FROM runs WHERE run_key = ?', (run_key,))
+            db.execute(
+                'INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                (run_key, str(account_id), str(ip), str(message_id), 'running', time.time())
+            )
+        return {
+            step: loads(outputs)
+            for step, outputs in db.execute('SELECT step, outputs FROM steps WHERE run_key = ?', (run_key,))
+        }
+
+    def _save(self, run_key: str, step: str, outputs: bytes):
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?)', (run_key, step, outputs))
+            db.execute('UPDATE runs SET updated = ? WHERE run_key = ?', (time.time(), run_key))
+
+    def _finish(self, run_key: str):
+        db = self._connect()
+        with db:
+            db.execute('UPDATE runs SET status = ?, updated = ? WHERE run_key = ?', ('done', time.time(), run_key))
+
+    async def start(self, account_id, ip, message_id) -> Dict[str, Dict[str, Any]]:
+        '''Register a run, returning outputs of the steps it already completed.
+        Only an unfinished run resumes, a finished one starts over.'''
+        return await self._run(self._start, self.run_key(account_id, ip, message_id), account_id, ip, message_id)
+
+    async def save(self, run_key: str, step: str, outputs: Dict[str, Any]):
+        await self._run(self._save, run_key, step, dumps(outputs or {}))
+
+    async def finish(self, run_key: str):
+        '''Mark a run done, its steps are not resumed again'''
+        await self._run(self._finish, run_key)
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def close(self):
+        '''Close the database once any call in progress is done'''
+        await self._run(self._close)
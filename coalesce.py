@@ -0,0 +1,83 @@
+'''Collapse concurrent and recently repeated calls for the same key into one'''
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .cache import TTLCache, MISSING
+
+
+class Coalescer(object):
+    '''Runs fn once per key at a time, and remembers results for a TTL
+
+    A call for a key already in flight waits on that call's result (or
+    error) instead of starting another.  A call for a key that finished
+    within the TTL gets the remembered result.  Failures are never
+    remembered, so the next call runs again.
+
+    on_hit, if given, is called with the key and 'coalesced' or 'recent'
+    whenever a call is answered without running fn.  keep, if given,
+    decides which results are remembered, e.g. not error replies.  ttl_for,
+    if given, returns the TTL for a result as it is remembered, e.g. to
+    expire everything at midnight.
+    '''
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 60.0,
+        on_hit: Optional[Callable[[Hashable, str], None]] = None,
+        keep: Optional[Callable[[Any], bool]] = None,
+        ttl_for: Optional[Callable[[], float]] = None
+    ):
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.recent = TTLCache(maxsize, ttl) if ttl > 0 else None
+        self.on_hit = on_hit
+        self.keep = keep
+        self.ttl_for = ttl_for
+        self.coalesced = 0
+        self.recent_hits = 0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if self.recent is not None:
+            result = self.recent.get(key)
+            if result is not MISSING:
+                self.recent_hits += 1
+                if self.on_hit is not None:
+                    self.on_hit(key, 'recent')
+                return result
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            if self.on_hit is not None:
+                self.on_hit(key, 'coalesced')
+            # Shielded, a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved, there may be no other waiter
+            future.exception()
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+        if self.recent is not None and (self.keep is None or self.keep(result)):
+            self.recent.set(key, result, None if self.ttl_for is None else self.ttl_for())
+        future.set_result(result)
+        return result
+
+    def forget(self, key: Optional[Hashable] = None):
+        '''Drop remembered results, for one key or all of them'''
+        if self.recent is None:
+            return
+        if key is None:
+            self.recent.clear()
+        else:
+            self.recent.pop(key)
@@ -0,0 +1,75 @@
+'''Request deadlines shared between drivers, and latency windows for hedging'''
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+# Wall clock (epoch seconds) the current provision must finish by, wall
+# clock rather than monotonic because it is compared in other processes
+DEADLINE: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+def remaining(deadline: Optional[float] = None) -> Optional[float]:
+    '''Seconds left before deadline (or the current one), None if unbounded'''
+    deadline = DEADLINE.get() if deadline is None else deadline
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.time() >= float(deadline)
+
+
+class LatencyWindow(object):
+    '''Last size latencies per key, to pick when a hedged retry is worth it'''
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.size = size
+        self.min_samples = min_samples
+        self.samples: Dict[str, Deque[float]] = {}
+
+    def add(self, key: str, latency: float):
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.size)
+        self.samples[key].append(latency)
+
+    def percentile(self, key: str, percentile: float) -> Optional[float]:
+        '''None until there are enough samples to trust'''
+        samples = self.samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+async def hedged(
+    call: Callable[[], Awaitable[Any]],
+    delay: Optional[float],
+    timeout: float,
+    on_hedge: Optional[Callable[[], None]] = None
+) -> Any:
+    '''Await call(), starting a second call() if the first is still going
+    after delay seconds.  Whichever finishes first is used (its error too),
+    the other is cancelled.  Raises asyncio.TimeoutError after timeout.
+
+    With delay None, or no earlier than timeout, call() just gets timeout.
+    '''
+    if delay is None or delay >= timeout:
+        return await asyncio.wait_for(call(), timeout)
+
+    attempts = { asyncio.create_task(call()) }
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            attempts.add(asyncio.create_task(call()))
+            done, _ = await asyncio.wait(attempts, timeout=timeout - delay, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            raise asyncio.TimeoutError()
+        return done.pop().result()
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
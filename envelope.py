@@ -0,0 +1,79 @@
+'''Parse-once message envelope and the JSON codec shared by the drivers'''
+import json
+from typing import Any, Optional, Union
+from pydantic import BaseModel
+
+# Use the fastest codec installed, they all produce plain JSON on the wire
+try:
+    import orjson
+
+    def _default(obj):
+        if hasattr(obj, 'model_dump'):
+            return obj.model_dump()
+        raise TypeError(f'Cannot encode {type(obj).__name__}')
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    loads = orjson.loads
+
+except ImportError:
+    try:
+        import msgspec
+
+        _encoder = msgspec.json.Encoder(
+            enc_hook=lambda obj: obj.model_dump() if hasattr(obj, 'model_dump') else obj
+        )
+        dumps = _encoder.encode
+        loads = msgspec.json.Decoder().decode
+
+    except ImportError:
+        def dumps(obj: Any) -> bytes:
+            return json.dumps(
+                obj, default=lambda x: x.model_dump() if hasattr(x, 'model_dump') else str(x)
+            ).encode()
+
+        loads = json.loads
+
+
+class Envelope(BaseModel):
+    '''A message body, decoded once and handed down to every handler
+
+    Fields seen on most requests are typed, anything else is kept as an
+    extra.  Supports body['key'] and body.get('key') so handlers written
+    against the decoded dict keep working.
+    '''
+    routing_key: Optional[str] = None
+    account_id: Optional[Union[int, str]] = None
+    ip: Optional[str] = None
+    trace_id: Optional[str] = None
+    deadline: Optional[float] = None
+
+    class Config:
+        extra = 'allow'
+
+    @classmethod
+    def decode(cls, raw: Union[bytes, str, None]) -> 'Envelope':
+        data = loads(raw) if raw else {}
+        if not isinstance(data, dict):
+            # Some RPCs send a bare value, e.g. an IP string
+            data = {'value': data}
+        return cls.model_validate(data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        return getattr(self, key, None) is not None
+
+    def to_dict(self) -> dict:
+        '''Plain dict copy, without typed fields the sender left out.
+        Explicit nulls are kept.'''
+        return self.model_dump(exclude_unset=True)
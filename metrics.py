@@ -0,0 +1,188 @@
+'''In-process metrics, trace spans and a Prometheus text endpoint'''
+import asyncio
+import bisect
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    '''Escape a label value for the text exposition format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram(object):
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series: Dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labelnames)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        for i in range(index, len(self.buckets)):
+            series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series):
+                le = _labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {count}')
+            le = _labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {series[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {series[-1]}')
+        return '\n'.join(lines)
+
+
+class Counter(object):
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labelnames)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in self.series.items():
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {value}')
+        return '\n'.join(lines)
+
+
+class Gauge(object):
+    '''Gauge read from a callback at scrape time'''
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} gauge\n{self.name} {self.fn()}'
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.server = None
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, *args, **kwargs)
+        return self.metrics[name]
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        # Re-registering replaces the callback, e.g. when a driver is rebuilt
+        self.metrics[name] = Gauge(name, help, fn)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        return '\n'.join(x.render() for x in self.metrics.values()) + '\n'
+
+    async def serve(self, port: int, host: str = '127.0.0.1'):
+        '''Serve /metrics on a local port, once per process'''
+        if self.server is not None:
+            return
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            # Another driver process already has the port, don't retry per message
+            self.server = False
+            log.warning(f"Metrics endpoint not started on {host}:{port} - {e}")
+            return
+        log.info(f"Serving metrics on {host}:{port}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if request.split(b' ')[1:2] == [b'/metrics']:
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+METRICS = Registry()
+
+RPC_SECONDS = METRICS.histogram(
+    'rpc_call_seconds', 'Duration of outgoing RPC calls', ['driver', 'routing_key', 'outcome']
+)
+REQUEST_SECONDS = METRICS.histogram(
+    'rpc_request_seconds', 'Duration of handling incoming RPC requests', ['driver', 'routing_key', 'outcome']
+)
+
+
+# Trace of the request being handled, copied into every task it starts
+TRACE_ID: ContextVar[Optional[str]] = ContextVar('trace_id', default=None)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Span(object):
+    '''A timed block, set outcome to report a failure that didn't raise'''
+
+    def __init__(self, trace_id: Optional[str]):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.outcome = 'ok'
+
+
+@asynccontextmanager
+async def span(driver: str, name: str, trace_id: Optional[str], histogram: Histogram = REQUEST_SECONDS):
+    '''Time a block as a child span of trace_id and record it in histogram'''
+    current = Span(trace_id)
+    start = time.monotonic()
+    try:
+        yield current
+    except BaseException:
+        current.outcome = 'error'
+        raise
+    finally:
+        duration = time.monotonic() - start
+        histogram.observe(duration, driver=driver, routing_key=name, outcome=current.outcome)
+        log.info(
+            f"trace={trace_id} span={current.span_id} driver={driver} name={name} "
+            f"outcome={current.outcome} duration={duration:.3f}s"
+        )
@@ -6,3 +6,4 @@ from .get_router_ip import *
 from .get_vlan_and_prefix import *
 from .verify_tenant_vlan import *
 from .assign_tenant_vlan import *
+from .provisioning_context import *
@@ -1,28 +1,16 @@
 import json
-from gql import gql
 from .index import Netbox
+from .queries import QUERY_REG_VLAN, QUERY_VLAN_BY_NAME
 
 async def get_reg_vlan(self, ip: str) -> dict:
-    query = gql('''
-        query GetVLAN($ip: String!){
-            # children 0 filters for the most relevant
-            prefix_list(filters: {contains: $ip, children: "0"}){
-                id
-                prefix
-                site {
-                    id
-                    name
-                }
-                vlan {
-                    id
-                    name
-                    vid
-                }
-            }
-        }
-    ''')
+    # Answer from the local prefix index, only asking Netbox on a miss.
+    # A cached prefix without a VLAN also goes to Netbox, in case it changed.
+    prefix = await self.prefix_cache.lookup(ip)
+    if prefix is not None and prefix.get("vlan") is not None:
+        return { "prefix_list": [prefix] }
+
     res = await self.execute(
-        query,
+        QUERY_REG_VLAN,
         variable_values={
             'ip': ip
         }
@@ -41,16 +29,12 @@ async def get_reg_vlan(self, ip: str) -> dict:
 
 async def get_mgmt_id_by_reg(self, mgmt_vlan: str) -> int:
     print(mgmt_vlan)
-    query = gql(f'''
-       query {{
-          vlan_list(filters: {{name: {{exact:"{mgmt_vlan.replace('-reg', '-mgmt')}"}}}}){{
-            id
-            vid
-            name
-          }}
-        }}
-   ''')
-    res = await self.execute(query)
+    res = await self.execute(
+        QUERY_VLAN_BY_NAME,
+        variable_values={
+            'name': mgmt_vlan.replace('-reg', '-mgmt')
+        }
+    )
     return res['vlan_list'][0]['vid']
 
 
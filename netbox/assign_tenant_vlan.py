@@ -1,10 +1,17 @@
 '''Assign a VLAN to an account in Netbox'''
+import asyncio
+import logging
+import weakref
 from typing import Optional, List
-from gql import gql
 from gql.transport.exceptions import TransportQueryError
 from pydantic import BaseModel
 
 from .index import Netbox
+from .queries import QUERY_VLANS_BY_TENANT, QUERY_SITE, QUERY_TENANT
+from .rest import NetboxRestException
+from .vlan_pool import NetboxVlanPoolException
+
+log = logging.getLogger()
 
 
 class Site(BaseModel):
@@ -25,71 +32,40 @@ class Vlan(BaseModel):
     tenant: Optional[Tenant]
 
 
-QUERY_VLANS_BY_TENANT = gql('''
-    query VlansByTenant($id: [String!]){
-        vlan_list(filters: {tenant_id: $id}){
-            id
-            vid
-            name
-            site {
-                id
-            }
-            tenant {
-                id
-            }
-        }
-    }
-''')
-
-QUERY_TENANT_VLANS_BY_SITE = gql('''
-    query TenantVlansBySite($id: [String!]){
-        vlan_list(
-            filters: {
-                AND: {
-                    site_id: $id,
-                    vid: {gte: 1024, lt: 3072}
-                }
-            }
-        ){
-            id
-            vid
-            site {
-                id
-            }
-            tenant {
-                id
-            }
-        }
-    }
-''')
-
-QUERY_SITE = gql('''
-    query SiteExists($id: Int!){
-        site(id: $id) {
-            id
-        }
-    }
-''')
-
-QUERY_TENANT = gql('''
-    query TenantExists($id: Int!){
-        tenant(id: $id) {
-            id
-        }
-    }
-''')
+# Attempts at claiming a free VLAN before giving up on a site
+MAX_ASSIGN_ATTEMPTS = 5
+
 
 class NetboxAssignVLANException(Exception):
     '''General Exception for Assigining VLANs'''
 
 
+class NetboxAssignVLANConflict(NetboxAssignVLANException):
+    '''VLAN was claimed by someone else while being assigned'''
+
+
 class AssignTenantVlan(object):
-    '''Assign VLAN to Tenant'''
+    '''Assign VLAN to Tenant
+
+    One instance is shared by the driver, so nothing per-request is kept on
+    it.  Allocation on a site is serialized by a per-site lock, and each
+    claim is verified after writing and retried on conflict.  The lock only
+    covers this process.  Across worker processes the read-back catches a
+    claim that lands between our read and our read-back, but not one that
+    lands after it.
+    '''
+
+    def __init__(self):
+        # A site's lock is dropped once nothing holds or waits on it
+        self.site_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
 
     async def __call__(self, driver: Netbox, site_id: int, tenant_id: int) -> Vlan:
         '''Entry point for driver'''
-        self.driver = driver
-        return await self.assign_tenant_vlan(site_id, tenant_id)
+        return await self.assign_tenant_vlan(driver, int(site_id), int(tenant_id))
+
+    def site_lock(self, site_id: int) -> asyncio.Lock:
+        '''Return the lock serializing allocation on a site'''
+        return self.site_locks.setdefault(int(site_id), asyncio.Lock())
 
     def _path_in_errors(self, errors: list, path: str) -> bool:
         '''Check if path is in error'''
@@ -99,25 +75,25 @@ class AssignTenantVlan(object):
                     return True
         return False
 
-    async def assign_tenant_vlan(self, site_id: int, tenant_id: int) -> Vlan:
+    async def assign_tenant_vlan(self, driver: Netbox, site_id: int, tenant_id: int) -> Vlan:
         '''Main logic'''
-        vlan = await self.tenant_vlan(tenant_id)
+        vlan = await self.tenant_vlan(driver, tenant_id)
 
         if vlan is not None:
             if vlan.site.id == site_id:
                 return vlan
-            self.release_vlan(vlan.id)
+            await self.release_vlan(driver, vlan.id)
 
-        return await self.assign_next_vlan(site_id, tenant_id)
+        return await self.assign_next_vlan(driver, site_id, tenant_id)
 
-    async def tenant_vlan(self, tenant_id: int) -> Optional[Vlan]:
+    async def tenant_vlan(self, driver: Netbox, tenant_id: int) -> Optional[Vlan]:
         '''Return VLAN assigned to tenant'''
         # If tenant id does not exist, netbox returns all VLANs.
         # Check for tenant first
-        await self.tenant_exists(tenant_id)
+        await self.tenant_exists(driver, tenant_id)
 
         try:
-            res = await self.driver.execute(
+            res = await driver.execute(
                 QUERY_VLANS_BY_TENANT,
                 variable_values={
                     'id': [str(tenant_id)]
@@ -140,10 +116,10 @@ class AssignTenantVlan(object):
                 ) from e
             raise NetboxAssignVLANException from e
 
-    async def site_exists(self, site_id: int) -> bool:
+    async def site_exists(self, driver: Netbox, site_id: int) -> bool:
         '''Raise exception if site does not exist'''
         try:
-            res = await self.driver.execute(
+            res = await driver.execute(
                 QUERY_SITE,
                 variable_values={
                     'id': int(site_id)
@@ -163,10 +139,10 @@ class AssignTenantVlan(object):
                 ) from e
             raise NetboxAssignVLANException from e
 
-    async def tenant_exists(self, tenant_id: int) -> bool:
+    async def tenant_exists(self, driver: Netbox, tenant_id: int) -> bool:
         '''Raise exception if tenant does not exist'''
         try:
-            res = await self.driver.execute(
+            res = await driver.execute(
                 QUERY_TENANT,
                 variable_values={
                     'id': int(tenant_id)
@@ -186,55 +162,76 @@ class AssignTenantVlan(object):
                 ) from e
             raise NetboxAssignVLANException from e
 
+    async def next_free_tenant_vlan(self, driver: Netbox, site_id: int) -> Vlan:
+        '''Return first VLAN on a site that can be assigned to a tenant'''
+        try:
+            pool = await driver.vlan_pools.get(site_id)
+        except TransportQueryError as e:
+            raise NetboxAssignVLANException from e
+        except NetboxVlanPoolException as e:
+            raise NetboxAssignVLANException(str(e)) from e
 
-    async def site_tenant_vlans(self, site_id: int) -> List[Vlan]:
-        '''Return all VLANs that can be assigned to a tenant'''
-        # GraphQL AND does not seem to work when site id doesn't exist,
-        # and instead returns VLANs for all sites.
-        await self.site_exists(site_id)
-
-        # TODO: Range is business logic, maybe check for role instead of range
-        # At time of writing Role is NAT Access, but VLAN doesn't define whether
-        # prefix is NAT or Public, should change role to "Tenant" first
+        free = pool.next_free()
+        if free is None:
+            raise NetboxAssignVLANException(f'No free VLANs for site ID {site_id}')
+        vlan_id, vid = free
+        return Vlan(id=vlan_id, vid=vid, site=Site(id=site_id), tenant=None)
 
+    async def claim_vlan(self, driver: Netbox, site_vlan: Vlan, tenant_id: int):
+        '''Write tenant to a free VLAN, raising NetboxAssignVLANConflict if it was taken'''
         try:
-            res = await self.driver.execute(
-                QUERY_TENANT_VLANS_BY_SITE,
-                variable_values={
-                    'id': str(site_id)
-                }
-            )
-            if not res.get('vlan_list'):
-                raise NetboxAssignVLANException(f'No assignable VLANs found for site {site_id}')
-            return [Vlan(**x) for x in res['vlan_list']]
-
-        except TransportQueryError as e:
+            nb_vlan = await driver.rest.get_vlan(site_vlan.id)
+            if not nb_vlan:
+                raise NetboxAssignVLANException(f'Unable to retrieve VLAN {site_vlan.id}')
+            if nb_vlan.get('tenant') is not None:
+                raise NetboxAssignVLANConflict(f'VLAN {site_vlan.id} is already assigned')
+
+            await driver.rest.update_vlan(site_vlan.id, tenant=tenant_id)
+
+            # Another writer outside this process may have raced us between
+            # the read and the PATCH, so read back to confirm we won.
+            nb_vlan = await driver.rest.get_vlan(site_vlan.id)
+        except NetboxRestException as e:
             raise NetboxAssignVLANException from e
 
-    async def next_free_tenant_vlan(self, site_id: int) -> Vlan:
-        '''Return first VLAN on a site that can be assigned to a tenant'''
-        for site_vlan in await self.site_tenant_vlans(site_id):
-            if site_vlan.tenant is None:
+        tenant = (nb_vlan or {}).get('tenant') or {}
+        if tenant.get('id') != tenant_id:
+            raise NetboxAssignVLANConflict(f'VLAN {site_vlan.id} was claimed by another tenant')
+
+    async def allocate(self, driver: Netbox, site_id: int, tenant_id: int) -> Vlan:
+        '''Claim the next free VLAN on a site for a tenant, retrying on conflict'''
+        async with self.site_lock(site_id):
+            for attempt in range(MAX_ASSIGN_ATTEMPTS):
+                site_vlan = await self.next_free_tenant_vlan(driver, site_id)
+                try:
+                    await self.claim_vlan(driver, site_vlan, tenant_id)
+                except NetboxAssignVLANConflict as e:
+                    log.warning(f"VLAN assignment conflict on site {site_id}, retrying: {e}")
+                    driver.vlan_pools.mark_used(site_vlan.id)
+                    continue
+                driver.vlan_pools.mark_used(site_vlan.id)
                 return site_vlan
-        raise NetboxAssignVLANException(f'No free VLANs for site ID {site_id}')
 
-    async def assign_next_vlan(self, site_id: int, tenant_id: int) -> Vlan:
+            # Pool is likely stale, reload it on next use
+            driver.vlan_pools.invalidate(site_id)
+            raise NetboxAssignVLANException(
+                f'Unable to assign VLAN on site {site_id} after {MAX_ASSIGN_ATTEMPTS} attempts'
+            )
+
+    async def assign_next_vlan(self, driver: Netbox, site_id: int, tenant_id: int) -> Vlan:
         '''Assign next free VLAN to tenant'''
-        site_vlan = await self.next_free_tenant_vlan(site_id)
-        nb_vlan = self.driver.api.ipam.vlans.get(site_vlan.id)
-        if not nb_vlan:
-            raise NetboxAssignVLANException(f'Unable to retrieve VLAN {site_vlan.id}')
-        nb_vlan.tenant = tenant_id
-        nb_vlan.save()
-        return await self.tenant_vlan(tenant_id)
-
-    def release_vlan(self, vlan_id: int):
-        '''Remove tenant from VLAN'''
-        nb_vlan = self.driver.api.ipam.vlans.get(vlan_id)
-        if not nb_vlan:
-            raise NetboxAssignVLANException(f'Unable to retrieve VLAN {vlan_id}')
-        nb_vlan.tenant = None
-        nb_vlan.save()
+        await self.allocate(driver, site_id, tenant_id)
+        return await self.tenant_vlan(driver, tenant_id)
 
+    async def release_vlan(self, driver: Netbox, vlan_id: int):
+        '''Remove tenant from VLAN'''
+        try:
+            nb_vlan = await driver.rest.get_vlan(vlan_id)
+            if not nb_vlan:
+                raise NetboxAssignVLANException(f'Unable to retrieve VLAN {vlan_id}')
+            await driver.rest.update_vlan(vlan_id, tenant=None)
+        except NetboxRestException as e:
+            raise NetboxAssignVLANException from e
+        driver.vlan_pools.mark_free(vlan_id)
 
 Netbox.assign_tenant_vlan = AssignTenantVlan()
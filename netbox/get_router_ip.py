@@ -1,79 +1,56 @@
-import json
-import re
-import pynetbox
-from aio_pika import IncomingMessage
-from gql import gql
+import logging
+from ..envelope import Envelope
 from .index import Netbox
 
+log = logging.getLogger()
 
-# Get Management Prefix and VLAN based on the Reg VLAN name
-async def get_router_ip(self, message: IncomingMessage):
-
-    # Get and verify message contains Reg VLAN
-    if not message.body:
-        print("Errors with Get Router IP Message: {message}")
-        return None
-
-    vlan_id = json.loads(message.body).get("vlan_id")
-
-    if not vlan_id:
-        print("Get Router IP missing VLAN ID")
-        return None
 
+def _router_and_ap(site, ap_name: str) -> dict:
+    router_ip = site.router_ip()
+    access_point_ip = site.ip("AP", ap_name)
+    log.info(f"Found Router: {router_ip}, Access Point IP: {access_point_ip}")
 
-    query = gql('''
-        query getRouterIP($id: Int!)
-        {
-            vlan(id:$id)
-            {
-                site
-                {
-                    devices
-                    {
-                         name
-                        role
-                        {
-                            id
-                            name
-                        }
-                        primary_ip4
-                        {
-                            address
-                        }
-                    }
-                }
-            }
-        }
-        ''')
-
+    if router_ip is None or access_point_ip is None:
+        raise Exception("Get Router IP Failed to find Router or Access Point")
 
-    res = await self.execute(
-        query,
-        variable_values={
-            'id': int(vlan_id)
-        }
-    )
+    return { "router_ip": router_ip, "access_point_ip": access_point_ip }
 
-    print(f"Get Router IP Callback Received: {res}")
-    router_ip = None
-    for device in res.get("vlan").get("site").get("devices"):
-        if device.get("role").get("name") == "Router":
-            router_ip = re.sub("\/\d*$", "", device.get("primary_ip4").get("address"))
-            print(f"Found Router: {router_ip}")
 
-    ap_name = json.loads(message.body).get("ap_name")
-    access_point_ip = None
-    for device in res.get("vlan").get("site").get("devices"):
-        if device.get("role").get("name") == "AP" and device.get("name") == ap_name:
-            access_point_ip = re.sub("\/\d*$", "", device.get("primary_ip4").get("address"))
-            print(f"Found Access Point IP: {access_point_ip}")
+# Get Router and Access Point IPs on the site of a VLAN
+async def get_router_ip(self, body: Envelope):
 
-    if router_ip is None or access_point_ip is None:
-        raise Exception("Get Router IP Failed to find Router or Access Point")
+    # Get and verify message contains VLAN
+    vlan_id = body.get("vlan_id")
 
-    return { "router_ip": router_ip, "access_point_ip": access_point_ip }
+    if not vlan_id:
+        log.warning("Get Router IP missing VLAN ID")
+        return None
 
+    # The AP's site is usually already known (the tenant VLAN is new on every
+    # provision, so its site rarely is), the VLAN's site is the fallback
+    ap_name = body.get("ap_name")
+    site_id = None
+    if ap_name:
+        try:
+            site_id = await self.site_devices.site_for_device(ap_name)
+        except Exception as e:
+            log.warning(f"Get Router IP falling back to VLAN site: {e}")
+    if site_id is None:
+        site_id = await self.site_devices.site_for_vlan(vlan_id)
+    site = await self.site_devices.site(site_id)
+    return _router_and_ap(site, ap_name)
+
+
+# Get Router and Access Point IPs by Access Point name alone
+async def get_router_ip_by_ap(self, ap_name: str):
+    if not ap_name:
+        log.warning("Get Router IP by AP missing AP name")
+        return None
 
+    site_id = await self.site_devices.site_for_device(ap_name)
+    site = await self.site_devices.site(site_id)
+    return _router_and_ap(site, ap_name)
 
 
 Netbox.get_router_ip = get_router_ip
+Netbox.get_router_ip_by_ap = get_router_ip_by_ap
@@ -1,17 +1,42 @@
 import asyncio
+import importlib.util
 import logging
 import json
 import re
-import pynetbox
+import time
+import httpx
 from pydantic import BaseModel, Extra
 from aio_pika import IncomingMessage
-from aiolimiter import AsyncLimiter
 from gql import Client
+from gql.transport.exceptions import TransportServerError
 from gql.transport.httpx import HTTPXAsyncTransport
 from busboy import BaseRpcServer, BaseEndpoint, BaseRpcClient
 
+from ..cache import TTLCache
+from ..envelope import Envelope
+from ..deadline import expired
+from ..metrics import METRICS, span
+from .limiter import AdaptiveLimiter, DEFAULT_RATE, DEFAULT_MIN_RATE, DEFAULT_MAX_RATE, \
+    DEFAULT_RATE_INCREASE, DEFAULT_LATENCY_THRESHOLD, OVERLOAD_ERRORS
+from .queries import QUERIES, NetboxQueryException
+from .rest import NetboxRest
+from .vlan_pool import VlanPoolIndex, DEFAULT_POOL_TTL
+from .prefix_cache import PrefixCache, DEFAULT_PREFIX_TTL
+from .site_devices import SiteDeviceIndex, DEFAULT_DEVICE_TTL, DEFAULT_DEVICE_SITE_CACHE_SIZE, \
+    DEFAULT_VLAN_SITE_CACHE_SIZE
+
 log = logging.getLogger()
 
+# Connection pool defaults for the shared GraphQL session
+DEFAULT_POOL_SIZE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_IDLE_RECONNECT = 300.0
+
+# Tenant lookups by account ID
+DEFAULT_TENANT_CACHE_SIZE = 10000
+DEFAULT_TENANT_CACHE_TTL = 3600.0
+DEFAULT_TENANT_NEGATIVE_TTL = 30.0
+
 class NetboxModel(BaseModel):
     model: str
     event: str
@@ -27,7 +52,11 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
         "rpc.dcim.tenant_verification",
         "rpc.dcim.vlan_verification",
         "rpc.dcim.get_router_ip",
-        "rpc.dcim.assign_tenant_vlan"
+        "rpc.dcim.get_router_ip_by_ap",
+        "rpc.dcim.assign_tenant_vlan",
+        "rpc.dcim.refresh_prefix_cache",
+        "rpc.dcim.get_provisioning_context",
+        "rpc.dcim.get_provisioning_contexts"
     ]
     model = NetboxModel
 
@@ -37,22 +66,118 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
             raise Exception('Unable to get Netbox URL from config')
         url = self.config.netbox_api_url
 
+        pool_size = int(getattr(self.config, 'netbox_pool_size', None) or DEFAULT_POOL_SIZE)
+        keepalive_expiry = float(
+            getattr(self.config, 'netbox_keepalive_expiry', None) or DEFAULT_KEEPALIVE_EXPIRY
+        )
+        # HTTP/2 needs the optional `h2` package
+        http2 = bool(getattr(self.config, 'netbox_http2', False)) and \
+            importlib.util.find_spec('h2') is not None
+        self.idle_reconnect = float(
+            getattr(self.config, 'netbox_idle_reconnect', None) or DEFAULT_IDLE_RECONNECT
+        )
+
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        )
+
         self.transport = HTTPXAsyncTransport(
             url=url + '/graphql/',
             headers={
                 "Authorization": f"Token {self.config.netbox_api_key}",
                 "Accept": "application/json"
-            }
+            },
+            http2=http2,
+            limits=limits
         )
 
-        self.api = pynetbox.api(url, token=self.config.netbox_api_key)
         self.client = Client(transport=self.transport, fetch_schema_from_transport=False)
-        self.limiter = AsyncLimiter(40.0, 1.0)  # TODO: Make these config values with sane defaults
+        # Catch query/schema drift at startup rather than on a customer's provision
+        schema_path = getattr(self.config, 'netbox_schema_path', None)
+        if schema_path:
+            QUERIES.validate(schema_path)
+        else:
+            log.warning("netbox_schema_path not set, Netbox queries not validated")
+        # Shared by GraphQL and REST, adapts to how Netbox is coping
+        self.limiter = AdaptiveLimiter(
+            rate=float(getattr(self.config, 'netbox_rate_limit', None) or DEFAULT_RATE),
+            min_rate=float(getattr(self.config, 'netbox_rate_min', None) or DEFAULT_MIN_RATE),
+            max_rate=float(getattr(self.config, 'netbox_rate_max', None) or DEFAULT_MAX_RATE),
+            increase=float(getattr(self.config, 'netbox_rate_increase', None) or DEFAULT_RATE_INCREASE),
+            latency_threshold=float(
+                getattr(self.config, 'netbox_latency_threshold', None) or DEFAULT_LATENCY_THRESHOLD
+            ),
+            # Set to a file path to share one budget between worker processes
+            shared_path=getattr(self.config, 'netbox_rate_shared_path', None)
+        )
+        METRICS.gauge('netbox_rate_limit', 'Current Netbox request rate limit', lambda: self.limiter.rate)
+        METRICS.gauge('netbox_queue_depth', 'Requests waiting on the Netbox limiter', lambda: self.limiter.queue_depth)
+        # REST is only used for writes, and for reads that must see them
+        self.rest = NetboxRest(url, self.config.netbox_api_key, self.limiter, limits, http2)
+        self.vlan_pools = VlanPoolIndex(
+            self, float(getattr(self.config, 'netbox_vlan_pool_ttl', None) or DEFAULT_POOL_TTL)
+        )
+        self.prefix_cache = PrefixCache(
+            self, float(getattr(self.config, 'netbox_prefix_ttl', None) or DEFAULT_PREFIX_TTL)
+        )
+        self.site_devices = SiteDeviceIndex(
+            self,
+            float(getattr(self.config, 'netbox_device_ttl', None) or DEFAULT_DEVICE_TTL),
+            int(getattr(self.config, 'netbox_device_site_cache_size', None) or DEFAULT_DEVICE_SITE_CACHE_SIZE),
+            int(getattr(self.config, 'netbox_vlan_site_cache_size', None) or DEFAULT_VLAN_SITE_CACHE_SIZE)
+        )
+        self.tenant_cache = TTLCache(
+            int(getattr(self.config, 'netbox_tenant_cache_size', None) or DEFAULT_TENANT_CACHE_SIZE),
+            float(getattr(self.config, 'netbox_tenant_cache_ttl', None) or DEFAULT_TENANT_CACHE_TTL)
+        )
+        self.tenant_negative_ttl = float(
+            getattr(self.config, 'netbox_tenant_negative_ttl', None) or DEFAULT_TENANT_NEGATIVE_TTL
+        )
+        self.session = None
+        self.session_lock = asyncio.Lock()
+        self.session_last_used = 0.0
+        # Connect at startup, so the first request doesn't pay for it.  The
+        # driver is built inside the running loop, without one the first
+        # execute() connects instead.
+        self.warm_up_task = None
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            self.warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        '''Open the GraphQL session ahead of the first query'''
+        try:
+            await self.open_session()
+            log.info("Netbox session opened")
+        except Exception as e:
+            log.warning(f"Could not open Netbox session at startup, the first query will retry: {e}")
 
     async def consume(self, message: IncomingMessage) -> None:
         log.debug("Entered Netbox consumer")
-        body = json.loads(message.body)
+        port = getattr(self.config, 'metrics_port', None)
+        if port:
+            await METRICS.serve(int(port))
+        # Decoded once here, handlers get the envelope rather than the raw message
+        try:
+            body = Envelope.decode(message.body)
+        except Exception as e:
+            await self.reply({ "error": f"Malformed request - {e}", "res": None }, message)
+            raise Exception(f"Malformed request - {e}")
+        # The caller has already given up on this, don't spend Netbox/router time on it
+        if expired(body.get("deadline")):
+            log.warning(f"Skipping {message.routing_key}, its deadline has passed (trace {body.get('trace_id')})")
+            await self.reply({ "error": "Deadline exceeded before the request was handled", "res": None }, message)
+            return
+        # Child span of the provisioner's trace, when it sent one
+        async with span(self.name, message.routing_key, body.get("trace_id")):
+            await self.handle(message, body)
 
+    async def handle(self, message: IncomingMessage, body: Envelope) -> None:
         if message.routing_key == "do_rpc":
             log.debug("Got webhook. Making RPC call")
             log.debug(await self.rpc_call("rpc.dcim.customer.get.by_id", "420791"))
@@ -60,7 +185,11 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
         # It should just take an IP address. Not a whole message
         if message.routing_key == "rpc.dcim.get_reg_vlan":
             ip = body.get("ip")
-            result = await self.get_reg_vlan(ip)
+            try:
+                result = await self.get_reg_vlan(ip)
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Fetch VLAN failed - {e}")
             if not result:
                 await self.reply({ "error": "Fetch VLAN failed: Likely Bad IP", "res": None }, message)
                 raise Exception("Fetch VLAN failed: Likely Bad IP")
@@ -69,6 +198,39 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
                 # Returns the VLAN and Site data dict as a string, to be converted back on the other side
                 await self.reply({ "error": None, "res": result }, message)
 
+        if message.routing_key == "rpc.dcim.get_provisioning_context":
+            log.debug("Netbox got Get Provisioning Context Request")
+            context = None
+            try:
+                context = await self.get_provisioning_context(body.get("ip"), body.get("account_id"))
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Error Retrieving Provisioning Context - {e}")
+
+            log.info(f"Provisioning Context Received: {context}")
+            await self.reply({ "error": None, "res": context }, message)
+
+        if message.routing_key == "rpc.dcim.get_provisioning_contexts":
+            log.debug("Netbox got Get Provisioning Contexts Request")
+            contexts = None
+            try:
+                # One { error, res } per lease, a bad lease doesn't fail the rest
+                contexts = await self.get_provisioning_contexts(body.get("leases") or [])
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Error Retrieving Provisioning Contexts - {e}")
+
+            log.info(f"Provisioning Contexts Received for {len(contexts)} leases")
+            await self.reply({ "error": None, "res": contexts }, message)
+
+        if message.routing_key == "rpc.dcim.refresh_prefix_cache":
+            try:
+                await self.prefix_cache.refresh()
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Error Refreshing Prefix Cache - {e}")
+            await self.reply({ "error": None, "res": "Prefix cache refreshed" }, message)
+
         if message.routing_key == "rpc.dcim.get_mgmt_id_by_reg":
             result = await self.get_mgmt_id_by_reg(body.get('name'))
             if not result:
@@ -83,7 +245,7 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
             #Does the Tenant Already Exist?
             tenant_id = ""
             try:
-                tenant_id = await self.does_tenant_exist(message)
+                tenant_id = await self.does_tenant_exist(body)
             except Exception as e:
                 await self.reply({ "error": f"{e}", "res": None }, message)
                 raise Exception(f"Error Looking for Existing Tennant - {e}")
@@ -92,10 +254,9 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
             if not tenant_id:
                 log.debug("Failed to find tenant. Creating new one.")
                 try:
-                    #Create the tenant, then verify that it actually worked.
-                    creation_success = await self.create_tenant(message)
-                    if creation_success:
-                        tenant_id = await self.does_tenant_exist(message)
+                    # Create the tenant, which also caches it for does_tenant_exist
+                    if await self.create_tenant(body):
+                        tenant_id = await self.does_tenant_exist(body)
                 except Exception as e:
                     await self.reply({ "error": f"{e}", "res": None }, message)
                     raise Exception(f"Error when Creating a new Tenant - {e}")
@@ -109,7 +270,7 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
         if message.routing_key == "rpc.dcim.vlan_verification":
             log.debug("Netbox got Verify VLAN Request")
             try:
-                vlan_vid_set = await self.verify_tenant_vlan(message)
+                vlan_vid_set = await self.verify_tenant_vlan(body)
             except Exception as e:
                 await self.reply({ "error": f"{e}", "res": None }, message)
                 raise Exception(f"Error Verifying VLAN Request - {e}")
@@ -123,7 +284,6 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
 
         if message.routing_key == "rpc.dcim.assign_tenant_vlan":
             log.debug('Netbox got Assign Tenant VLAN Request')
-            body = json.loads(message.body)
             vlan = None
             try:
                 vlan = await self.assign_tenant_vlan(self, body['site_id'], body['tenant_id'])
@@ -138,7 +298,7 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
             log.debug("Netbox got Get Router IP Request")
             router_and_ap_ips = None
             try:
-                router_and_ap_ips = await self.get_router_ip(message)
+                router_and_ap_ips = await self.get_router_ip(body)
             except Exception as e:
                 await self.reply({ "error": f"{e}", "res": None }, message)
                 raise Exception(f"Error Retrieving Router IP - {e}")
@@ -146,9 +306,65 @@ class Netbox(BaseRpcServer, BaseEndpoint, BaseRpcClient):
             log.debug("router ip acquired")
             await self.reply({ "error": None, "res": router_and_ap_ips }, message) #Returns the VLAN and Site data dict as a string, to be converted back on the other side
 
-    async def execute(self, *args, **kwargs):
-        async with self.limiter, self.client as session:
-            return await session.execute(*args, **kwargs)
+        if message.routing_key == "rpc.dcim.get_router_ip_by_ap":
+            log.debug("Netbox got Get Router IP by AP Request")
+            router_and_ap_ips = None
+            try:
+                router_and_ap_ips = await self.get_router_ip_by_ap(body.get("ap_name"))
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Error Retrieving Router IP by AP - {e}")
+
+            log.debug("router ip acquired")
+            await self.reply({ "error": None, "res": router_and_ap_ips }, message)
+
+    async def open_session(self):
+        '''Open the long-lived GraphQL session, reconnecting if it sat idle too long'''
+        async with self.session_lock:
+            idle = time.monotonic() - self.session_last_used
+            if self.session is not None and idle > self.idle_reconnect:
+                log.debug(f"Netbox session idle for {idle:.0f}s, reconnecting")
+                await self.client.close_async()
+                self.session = None
+
+            if self.session is None:
+                self.session = await self.client.connect_async(reconnecting=True)
+                self.session_last_used = time.monotonic()
+            return self.session
+
+    async def close_session(self):
+        '''Close the GraphQL session and the REST connection pool'''
+        async with self.session_lock:
+            if self.session is not None:
+                await self.client.close_async()
+                self.session = None
+        await self.rest.close()
+
+    async def close(self):
+        '''Shutdown: close the Netbox sessions, then the RPC connections'''
+        await self.close_session()
+        parent = getattr(super(), 'close', None)
+        if parent is not None:
+            await parent()
+
+    async def execute(self, document, *args, **kwargs):
+        if document not in QUERIES:
+            raise NetboxQueryException('Ad-hoc Netbox queries are not allowed, register it in netbox/queries.py')
+        session = await self.open_session()
+        async with self.limiter:
+            start = time.monotonic()
+            try:
+                result = await session.execute(document, *args, **kwargs)
+            except TransportServerError as e:
+                await self.limiter.record(time.monotonic() - start, e.code)
+                raise
+            except OVERLOAD_ERRORS:
+                # Timeouts and dropped connections are Netbox struggling too
+                await self.limiter.record(time.monotonic() - start, failed=True)
+                raise
+            await self.limiter.record(time.monotonic() - start)
+        self.session_last_used = time.monotonic()
+        return result
 
     def get_routing_key(self, body: dict) -> str:
         data = self.model(**body)
@@ -0,0 +1,190 @@
+'''Adaptive rate limiter for Netbox traffic'''
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Optional, Tuple
+import httpx
+
+log = logging.getLogger()
+
+DEFAULT_RATE = 40.0
+DEFAULT_MIN_RATE = 5.0
+DEFAULT_MAX_RATE = 200.0
+DEFAULT_RATE_INCREASE = 1.0       # requests/s added per healthy second
+DEFAULT_LATENCY_THRESHOLD = 2.0   # seconds, slower responses count as a spike
+INCREASE_INTERVAL = 1.0           # at most one increase per second
+DECREASE_COOLDOWN = 1.0           # don't halve more than once per second
+
+# Requests that failed this way count as overload, like a 429 or 5xx
+OVERLOAD_ERRORS: Tuple[type, ...] = (httpx.TimeoutException, httpx.NetworkError, asyncio.TimeoutError)
+try:
+    import aiohttp
+    OVERLOAD_ERRORS += (aiohttp.ClientConnectionError,)
+except ImportError:
+    pass
+
+
+class AdaptiveLimiter(object):
+    '''Token bucket limiter whose rate is adjusted by additive increase,
+    multiplicative decrease (AIMD) on Netbox responses.
+
+    Use as ``async with limiter:`` around a request, then report how it went
+    with ``record()``.  The rate grows by ``increase`` at most once per
+    healthy second, and halves at most once per DECREASE_COOLDOWN.
+
+    When ``shared_path`` is set, the bucket, rate and the times of the last
+    increase and decrease live in that file under an flock, so every worker
+    process on the host draws from one budget and backs off once.  The file
+    is locked from a worker thread, never on the event loop.
+    '''
+
+    def __init__(
+        self,
+        rate: float = DEFAULT_RATE,
+        min_rate: float = DEFAULT_MIN_RATE,
+        max_rate: float = DEFAULT_MAX_RATE,
+        increase: float = DEFAULT_RATE_INCREASE,
+        latency_threshold: float = DEFAULT_LATENCY_THRESHOLD,
+        shared_path: Optional[str] = None
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.latency_threshold = latency_threshold
+        self.shared_path = shared_path
+
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.last_increase = self.updated
+        self.last_decrease = 0.0
+        self.waiting = 0
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        return None
+
+    @property
+    def queue_depth(self) -> int:
+        '''Requests waiting for a token'''
+        return self.waiting
+
+    def metrics(self) -> dict:
+        return {
+            'rate': self.rate,
+            'queue_depth': self.waiting
+        }
+
+    async def acquire(self):
+        '''Wait for a token'''
+        self.waiting += 1
+        try:
+            while True:
+                wait = await self._take()
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    async def record(self, latency: float, status: Optional[int] = None, failed: bool = False):
+        '''Adjust the rate from a finished request.  failed is a request that
+        got no response, e.g. one of OVERLOAD_ERRORS.'''
+        overloaded = failed or status == 429 or (status is not None and status >= 500) \
+            or latency > self.latency_threshold
+
+        if self.shared_path:
+            await asyncio.to_thread(self._record_shared, overloaded, latency, status)
+            return
+        state = {'rate': self.rate, 'last_increase': self.last_increase, 'last_decrease': self.last_decrease}
+        self._adjust(state, time.monotonic(), overloaded, latency, status)
+        self.rate = state['rate']
+        self.last_increase = state['last_increase']
+        self.last_decrease = state['last_decrease']
+
+    def _record_shared(self, overloaded: bool, latency: float, status: Optional[int]):
+        with self._shared_state() as state:
+            # Wall clock, the times are compared across processes
+            self._adjust(state, time.time(), overloaded, latency, status)
+            self.rate = state['rate']
+
+    def _adjust(self, state: dict, now: float, overloaded: bool, latency: float, status: Optional[int]):
+        '''AIMD step on state's rate, last_increase and last_decrease'''
+        if overloaded:
+            if now - state['last_decrease'] < DECREASE_COOLDOWN:
+                return
+            state['last_decrease'] = now
+            state['last_increase'] = now
+            state['rate'] = max(self.min_rate, state['rate'] / 2)
+            log.warning(f"Netbox overloaded ({status}, {latency:.2f}s), rate lowered to {state['rate']:.1f}/s")
+        elif now - state['last_increase'] >= INCREASE_INTERVAL:
+            # One step however long since the last, an idle spell earns nothing
+            state['last_increase'] = now
+            state['rate'] = min(self.max_rate, state['rate'] + self.increase)
+
+    def _refill(self, tokens: float, updated: float, rate: float, now: float) -> float:
+        return min(rate, tokens + (now - updated) * rate)
+
+    async def _take(self) -> float:
+        '''Take a token if one is available, else return seconds to wait'''
+        if self.shared_path:
+            return await asyncio.to_thread(self._take_shared)
+
+        now = time.monotonic()
+        self.tokens = self._refill(self.tokens, self.updated, self.rate, now)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _take_shared(self) -> float:
+        with self._shared_state() as state:
+            now = time.time()
+            self.rate = state['rate']
+            state['tokens'] = self._refill(state['tokens'], state['updated'], self.rate, now)
+            state['updated'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0
+            return (1 - state['tokens']) / self.rate
+
+    def _shared_state(self):
+        return _SharedState(self.shared_path, self.rate)
+
+
+class _SharedState(object):
+    '''Read-modify-write of the shared bucket file under an exclusive flock'''
+
+    def __init__(self, path: str, rate: float):
+        self.path = path
+        self.rate = rate
+
+    def __enter__(self) -> dict:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        raw = os.read(self.fd, 4096)
+        try:
+            self.state = json.loads(raw)
+        except ValueError:
+            self.state = {'rate': self.rate, 'tokens': self.rate, 'updated': time.time()}
+        # Files written before the AIMD times were shared
+        self.state.setdefault('last_increase', self.state['updated'])
+        self.state.setdefault('last_decrease', 0.0)
+        return self.state
+
+    def __exit__(self, *args):
+        try:
+            data = json.dumps(self.state).encode()
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, data)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
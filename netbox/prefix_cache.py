@@ -0,0 +1,73 @@
+'''Local longest-prefix-match index of Netbox leaf prefixes'''
+import asyncio
+import ipaddress
+import logging
+import time
+from typing import Dict, Optional
+from .queries import QUERY_LEAF_PREFIXES
+
+log = logging.getLogger()
+
+DEFAULT_PREFIX_TTL = 300.0
+
+
+class PrefixCache(object):
+    '''Prefixes keyed by IP version, then prefix length, then network address
+
+    Lookup masks the address at each known length, longest first, so a hit
+    costs at most one dict lookup per distinct prefix length.
+    '''
+
+    def __init__(self, driver, ttl: float = DEFAULT_PREFIX_TTL):
+        self.driver = driver
+        self.ttl = ttl
+        self.tables: Dict[int, Dict[int, Dict[int, dict]]] = {}
+        self.lengths: Dict[int, list] = {}
+        self.loaded = None
+        self.lock = asyncio.Lock()
+
+    def expired(self) -> bool:
+        return self.loaded is None or time.monotonic() - self.loaded > self.ttl
+
+    async def refresh(self):
+        '''Reload every leaf prefix'''
+        async with self.lock:
+            res = await self.driver.execute(QUERY_LEAF_PREFIXES)
+            tables = {}
+            for prefix in res.get('prefix_list') or []:
+                network = ipaddress.ip_network(prefix['prefix'], strict=False)
+                by_length = tables.setdefault(network.version, {})
+                by_length.setdefault(network.prefixlen, {})[int(network.network_address)] = prefix
+
+            self.tables = tables
+            self.lengths = {
+                version: sorted(by_length, reverse=True) for version, by_length in tables.items()
+            }
+            self.loaded = time.monotonic()
+            log.info(f"Loaded {sum(len(x) for t in tables.values() for x in t.values())} prefixes")
+
+    def match(self, ip: str) -> Optional[dict]:
+        '''Return the most specific cached prefix containing ip'''
+        address = ipaddress.ip_address(str(ip).split('/')[0])
+        by_length = self.tables.get(address.version)
+        if not by_length:
+            return None
+        value = int(address)
+        bits = address.max_prefixlen
+        for length in self.lengths[address.version]:
+            mask = ((1 << length) - 1) << (bits - length)
+            prefix = by_length[length].get(value & mask)
+            if prefix is not None:
+                return prefix
+        return None
+
+    async def lookup(self, ip: str) -> Optional[dict]:
+        '''Match ip, refreshing first if the index is stale'''
+        if self.expired() and not self.lock.locked():
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep answering from the old index, misses still fall back
+                # to Netbox.  The index stays stale, so the next lookup retries.
+                log.error(f"Prefix cache refresh failed: {e}")
+        return self.match(ip)
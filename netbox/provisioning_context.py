@@ -0,0 +1,145 @@
+import asyncio
+import re
+from typing import List, Optional
+from .index import Netbox
+from .queries import QUERY_PROVISIONING_CONTEXT, QUERY_SITES_CONTEXT, QUERY_TENANTS_BY_NAME
+
+
+async def get_provisioning_context(self, ip: str, account_id) -> dict:
+    ''' Resolves reg prefix/VLAN/site, mgmt VLAN VID, tenant and the
+        site's router and AP IPs for a lease in a single Netbox round trip
+    '''
+    res = await self.execute(
+        QUERY_PROVISIONING_CONTEXT,
+        variable_values={
+            'ip': ip,
+            'exact': f"ubb-{account_id}",
+            'starts_with': f"ubb-{account_id}-"
+        }
+    )
+
+    if not res.get("reg"):
+        raise Exception("Site/VLAN request returned empty response")
+    prefix = res["reg"][0]
+    if prefix.get("vlan") is None:
+        raise Exception(f"VLAN is Missing from site: {prefix}")
+
+    return await self.build_provisioning_context(prefix, prefix["site"], res.get("tenant"), account_id)
+
+
+async def get_provisioning_contexts(self, leases: List[dict]) -> List[dict]:
+    ''' get_provisioning_context for many leases, e.g. a site coming back
+        after an outage.  Prefixes come from the prefix cache, then every
+        site and every tenant in the group is fetched in one query each.
+
+        Returns one { "error", "res" } per lease, in order.
+    '''
+    def lease_error(lease) -> Optional[str]:
+        if not isinstance(lease, dict):
+            return f"Malformed lease {lease!r}"
+        missing = [x for x in ("ip", "account_id") if lease.get(x) is None]
+        if missing:
+            return f"Lease is missing {', '.join(missing)}"
+        return None
+
+    # A bad lease gets its own error, the rest are batched without it
+    errors = [lease_error(lease) for lease in leases]
+    valid = [lease for lease, error in zip(leases, errors) if error is None]
+
+    async def cached_prefix(lease: dict) -> Optional[dict]:
+        # A bad IP is reported on its own lease by the fallback below
+        try:
+            return await self.prefix_cache.lookup(lease["ip"])
+        except ValueError:
+            return None
+
+    prefixes = [await cached_prefix(lease) if error is None else None for lease, error in zip(leases, errors)]
+    site_ids = sorted({ str(x["site"]["id"]) for x in prefixes if x and x.get("vlan") and x.get("site") })
+
+    async def fetch_sites() -> dict:
+        # An empty id filter would match every site
+        if not site_ids:
+            return {}
+        res = await self.execute(QUERY_SITES_CONTEXT, variable_values={ 'id': site_ids })
+        return { str(x["id"]): x for x in res.get("site_list") or [] }
+
+    async def fetch_tenants() -> dict:
+        if not valid:
+            return {}
+        res = await self.execute(QUERY_TENANTS_BY_NAME, variable_values={
+            'names': sorted({ f"ubb-{lease['account_id']}" for lease in valid })
+        })
+        return { x["name"]: x for x in res.get("tenant_list") or [] }
+
+    sites, tenants = await asyncio.gather(fetch_sites(), fetch_tenants())
+
+    async def one(lease: dict, prefix: Optional[dict], error: Optional[str]) -> dict:
+        if error is not None:
+            return { "error": error, "res": None }
+        try:
+            site = sites.get(str(prefix["site"]["id"])) if prefix and prefix.get("vlan") and prefix.get("site") else None
+            if site is None:
+                # Not in the prefix cache, or a site we couldn't batch
+                context = await self.get_provisioning_context(lease["ip"], lease["account_id"])
+            else:
+                # Only exact names are batched, a miss lets tenant_verification look wider
+                tenant = tenants.get(f"ubb-{lease['account_id']}")
+                context = await self.build_provisioning_context(
+                    prefix, site, [tenant] if tenant else None, lease["account_id"]
+                )
+            return { "error": None, "res": context }
+        except Exception as e:
+            return { "error": f"{e}", "res": None }
+
+    return await asyncio.gather(*[one(*x) for x in zip(leases, prefixes, errors)])
+
+
+async def build_provisioning_context(self, prefix: dict, site: dict, tenant_list: Optional[list], account_id) -> dict:
+    reg_vlan_name = prefix["vlan"]["name"]
+    ap_name = re.sub("-reg$|-mgmt$", "", reg_vlan_name)
+
+    mgmt_name = reg_vlan_name.replace('-reg', '-mgmt')
+    mgmt_vid = None
+    for vlan in site.get("vlans") or []:
+        if vlan["name"] == mgmt_name:
+            mgmt_vid = vlan["vid"]
+            break
+    if mgmt_vid is None:
+        # Not on the site, e.g. a global or VLAN group mgmt VLAN, search by name like get_mgmt_id_by_reg
+        try:
+            mgmt_vid = await self.get_mgmt_id_by_reg(reg_vlan_name)
+        except (IndexError, KeyError, TypeError):
+            raise Exception(f"Failed to find mgmt VLAN {mgmt_name}")
+
+    # The site's devices came along anyway, keep them for get_router_ip
+    devices = self.site_devices.add(site["id"], site.get("devices") or [])
+    router_ip = devices.router_ip()
+    access_point_ip = devices.ip("AP", ap_name)
+
+    if router_ip is None or access_point_ip is None:
+        raise Exception("Get Router IP Failed to find Router or Access Point")
+
+    if tenant_list:
+        self.tenant_cache.set(str(account_id), { "tenant_list": tenant_list })
+
+    return {
+        # Same shape as rpc.dcim.get_reg_vlan
+        "reg_vlan": {
+            "prefix_list": [{
+                "id": prefix["id"],
+                "prefix": prefix["prefix"],
+                "site": { "id": site["id"], "name": site["name"] },
+                "vlan": prefix["vlan"]
+            }]
+        },
+        "mgmt_vid": mgmt_vid,
+        # Same shape as rpc.dcim.tenant_verification, None if it needs creating
+        "tenant": { "tenant_list": tenant_list } if tenant_list else None,
+        "router_ip": router_ip,
+        "access_point_ip": access_point_ip
+    }
+
+
+Netbox.get_provisioning_context = get_provisioning_context
+Netbox.get_provisioning_contexts = get_provisioning_contexts
+Netbox.build_provisioning_context = build_provisioning_context
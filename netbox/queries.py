@@ -0,0 +1,317 @@
+'''Registry of every GraphQL document the Netbox driver may send
+
+Documents are parsed once at import, take all input as variables so their
+text never changes, and can be validated at startup against a locally
+cached copy of the Netbox schema.  Netbox.execute refuses anything that
+was not registered here.
+'''
+import json
+import logging
+from pathlib import Path
+from typing import Dict
+from gql import gql
+from graphql import DocumentNode, build_client_schema, build_schema, validate
+
+log = logging.getLogger()
+
+
+class NetboxQueryException(Exception):
+    '''Query is not registered or does not match the schema'''
+
+
+class QueryRegistry(object):
+    '''Named, pre-parsed GraphQL documents'''
+
+    def __init__(self):
+        self.documents: Dict[str, DocumentNode] = {}
+        self._ids = set()
+
+    def register(self, name: str, source: str) -> DocumentNode:
+        '''Parse and register a document'''
+        if name in self.documents:
+            raise NetboxQueryException(f'Query {name} is already registered')
+        document = gql(source)
+        self.documents[name] = document
+        self._ids.add(id(document))
+        return document
+
+    def __contains__(self, document) -> bool:
+        return id(document) in self._ids
+
+    def validate(self, schema_path: str):
+        '''Validate every document against a schema file
+
+        Accepts SDL (``.graphql``) or an introspection result (``.json``).
+        '''
+        path = Path(schema_path)
+        if path.suffix == '.json':
+            introspection = json.loads(path.read_text())
+            schema = build_client_schema(introspection.get('data', introspection))
+        else:
+            schema = build_schema(path.read_text())
+
+        failures = []
+        for name, document in self.documents.items():
+            for error in validate(schema, document):
+                failures.append(f'{name}: {error.message}')
+        if failures:
+            raise NetboxQueryException('Invalid Netbox queries:\n' + '\n'.join(failures))
+        log.info(f"Validated {len(self.documents)} Netbox queries against {schema_path}")
+
+
+QUERIES = QueryRegistry()
+
+
+QUERY_REG_VLAN = QUERIES.register('GetVLAN', '''
+    query GetVLAN($ip: String!){
+        # children 0 filters for the most relevant
+        prefix_list(filters: {contains: $ip, children: "0"}){
+            id
+            prefix
+            site {
+                id
+                name
+            }
+            vlan {
+                id
+                name
+                vid
+            }
+        }
+    }
+''')
+
+QUERY_VLAN_BY_NAME = QUERIES.register('VlanByName', '''
+    query VlanByName($name: String!){
+        vlan_list(filters: {name: {exact: $name}}){
+            id
+            vid
+            name
+        }
+    }
+''')
+
+QUERY_VERIFY_TENANT = QUERIES.register('verifyTenant', '''
+    query verifyTenant($exact: String!, $starts_with: String!)
+    {
+        tenant_list(filters: {
+            name: {exact: $exact},
+            OR: {
+                name: {starts_with: $starts_with}
+            }
+        })
+        {
+            id
+            name
+        }
+    }
+''')
+
+QUERY_TENANT_VLAN = QUERIES.register('returnTenantVLAN', '''
+    query returnTenantVLAN($id: Int!){
+        tenant(id: $id){
+            id
+            name
+            slug
+            vlans {
+                id
+                vid
+                name
+                site {
+                    id
+                }
+            }
+        }
+    }
+''')
+
+QUERY_VLANS_BY_TENANT = QUERIES.register('VlansByTenant', '''
+    query VlansByTenant($id: [String!]){
+        vlan_list(filters: {tenant_id: $id}){
+            id
+            vid
+            name
+            site {
+                id
+            }
+            tenant {
+                id
+            }
+        }
+    }
+''')
+
+QUERY_SITE = QUERIES.register('SiteExists', '''
+    query SiteExists($id: Int!){
+        site(id: $id) {
+            id
+        }
+    }
+''')
+
+QUERY_TENANT = QUERIES.register('TenantExists', '''
+    query TenantExists($id: Int!){
+        tenant(id: $id) {
+            id
+        }
+    }
+''')
+
+QUERY_TENANT_VLANS_BY_SITE = QUERIES.register('TenantVlansBySite', '''
+    query TenantVlansBySite($id: [String!]){
+        vlan_list(
+            filters: {
+                AND: {
+                    site_id: $id,
+                    vid: {gte: 1024, lt: 3072}
+                }
+            }
+        ){
+            id
+            vid
+            site {
+                id
+            }
+            tenant {
+                id
+            }
+        }
+    }
+''')
+
+# Same shape as GetVLAN, for every leaf prefix
+QUERY_LEAF_PREFIXES = QUERIES.register('LeafPrefixes', '''
+    query LeafPrefixes{
+        prefix_list(filters: {children: "0"}){
+            id
+            prefix
+            site {
+                id
+                name
+            }
+            vlan {
+                id
+                name
+                vid
+            }
+        }
+    }
+''')
+
+# Everything the provisioner needs from Netbox for one lease, in one document.
+# The mgmt VLAN and the router/AP come from the reg prefix's site, so they
+# are selected locally instead of being chained as separate queries.
+QUERY_PROVISIONING_CONTEXT = QUERIES.register('ProvisioningContext', '''
+    query ProvisioningContext($ip: String!, $exact: String!, $starts_with: String!){
+        reg: prefix_list(filters: {contains: $ip, children: "0"}){
+            id
+            prefix
+            site {
+                id
+                name
+                vlans {
+                    id
+                    vid
+                    name
+                }
+                devices {
+                    name
+                    role {
+                        id
+                        name
+                    }
+                    primary_ip4 {
+                        address
+                    }
+                }
+            }
+            vlan {
+                id
+                name
+                vid
+            }
+        }
+        tenant: tenant_list(filters: {
+            name: {exact: $exact},
+            OR: {
+                name: {starts_with: $starts_with}
+            }
+        }){
+            id
+            name
+        }
+    }
+''')
+
+QUERY_SITE_DEVICES = QUERIES.register('SiteDevices', '''
+    query SiteDevices($id: [String!]){
+        device_list(filters: {site_id: $id}){
+            name
+            site {
+                id
+            }
+            role {
+                id
+                name
+            }
+            primary_ip4 {
+                address
+            }
+        }
+    }
+''')
+
+QUERY_VLAN_SITE = QUERIES.register('VlanSite', '''
+    query VlanSite($id: Int!){
+        vlan(id: $id){
+            site {
+                id
+            }
+        }
+    }
+''')
+
+QUERY_DEVICE_SITE = QUERIES.register('DeviceSite', '''
+    query DeviceSite($name: String!){
+        device_list(filters: {name: {exact: $name}}){
+            site {
+                id
+            }
+        }
+    }
+''')
+
+# Bulk provisioning, the site half of ProvisioningContext for many sites
+QUERY_SITES_CONTEXT = QUERIES.register('SitesContext', '''
+    query SitesContext($id: [String!]){
+        site_list(filters: {id: $id}){
+            id
+            name
+            vlans {
+                id
+                vid
+                name
+            }
+            devices {
+                name
+                role {
+                    id
+                    name
+                }
+                primary_ip4 {
+                    address
+                }
+            }
+        }
+    }
+''')
+
+# Bulk provisioning, tenants for many accounts by exact name
+QUERY_TENANTS_BY_NAME = QUERIES.register('TenantsByName', '''
+    query TenantsByName($names: [String!]!){
+        tenant_list(filters: {name: {in_list: $names}}){
+            id
+            name
+        }
+    }
+''')
@@ -0,0 +1,83 @@
+'''Async Netbox REST client for the writes GraphQL can't do'''
+import logging
+import time
+from typing import Optional
+import httpx
+
+from .limiter import OVERLOAD_ERRORS
+
+log = logging.getLogger()
+
+
+class NetboxRestException(Exception):
+    '''Netbox REST API returned an error'''
+
+
+class NetboxRest(object):
+    '''Netbox REST API over one shared, pooled httpx client'''
+
+    def __init__(self, url: str, token: str, limiter, limits: httpx.Limits, http2: bool = False):
+        self.base_url = url.rstrip('/') + '/api/'
+        self.token = token
+        self.limiter = limiter
+        self.limits = limits
+        self.http2 = http2
+        self.client = None
+
+    def _client(self) -> httpx.AsyncClient:
+        '''Return the shared client, creating it on first use'''
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Token {self.token}",
+                    "Accept": "application/json"
+                },
+                limits=self.limits,
+                http2=self.http2
+            )
+        return self.client
+
+    async def close(self):
+        '''Close the connection pool'''
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def request(self, method: str, path: str, **kwargs) -> Optional[dict]:
+        '''Send a request, returning the decoded body or None on 404'''
+        async with self.limiter:
+            start = time.monotonic()
+            try:
+                res = await self._client().request(method, path, **kwargs)
+            except OVERLOAD_ERRORS:
+                await self.limiter.record(time.monotonic() - start, failed=True)
+                raise
+            await self.limiter.record(time.monotonic() - start, res.status_code)
+
+        if res.status_code == 404:
+            return None
+        if res.is_error:
+            raise NetboxRestException(f'{method} {path} returned {res.status_code}: {res.text}')
+        if not res.content:
+            return None
+        return res.json()
+
+    async def get_vlan(self, vlan_id: int) -> Optional[dict]:
+        '''Return VLAN by Netbox ID'''
+        return await self.request('GET', f'ipam/vlans/{int(vlan_id)}/')
+
+    async def update_vlan(self, vlan_id: int, **fields) -> dict:
+        '''PATCH fields on a VLAN'''
+        res = await self.request('PATCH', f'ipam/vlans/{int(vlan_id)}/', json=fields)
+        if res is None:
+            raise NetboxRestException(f'VLAN {vlan_id} does not exist')
+        return res
+
+    async def get_tenant(self, tenant_id: int) -> Optional[dict]:
+        '''Return tenant by Netbox ID'''
+        return await self.request('GET', f'tenancy/tenants/{int(tenant_id)}/')
+
+    async def create_tenant(self, name: str, slug: str) -> dict:
+        '''Create a tenant'''
+        return await self.request('POST', 'tenancy/tenants/', json={'name': name, 'slug': slug})
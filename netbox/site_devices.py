@@ -0,0 +1,111 @@
+'''Cached per-site index of devices by role and name'''
+import re
+import time
+from typing import Dict, List, Optional
+from ..cache import TTLCache, MISSING
+from .queries import QUERY_SITE_DEVICES, QUERY_VLAN_SITE, QUERY_DEVICE_SITE
+
+DEFAULT_DEVICE_TTL = 600.0
+# Every device of every loaded site is kept, size for the whole fleet
+DEFAULT_DEVICE_SITE_CACHE_SIZE = 50000
+DEFAULT_VLAN_SITE_CACHE_SIZE = 10000
+
+
+def device_ip(device: dict) -> Optional[str]:
+    '''Primary IPv4 of a device without the mask'''
+    if not device.get("primary_ip4"):
+        return None
+    return re.sub(r"/\d*$", "", device["primary_ip4"]["address"])
+
+
+class SiteDevices(object):
+    '''One site's devices keyed by role, and by (role, name)'''
+
+    def __init__(self, site_id: int, devices: List[dict]):
+        self.site_id = site_id
+        self.loaded = time.monotonic()
+        self.by_role: Dict[str, List[dict]] = {}
+        self.by_name: Dict[tuple, dict] = {}
+        for device in devices:
+            role = (device.get("role") or {}).get("name")
+            self.by_role.setdefault(role, []).append(device)
+            self.by_name[(role, device.get("name"))] = device
+
+    def router_ip(self) -> Optional[str]:
+        # Last router wins, as the linear scan this replaces did
+        routers = self.by_role.get("Router")
+        return device_ip(routers[-1]) if routers else None
+
+    def ip(self, role: str, name: str) -> Optional[str]:
+        device = self.by_name.get((role, name))
+        return device_ip(device) if device else None
+
+
+class SiteDeviceIndex(object):
+    '''SiteDevices per site, loaded on first use and refreshed after a TTL'''
+
+    def __init__(
+        self,
+        driver,
+        ttl: float = DEFAULT_DEVICE_TTL,
+        device_cache_size: int = DEFAULT_DEVICE_SITE_CACHE_SIZE,
+        vlan_cache_size: int = DEFAULT_VLAN_SITE_CACHE_SIZE
+    ):
+        self.driver = driver
+        self.ttl = ttl
+        self.sites: Dict[int, SiteDevices] = {}
+        self.vlan_sites = TTLCache(vlan_cache_size, ttl)
+        self.device_sites = TTLCache(device_cache_size, ttl)
+
+    async def site(self, site_id: int) -> SiteDevices:
+        site_id = int(site_id)
+        devices = self.sites.get(site_id)
+        if devices is None or time.monotonic() - devices.loaded > self.ttl:
+            res = await self.driver.execute(
+                QUERY_SITE_DEVICES,
+                variable_values={
+                    'id': [str(site_id)]
+                }
+            )
+            devices = self.add(site_id, res.get("device_list") or [])
+        return devices
+
+    def add(self, site_id: int, device_list: List[dict]) -> SiteDevices:
+        '''Index a site's devices fetched elsewhere, e.g. with a provisioning context'''
+        devices = SiteDevices(int(site_id), device_list)
+        self.sites[devices.site_id] = devices
+        for device in device_list:
+            self.device_sites.set(device.get("name"), devices.site_id)
+        return devices
+
+    async def site_for_vlan(self, vlan_id: int) -> int:
+        '''Site a VLAN belongs to'''
+        site_id = self.vlan_sites.get(int(vlan_id))
+        if site_id is MISSING:
+            res = await self.driver.execute(
+                QUERY_VLAN_SITE,
+                variable_values={
+                    'id': int(vlan_id)
+                }
+            )
+            if not res.get("vlan") or not res["vlan"].get("site"):
+                raise Exception(f"VLAN {vlan_id} has no site")
+            site_id = int(res["vlan"]["site"]["id"])
+            self.vlan_sites.set(int(vlan_id), site_id)
+        return site_id
+
+    async def site_for_device(self, name: str) -> int:
+        '''Site a device belongs to, by device name'''
+        site_id = self.device_sites.get(name)
+        if site_id is MISSING:
+            res = await self.driver.execute(
+                QUERY_DEVICE_SITE,
+                variable_values={
+                    'name': name
+                }
+            )
+            if not res.get("device_list") or not res["device_list"][0].get("site"):
+                raise Exception(f"Device {name} not found")
+            site_id = int(res["device_list"][0]["site"]["id"])
+            self.device_sites.set(name, site_id)
+        return site_id
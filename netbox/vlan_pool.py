@@ -0,0 +1,127 @@
+'''In-memory index of assignable tenant VLANs per site'''
+import time
+from typing import Dict, Optional, Tuple
+from gql.transport.exceptions import TransportQueryError
+
+from ..coalesce import Coalescer
+from .queries import QUERY_SITE, QUERY_TENANT_VLANS_BY_SITE
+
+
+# TODO: Range is business logic, maybe check for role instead of range
+# At time of writing Role is NAT Access, but VLAN doesn't define whether
+# prefix is NAT or Public, should change role to "Tenant" first
+TENANT_VID_MIN = 1024
+TENANT_VID_MAX = 3072
+
+# Reload a site from Netbox after this long, to pick up changes made elsewhere
+DEFAULT_POOL_TTL = 3600.0
+
+
+class NetboxVlanPoolException(Exception):
+    '''General Exception for the VLAN pool index'''
+
+
+class SiteVlanPool(object):
+    '''Free/used bitmap of one site's tenant VIDs, plus VID to Netbox ID map'''
+
+    def __init__(self, site_id: int, vlans: list):
+        self.site_id = site_id
+        self.loaded = time.monotonic()
+        self.free = 0  # Bit n set when VID n is unassigned
+        self.ids: Dict[int, int] = {}
+        for vlan in vlans:
+            vid = int(vlan['vid'])
+            self.ids[vid] = int(vlan['id'])
+            if vlan.get('tenant') is None:
+                self.free |= 1 << vid
+
+    def next_free(self) -> Optional[Tuple[int, int]]:
+        '''Return (Netbox ID, VID) of the lowest free VLAN'''
+        if not self.free:
+            return None
+        vid = (self.free & -self.free).bit_length() - 1
+        return self.ids[vid], vid
+
+    def mark_used(self, vid: int):
+        '''Take VID out of the free set'''
+        self.free &= ~(1 << vid)
+
+    def mark_free(self, vid: int):
+        '''Put VID back in the free set, if it is one of the site's tenant VLANs'''
+        if vid in self.ids:
+            self.free |= 1 << vid
+
+
+class VlanPoolIndex(object):
+    '''Lazily loaded SiteVlanPool per site, updated as VLANs are assigned and released'''
+
+    def __init__(self, driver, ttl: float = DEFAULT_POOL_TTL):
+        self.driver = driver
+        self.ttl = ttl
+        self.pools: Dict[int, SiteVlanPool] = {}
+        self.vlans: Dict[int, Tuple[int, int]] = {}  # Netbox ID -> (site ID, VID)
+        # Concurrent first uses of a site share one load
+        self.loads = Coalescer(ttl=0)
+
+    async def get(self, site_id: int) -> SiteVlanPool:
+        '''Return the pool for a site, loading it from Netbox on first use'''
+        site_id = int(site_id)
+        pool = self.pools.get(site_id)
+        if pool is None or time.monotonic() - pool.loaded > self.ttl:
+            pool = await self.loads.run(site_id, lambda: self.load(site_id))
+        return pool
+
+    async def load(self, site_id: int) -> SiteVlanPool:
+        '''Build a site's pool from one query'''
+        res = await self.driver.execute(
+            QUERY_TENANT_VLANS_BY_SITE,
+            variable_values={
+                'id': str(site_id)
+            }
+        )
+        # GraphQL AND returns VLANs for all sites (site-less ones included)
+        # when the site doesn't exist, so only keep rows of the requested site.
+        vlans = [
+            x for x in res.get('vlan_list') or []
+            if x.get('site') and int(x['site']['id']) == site_id
+            and TENANT_VID_MIN <= int(x['vid']) < TENANT_VID_MAX
+        ]
+        if not vlans:
+            await self.site_exists(site_id)
+            raise NetboxVlanPoolException(f'No assignable VLANs found for site {site_id}')
+
+        pool = SiteVlanPool(site_id, vlans)
+        self.pools[site_id] = pool
+        for vid, vlan_id in pool.ids.items():
+            self.vlans[vlan_id] = (site_id, vid)
+        return pool
+
+    async def site_exists(self, site_id: int):
+        '''Raise NetboxVlanPoolException if site does not exist'''
+        try:
+            res = await self.driver.execute(QUERY_SITE, variable_values={'id': int(site_id)})
+        except TransportQueryError as e:
+            if any('site' in error.get('path', []) for error in e.errors or []):
+                raise NetboxVlanPoolException(f'Site {site_id} does not exist') from e
+            raise
+        if res.get('site') is None:
+            raise NetboxVlanPoolException(f'Site {site_id} does not exist')
+
+    def invalidate(self, site_id: Optional[int] = None):
+        '''Drop a site's pool, or every pool, so it is reloaded on next use'''
+        if site_id is None:
+            self.pools.clear()
+        else:
+            self.pools.pop(int(site_id), None)
+
+    def mark_used(self, vlan_id: int):
+        '''Record that a VLAN, by Netbox ID, was assigned to a tenant'''
+        site_id, vid = self.vlans.get(int(vlan_id), (None, None))
+        if site_id in self.pools:
+            self.pools[site_id].mark_used(vid)
+
+    def mark_free(self, vlan_id: int):
+        '''Record that a VLAN, by Netbox ID, was released'''
+        site_id, vid = self.vlans.get(int(vlan_id), (None, None))
+        if site_id in self.pools:
+            self.pools[site_id].mark_free(vid)
@@ -1,7 +1,21 @@
 import inspect
-import importlib.util
+import importlib
+import json
+import logging
+import pkgutil
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger('drivers/network')
+
+# Optional {platform: {command name: "module:Class"}}, saves scanning a platform
+MANIFEST_PATH = Path(__file__).parent / 'platforms' / 'manifest.json'
+
+# Netbox platform slug -> package under platforms/
+PLATFORM_PACKAGES = {
+    'ios-xr': 'cisco_iosxr',
+}
 
 
 class Command(ABC):
@@ -10,34 +24,87 @@ class Command(ABC):
         pass
 
 
-class CommandPlatformResolver:
-    def __init__(self):
-        self._map = {}
-        for file in (Path(__file__).parent / 'platforms').rglob('*.py'):
-            if file.name.startswith('_'):
-                continue
+class CommandRegistry:
+    '''
+    Process-wide map of (platform, command name) to Command class.  A command
+    is named after its module under platforms/<platform>/.  Platforms are
+    loaded on first use, through the normal import system so modules are
+    never executed twice, and only the needed module is imported when the
+    manifest lists the command.
+    '''
+    def __init__(self, manifest_path: Path = MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        self._map: Dict[Tuple[str, str], type] = {}
+        self._scanned = set()
+        self._manifest: Optional[dict] = None
 
-            spec = importlib.util.spec_from_file_location(file.stem, file)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            self._manifest = {}
+            if self.manifest_path.exists():
+                self._manifest = json.loads(self.manifest_path.read_text())
+        return self._manifest
 
+    def get(self, platform: str, name: str) -> type:
+        platform = PLATFORM_PACKAGES.get(platform, platform)
+        key = (platform, name)
+        if key not in self._map:
+            entry = self.manifest().get(platform, {}).get(name)
+            if entry:
+                module_name, class_name = entry.split(':')
+                module = importlib.import_module(f'.platforms.{platform}.{module_name}', __package__)
+                self._map[key] = getattr(module, class_name)
+            elif platform not in self._scanned:
+                self.scan(platform)
+        if key not in self._map:
+            raise Exception(f'No command {name} for platform {platform}')
+        return self._map[key]
+
+    def set(self, platform: str, name: str, cls: type):
+        self._map[(platform, name)] = cls
+
+    def scan(self, platform: str):
+        '''Register every command of a platform'''
+        package = importlib.import_module(f'.platforms.{platform}', __package__)
+        for info in pkgutil.iter_modules(package.__path__):
+            if info.name.startswith('_'):
+                continue
+            module = importlib.import_module(f'{package.__name__}.{info.name}')
             for _, cls in inspect.getmembers(module, inspect.isclass):
-                if issubclass(cls, Command) and cls is not Command:
-                    self.set(file.stem, cls)
+                if issubclass(cls, Command) and cls is not Command and cls.__module__ == module.__name__:
+                    self._map.setdefault((platform, info.name), cls)
+        self._scanned.add(platform)
+        log.debug(f'Loaded commands for platform {platform}')
 
-    def get(self, name):
-        return self._map.get(name)
+    def write_manifest(self):
+        '''Scan every platform and save the manifest, to ship with a release'''
+        platforms = importlib.import_module('.platforms', __package__)
+        manifest = {}
+        for info in pkgutil.iter_modules(platforms.__path__):
+            if not info.ispkg:
+                continue
+            self.scan(info.name)
+            manifest[info.name] = {
+                name: f'{cls.__module__.rsplit(".", 1)[1]}:{cls.__name__}'
+                for (platform, name), cls in self._map.items() if platform == info.name
+            }
+        self.manifest_path.write_text(json.dumps(manifest, indent=4, sort_keys=True))
+        self._manifest = manifest
 
-    def set(self, name, cls):
-        self._map[name] = cls
 
+COMMANDS = CommandRegistry()
 
 
 class CommandExecutor:
-    def __init__(self, conn):
+    '''
+    Runs commands on a connection.  run() takes a Command, or a command name
+    and its arguments which is resolved for the executor's platform.
+    '''
+    def __init__(self, conn, platform: Optional[str] = None):
         self.conn = conn
-        self.resolver = CommandPlatformResolver()
+        self.platform = platform
 
-    async def run(name, *args, **kwargs):
-        command = self.resolver.get(name)
-        return await command(*args, **kwargs)
+    async def run(self, command, *args, **kwargs):
+        if isinstance(command, str):
+            command = COMMANDS.get(self.platform, command)(*args, **kwargs)
+        return await command.execute(self)
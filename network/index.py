@@ -1,6 +1,7 @@
 # Imports
-import json
+import asyncio
 from string import Template
+from typing import List
 import logging
 import logging.config
 from aio_pika import IncomingMessage
@@ -12,71 +13,72 @@ from gql.transport.aiohttp import log as gql_logger
 from scrapli.driver.core import AsyncIOSXRDriver
 from scrapli.driver.base.base_driver import BaseDriver
 
+from ..coalesce import Coalescer
+from ..envelope import Envelope
+from ..deadline import expired
+from ..metrics import METRICS, span
 from .utils import CommandExecuter
 from .provision_cvlan import ProvisionCVLAN
-from .platforms import cisco_iosxr
+from .ssh_pool import SSHSessionPool, DEFAULT_MAX_PER_DEVICE, DEFAULT_IDLE_TIMEOUT, DEFAULT_PROBE_TIMEOUT
+from .command import COMMANDS
 
 # Defining variables
 gql_logger.setLevel(logging.CRITICAL)
 log = logging.getLogger('drivers/network')
 
-async def get_site_router_type(API_TOKEN, NETBOX_API_URL, IP_ADDRESS):
-    NETBOX_API_URL = "https://netbox.utbb.net/graphql/"
-    QL_HEADERS = {"Authorization": f"Token {API_TOKEN}"}
-    QL_TRANSPORT = AIOHTTPTransport(url=NETBOX_API_URL, headers=QL_HEADERS)
-    client = Client(transport=QL_TRANSPORT, fetch_schema_from_transport=False)
-
-    # Gets Router's Primary IPv4 IP ID
-    router_ip_id_query = gql("""
-    query DeviceIDFromIPAddress($ip: StrFilterLookup!) {
-        ip_address_list(filters: {address: $ip}) {
-            id
+DEFAULT_ROUTER_CACHE_SIZE = 1000
+DEFAULT_ROUTER_CACHE_TTL = 3600.0
+
+# Platform and site of the device an IP is assigned to, in one round trip
+QUERY_ROUTER_PLATFORM = gql("""
+query RouterPlatform($ip: String!) {
+    ip_address_list(filters: {address: {exact: $ip}}) {
+        id
+        assigned_object {
+            ... on InterfaceType {
+                device {
+                    device_type {
+                        manufacturer {
+                            name
+                        }
+                        default_platform {
+                            slug
+                        }
+                    }
+                    site {
+                        slug
+                    }
+                    primary_ip4 {
+                        id
+                    }
+                }
+            }
         }
     }
-    """)
-
-    router_info_query = gql("""
-    query DeviceInfoFromID($id: [String!]){
-        device_list(filters: {primary_ip4_id: $id}){
-            device_type{
-                manufacturer{
-                    name
-                }
-                default_platform {
-                    slug
-                }
+}
+""")
+
+# Platform and site of the device whose primary IPv4 is an IP address ID
+QUERY_PRIMARY_IP_DEVICE = gql("""
+query DeviceInfoFromID($id: [String!]) {
+    device_list(filters: {primary_ip4_id: $id}) {
+        device_type {
+            manufacturer {
+                name
             }
-            site
-            {
+            default_platform {
                 slug
             }
         }
-    }
-    """)
-
-    router_ip_id_query_variables = {
-        "ip": {
-            "exact": IP_ADDRESS
+        site {
+            slug
+        }
+        primary_ip4 {
+            id
         }
     }
-
-    try:
-        async with client as session:
-            get_router_ip = await session.execute(router_ip_id_query, variable_values=router_ip_id_query_variables)
-            primary_ip4_id = get_router_ip.get("ip_address_list")[0].get("id")
-            log.info(f'Got primary_ip4_id f{primary_ip4_id}')
-            router_info_query_variables = {
-                "id": [str(primary_ip4_id)]
-            }
-            get_router_data = await session.execute(router_info_query, variable_values=router_info_query_variables)
-            log.info(f'Received router data {get_router_data}')
-            return [
-                get_router_data.get("device_list")[0].get("device_type").get("default_platform").get("slug"),
-                get_router_data.get("device_list")[0].get("site").get("slug")
-            ]
-    except:
-        log.error("Error: Could not get router platform")
-        raise
+}
+""")
 
 
 class RouterModel(BaseModel):
@@ -89,6 +91,20 @@ class RouterModel(BaseModel):
         extra = "allow"
 
 
+class CVLANChange(BaseModel):
+    ip: str
+    customer_vlan: int
+
+
+class RouterBatchModel(BaseModel):
+    routing_key: str
+    router_ip: str
+    changes: List[CVLANChange]
+
+    class Config:
+        extra = "allow"
+
+
 class ProvisionCVLANRequest(BaseModel):
     site_id: int
     arp_ip: str
@@ -100,12 +116,37 @@ class ProvisionCVLANRequest(BaseModel):
 
 class Network(BaseRpcServer, BaseConsumer, BasePublisher):
     name = "Network"
-    binding_keys = ["rpc.network.router.add_cvlan_to_interface_by_arp"]
+    binding_keys = [
+        "rpc.network.router.add_cvlan_to_interface_by_arp",
+        "rpc.network.router.add_cvlans_to_interfaces_by_arp"
+    ]
     model = RouterModel
 
-    def __init__(self):
-
-        provision_cvlan = ProvisionCVLAN(self)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.config.netbox_api_url:
+            raise Exception('Unable to get Netbox URL from config')
+        # One Netbox client and session for the driver's lifetime
+        self.client = Client(
+            transport=AIOHTTPTransport(
+                url=self.config.netbox_api_url + '/graphql/',
+                headers={"Authorization": f"Token {self.config.netbox_api_key}"}
+            ),
+            fetch_schema_from_transport=False
+        )
+        self.session = None
+        self.session_lock = asyncio.Lock()
+        # Router platform and site hardly ever change
+        self.router_platforms = Coalescer(
+            int(getattr(self.config, 'router_platform_cache_size', None) or DEFAULT_ROUTER_CACHE_SIZE),
+            float(getattr(self.config, 'router_platform_cache_ttl', None) or DEFAULT_ROUTER_CACHE_TTL)
+        )
+        # Warm router sessions, keyed by (router IP, platform)
+        self.ssh_pool = SSHSessionPool(
+            int(getattr(self.config, 'ssh_pool_max_per_device', None) or DEFAULT_MAX_PER_DEVICE),
+            float(getattr(self.config, 'ssh_pool_idle_timeout', None) or DEFAULT_IDLE_TIMEOUT),
+            float(getattr(self.config, 'ssh_probe_timeout', None) or DEFAULT_PROBE_TIMEOUT)
+        )
 
     def ssh_factory(self, host: str, netbox_platform_slug: str) -> BaseDriver:
         device = {
@@ -129,17 +170,33 @@ class Network(BaseRpcServer, BaseConsumer, BasePublisher):
             print(f"Errors with getting Router consumer message: {message}")
             return None
 
-
+        port = getattr(self.config, 'metrics_port', None)
+        if port:
+            await METRICS.serve(int(port))
+        # Decoded once, each branch validates its own request model from it
+        try:
+            body = Envelope.decode(message.body)
+        except Exception as e:
+            await self.reply({ "error": f"Malformed request - {e}", "res": None }, message)
+            raise Exception(f"Malformed request - {e}")
+        # The caller has already given up on this, don't spend Netbox/router time on it
+        if expired(body.get("deadline")):
+            log.warning(f"Skipping {message.routing_key}, its deadline has passed (trace {body.get('trace_id')})")
+            await self.reply({ "error": "Deadline exceeded before the request was handled", "res": None }, message)
+            return
+        # Child span of the provisioner's trace, when it sent one
+        async with span(self.name, message.routing_key, body.get("trace_id")):
+            await self.handle(message, body)
+
+    async def handle(self, message: IncomingMessage, body: Envelope):
         # Getting variables from .conf
-        NETBOX_API_TOKEN = self.config.netbox_api_key
-        NETBOX_API_URL = self.config.netbox_api_url
         SSH_USER = self.config.ssh_user
         SSH_PASS = self.config.ssh_pass
         RTR_PASS = self.config.rtr_ssh_pass
 
         if message.routing_key == "rpc.network.provision_cvlan":
             try:
-                request = ProvisionCVLANRequest.model_validate_json(message.body)
+                request = ProvisionCVLANRequest.model_validate(body.to_dict())
                 result = await self.provision_cvlan(request)
                 self.reply({'error': None, 'res': result})
             except Exception as e:
@@ -150,14 +207,9 @@ class Network(BaseRpcServer, BaseConsumer, BasePublisher):
 
         elif message.routing_key == "rpc.network.router.add_cvlan_to_interface_by_arp":
             try:
-                # Extracting the message body and parsing it as JSON
-                body = json.loads(message.body)
-
                 # Parse the body into the RouterModel
-                router_data = RouterModel(**body)
-                site_data = await get_site_router_type(
-                    NETBOX_API_TOKEN, NETBOX_API_URL, router_data.router_ip
-                )
+                router_data = RouterModel.model_validate(body.to_dict())
+                site_data = await self.get_site_router_type(router_data.router_ip)
                 log.info(site_data)
                 nb_platform = str(site_data[0])
                 site_slug = str(site_data[1])
@@ -173,7 +225,7 @@ class Network(BaseRpcServer, BaseConsumer, BasePublisher):
                 match nb_platform:
                     case "ios-xr":
                         network_driver = AsyncIOSXRDriver
-                        command = cisco_iosxr.AddCVLANToInterfaceByArp
+                        command = COMMANDS.get(nb_platform, 'add_cvlan_to_interface_by_arp')
                         device['textfsm_platform'] = 'cisco_xr'
                     # TODO: case "routeros":
                     # TODO: case "extreme":
@@ -183,15 +235,77 @@ class Network(BaseRpcServer, BaseConsumer, BasePublisher):
                         raise Exception("Unknown router platform")
 
 
-                async with network_driver(**device) as conn:
+                async with self.ssh_pool.session(
+                    (router_data.router_ip, nb_platform), lambda: network_driver(**device)
+                ) as conn:
                     command = command(router_data.ip, router_data.customer_vlan)
-                    executer = CommandExecuter(conn)
+                    executer = CommandExecuter(conn, nb_platform)
                     await executer.run(command)
                 await self.reply({ "error": None, "res": "Router/Switch Config successfully completed" }, message)
             except Exception as e:
                 await self.reply({ "error": f"{e}", "res": None }, message)
                 raise Exception(f"Error in SM Config - {e}")
 
+        elif message.routing_key == "rpc.network.router.add_cvlans_to_interfaces_by_arp":
+            # Bulk provisioning: one session and one commit for a router's whole change set
+            try:
+                batch = RouterBatchModel.model_validate(body.to_dict())
+                site_data = await self.get_site_router_type(batch.router_ip)
+                nb_platform = str(site_data[0])
+
+                device = {
+                    'host': batch.router_ip,
+                    'auth_username': self.config.ssh_user,
+                    'auth_password': self.config.rtr_ssh_pass,
+                    'auth_strict_key': False,
+                    'transport': 'asyncssh'
+                }
+
+                match nb_platform:
+                    case "ios-xr":
+                        network_driver = AsyncIOSXRDriver
+                        device['textfsm_platform'] = 'cisco_xr'
+                    case _:
+                        log.error("Unknown router platform.")
+                        await self.reply({ "error": "Unknown router platform", "res": None }, message)
+                        raise Exception("Unknown router platform")
+
+                async with self.ssh_pool.session(
+                    (batch.router_ip, nb_platform), lambda: network_driver(**device)
+                ) as conn:
+                    command = COMMANDS.get(nb_platform, 'add_cvlans_to_interfaces_by_arp')(
+                        [(x.ip, x.customer_vlan) for x in batch.changes]
+                    )
+                    executer = CommandExecuter(conn, nb_platform)
+                    errors = await executer.run(command)
+                log.info(f"Applied {len(batch.changes)} cVLAN changes on {batch.router_ip}")
+                await self.reply({ "error": None, "res": [
+                    { "error": error, "res": None if error else "Router/Switch Config successfully completed" }
+                    for error in errors
+                ] }, message)
+            except Exception as e:
+                await self.reply({ "error": f"{e}", "res": None }, message)
+                raise Exception(f"Error in Router Batch Config - {e}")
+
+
+    async def provision_cvlan(self, request):
+        # A fresh command per request, it keeps the driver on itself while running
+        return await ProvisionCVLAN()(self, request)
+
+    async def close(self):
+        '''Shutdown: close pooled sessions, then the RPC connections'''
+        await self.close_sessions()
+        parent = getattr(super(), 'close', None)
+        if parent is not None:
+            await parent()
+
+    async def close_sessions(self):
+        '''Close pooled router sessions and the Netbox session, for shutdown'''
+        await self.ssh_pool.close()
+        async with self.session_lock:
+            if self.session is not None:
+                await self.client.close_async()
+                self.session = None
 
     async def slack_post(self, message):
         msg = {
@@ -202,5 +316,33 @@ class Network(BaseRpcServer, BaseConsumer, BasePublisher):
 
 
     async def execute(self, *args, **kwargs):
-        async with self.limiter, self.client as session:
-            return await session.execute(*args, **kwargs)
+        async with self.session_lock:
+            if self.session is None:
+                self.session = await self.client.connect_async(reconnecting=True)
+        return await self.session.execute(*args, **kwargs)
+
+    async def get_site_router_type(self, ip: str) -> list:
+        '''[platform slug, site slug] of the router at ip, cached per IP'''
+        return await self.router_platforms.run(ip, lambda: self.fetch_site_router_type(ip))
+
+    async def fetch_site_router_type(self, ip: str) -> list:
+        try:
+            res = await self.execute(QUERY_ROUTER_PLATFORM, variable_values={ "ip": ip })
+            ip_address = res.get("ip_address_list")[0]
+            device = (ip_address.get("assigned_object") or {}).get("device")
+            # The router is the device with this IP as its primary, which is
+            # nearly always the device it is assigned to.  Otherwise ask again.
+            if not device or (device.get("primary_ip4") or {}).get("id") != ip_address.get("id"):
+                res = await self.execute(
+                    QUERY_PRIMARY_IP_DEVICE,
+                    variable_values={ "id": [str(ip_address.get("id"))] }
+                )
+                device = res.get("device_list")[0]
+            log.info(f'Received router data {device}')
+            return [
+                device.get("device_type").get("default_platform").get("slug"),
+                device.get("site").get("slug")
+            ]
+        except:
+            log.error("Error: Could not get router platform")
+            raise
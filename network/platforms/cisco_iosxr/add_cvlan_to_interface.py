@@ -9,7 +9,7 @@ class AddCVLANToInterface(Command):
         self.cvlan = cvlan
 
     async def execute(self, executer):
-        for interface in await executer.run('get_configured_interfaces'):
+        for interface in await executer.run('get_configured_interfaces', self.cvlan):
             parts = interface.split('.')
             if len(parts) > 1 and int(parts[1]) == self.cvlan:  # Found matching VLAN
                 if parts[0] == self.interface:  # Nothing to do if already on interface
@@ -10,7 +10,7 @@ class AddCVLANToInterfaceByArp(Command):
         self.cvlan = cvlan
 
     async def execute(self, executer):
-        for arp in await executer.run('arp'):
+        for arp in await executer.run('arp', self.ip):
             if arp['ip_address'] == self.ip:
                 interface = arp['interface'].split('.')[0]
                 break
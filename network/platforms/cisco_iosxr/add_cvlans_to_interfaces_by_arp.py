@@ -0,0 +1,49 @@
+from typing import List, Optional, Tuple
+from ...command import Command
+
+
+class AddCVLANsToInterfacesByArp(Command):
+    '''
+    AddCVLANToInterfaceByArp for many (ip, cvlan) pairs, reading the ARP table
+    and interface list once and applying every move in a single commit.
+    Returns an error (or None) per change, in order.
+    '''
+    def __init__(self, changes: List[Tuple[str, int]]):
+        self.changes = changes
+
+    async def execute(self, executer) -> List[Optional[str]]:
+        # Full tables here, one read each beats a filtered command per change
+        arp = {}
+        for entry in await executer.run('arp'):
+            arp.setdefault(entry['ip_address'], entry['interface'].split('.')[0])
+
+        # First configured sub-interface per VLAN, as the single command picks
+        by_vlan = {}
+        for interface in await executer.run('get_configured_interfaces'):
+            parts = interface.split('.')
+            if len(parts) > 1 and parts[1].isdigit():
+                by_vlan.setdefault(int(parts[1]), interface)
+
+        configs = []
+        errors = []
+        for ip, cvlan in self.changes:
+            cvlan = int(cvlan)
+            if ip not in arp:
+                errors.append(f'Could not find ARP for {ip}')
+                continue
+            interface = by_vlan.get(cvlan)
+            if interface is None:
+                errors.append(f'Could not find configured interface with vlan {cvlan}')
+                continue
+            errors.append(None)
+            if interface.split('.')[0] == arp[ip]:  # Nothing to do if already on interface
+                continue
+            configs += [
+                f'replace interface {interface} with {arp[ip]}.{cvlan}',
+                f'no interface {interface}'
+            ]
+            by_vlan[cvlan] = f'{arp[ip]}.{cvlan}'
+
+        if configs:
+            await executer.conn.send_configs(configs + ['commit', 'exit'])
+        return errors
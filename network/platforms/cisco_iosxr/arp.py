@@ -1,10 +1,21 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from ...command import Command
+from ...utils import TEMPLATES
 
 
 class Arp(Command):
+    '''
+    ARP table, or only the entry for ip when given.  The router filters a
+    single address itself, the full table is read if it rejects the command.
+    '''
+    def __init__(self, ip: Optional[str] = None):
+        self.ip = ip
 
     async def execute(self, executer) -> List[Dict[str, Any]]:
         cmd = 'show arp'
+        if self.ip is not None:
+            response = await executer.conn.send_command(f'{cmd} {self.ip}')
+            if not response.failed:
+                return TEMPLATES.parse(executer.conn.textfsm_platform, cmd, response.result)
         response = await executer.conn.send_command(cmd)
-        return response.textfsm_parse_output()
+        return TEMPLATES.parse(executer.conn.textfsm_platform, cmd, response.result)
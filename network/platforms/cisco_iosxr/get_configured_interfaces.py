@@ -1,4 +1,6 @@
-from io import BytesIO, TextIOWrapper
+from typing import Optional
+from ...command import Command
+from ...utils import TEMPLATES
 
 template = '''\
 Value List INTERFACES (\S+)
@@ -7,15 +9,34 @@ Start
   ^interface(\s+preconfigure)?\s+${INTERFACES} -> Continue
 '''
 
+cmd = 'show run | inc ^interface'
 
-class GetConfiguredInterfaces(object):
+# Compiled once, shared by every execution
+TEMPLATES.register('cisco_xr', cmd, template)
+
+
+class GetConfiguredInterfaces(Command):
     '''
-    Returns interfaces in configuration
+    Returns interfaces in configuration, only sub-interfaces for vlan when
+    given.  The router filters by the sub-interface suffix, the full list is
+    read if that finds nothing.
     '''
+    def __init__(self, vlan: Optional[int] = None):
+        self.vlan = vlan
 
     async def execute(self, executer):
-        cmd = 'show run | inc ^interface'
+        if self.vlan is not None:
+            # Unanchored, so 'interface X.100 l2transport' lines match too, and
+            # no '|' or '$' for the CLI to misread.  X.1000 matching as well is
+            # fine, the suffix is checked exactly below.
+            response = await executer.conn.send_command(f'{cmd} .*\\.{int(self.vlan)}')
+            if not response.failed:
+                interfaces = self.parse(response.result)
+                if any(x.split('.')[-1] == str(int(self.vlan)) for x in interfaces):
+                    return interfaces
         response = await executer.conn.send_command(cmd)
-        bytes_io = BytesIO(template.encode())
-        text_io = TextIOWrapper(bytes_io)
-        return response.textfsm_parse_output(text_io)[0]['interfaces']
+        return self.parse(response.result)
+
+    def parse(self, result: str):
+        rows = TEMPLATES.parse('cisco_xr', cmd, result)
+        return rows[0]['interfaces'] if rows else []
@@ -22,7 +22,7 @@ class ProvisionCVLAN(object):
         for router in [x for x in site_equipment if x.role.name == 'Router']:
             net_driver = self.driver.ssh_factory(router.default_platform.slug)
             async with net_driver as conn:
-                executor = CommandExecutor(conn)
+                executor = CommandExecutor(conn, router.default_platform.slug)
                 arp = await executor.run('arp', ip=request.arp_ip)
                 interface = await executor.run('interface', interface=arp['interface'])
                 macs.append(interface['mac_address'])
@@ -31,7 +31,7 @@ class ProvisionCVLAN(object):
         for switch in [x for x in site_equipment if x.role.name == 'Switch']:
             net_driver = self.driver.ssh_factory(switch.default_platform.slug)
             async with net_driver as conn:
-                executor = CommandExecutor(conn)
+                executor = CommandExecutor(conn, switch.default_platform.slug)
                 for mac in macs:
                     entry = await executor.run('mac_table', mac=mac)
                     await executor.run('add_cvlan_to_interface', interfaces=entry['destination_port'])
@@ -0,0 +1,138 @@
+'''Reusable SSH sessions to network devices'''
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List, Tuple
+
+if TYPE_CHECKING:
+    # Only for annotations, the pool works with any object with scrapli's async API
+    from scrapli.driver.base.base_driver import BaseDriver
+
+log = logging.getLogger('drivers/network')
+
+DEFAULT_MAX_PER_DEVICE = 2
+DEFAULT_IDLE_TIMEOUT = 300.0
+DEFAULT_PROBE_TIMEOUT = 5.0
+
+# Prompt of a session left in configuration mode, e.g. RP/0/RP0/CPU0:rtr(config)#
+CONFIG_PROMPT = re.compile(r'\(config[^)]*\)')
+
+
+class SSHSessionPool(object):
+    '''Open scrapli sessions per key (router IP and platform), reused
+    between requests so the login and prompt setup is paid once.
+
+    Idle sessions are closed after idle_timeout, and probed for a prompt
+    before reuse.  At most max_per_device sessions per key are in use at
+    once, further callers wait.  A session whose user raised, or that is
+    still in configuration mode when returned, is closed rather than kept,
+    its state on the device is unknown.
+    '''
+
+    def __init__(
+        self,
+        max_per_device: int = DEFAULT_MAX_PER_DEVICE,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        probe_timeout: float = DEFAULT_PROBE_TIMEOUT
+    ):
+        self.max_per_device = max_per_device
+        self.idle_timeout = idle_timeout
+        self.probe_timeout = probe_timeout
+        self.idle: Dict[Hashable, List[Tuple['BaseDriver', float]]] = {}
+        self.limits: Dict[Hashable, asyncio.Semaphore] = {}
+        self.reaper = None
+        self.closed = False
+
+    @asynccontextmanager
+    async def session(self, key: Hashable, factory: Callable[[], 'BaseDriver']):
+        '''Borrow an open session for key, opening one with factory if needed'''
+        if self.closed:
+            raise Exception('SSH session pool is closed')
+        limit = self.limits.setdefault(key, asyncio.Semaphore(self.max_per_device))
+        async with limit:
+            conn = await self._checkout(key, factory)
+            try:
+                yield conn
+            except BaseException:
+                await self._close(conn)
+                raise
+            if self.closed or not await self._returnable(key, conn):
+                await self._close(conn)
+            else:
+                self.idle.setdefault(key, []).append((conn, time.monotonic()))
+                self._start_reaper()
+
+    async def _checkout(self, key: Hashable, factory: Callable[[], 'BaseDriver']) -> 'BaseDriver':
+        sessions = self.idle.get(key) or []
+        while sessions:
+            # Most recently used first, it is the likeliest to still be up
+            conn, last_used = sessions.pop()
+            if time.monotonic() - last_used > self.idle_timeout:
+                await self._close(conn)
+            elif await self._alive(conn):
+                log.debug(f"Reusing SSH session to {key}")
+                return conn
+            else:
+                log.info(f"Dropping dead SSH session to {key}")
+                await self._close(conn)
+
+        log.debug(f"Opening SSH session to {key}")
+        conn = factory()
+        await conn.open()
+        return conn
+
+    async def _alive(self, conn: 'BaseDriver') -> bool:
+        try:
+            if not conn.isalive():
+                return False
+            await asyncio.wait_for(conn.get_prompt(), self.probe_timeout)
+            return True
+        except Exception:
+            return False
+
+    async def _returnable(self, key: Hashable, conn: 'BaseDriver') -> bool:
+        '''Back at the exec prompt, so the next borrower starts clean'''
+        try:
+            prompt = await asyncio.wait_for(conn.get_prompt(), self.probe_timeout)
+        except Exception:
+            return False
+        if CONFIG_PROMPT.search(prompt):
+            log.warning(f"SSH session to {key} returned in configuration mode, closing it")
+            return False
+        return True
+
+    async def _close(self, conn: 'BaseDriver'):
+        try:
+            await conn.close()
+        except Exception as e:
+            log.debug(f"Error closing SSH session: {e}")
+
+    def _start_reaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        '''Close sessions idle past the timeout, until none are left'''
+        while any(self.idle.values()):
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            for key, sessions in list(self.idle.items()):
+                expired = [x for x in sessions if now - x[1] > self.idle_timeout]
+                # In place, a checkout may be walking this list
+                sessions[:] = [x for x in sessions if now - x[1] <= self.idle_timeout]
+                for conn, _ in expired:
+                    log.debug(f"Closing idle SSH session to {key}")
+                    await self._close(conn)
+
+    async def close(self):
+        '''Close every idle session, sessions in use are closed when returned'''
+        self.closed = True
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        idle, self.idle = self.idle, {}
+        for sessions in idle.values():
+            for conn, _ in sessions:
+                await self._close(conn)
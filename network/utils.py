@@ -1,27 +1,84 @@
 import logging
+from io import StringIO
 from pathlib import Path
+from textfsm import TextFSM
 from textfsm.clitable import CliTable
-from typing import Optional, TextIO
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from .command import CommandExecutor
 
 logger = logging.getLogger(__name__)
 
-def get_template(platform: str, command: str) -> Optional[TextIO]:
-    current_dir = Path(__file__).parent
-    template_dir = str(current_dir / 'templates')
-    cli_table = CliTable('index', template_dir)
-    template_index = cli_table.index.GetRowMatch({'Platform': platform, 'Command': command})
-    if not template_index:
+def template_dirs() -> List[str]:
+    '''Our own templates first, then ntc_templates if it is installed'''
+    dirs = [str(Path(__file__).parent / 'templates')]
+    try:
+        import ntc_templates
+        dirs.append(str(Path(ntc_templates.__file__).parent / 'templates'))
+    except ImportError:
+        pass
+    return [x for x in dirs if (Path(x) / 'index').exists()]
+
+
+class TemplateCache(object):
+    '''
+    Compiled TextFSM state machines keyed by (platform, command), shared by
+    every command.  Index files are read once, each template is compiled on
+    first use, and parse() resets the machine rather than rebuilding it.
+    '''
+    def __init__(self):
+        self._tables: Optional[List[Tuple[str, CliTable]]] = None
+        self._fsms: Dict[Tuple[str, str], Optional[TextFSM]] = {}
+
+    def _index(self) -> List[Tuple[str, CliTable]]:
+        if self._tables is None:
+            self._tables = [(x, CliTable('index', x)) for x in template_dirs()]
+        return self._tables
+
+    def register(self, platform: str, command: str, template: str) -> TextFSM:
+        '''Compile an inline template'''
+        fsm = TextFSM(StringIO(template))
+        self._fsms[(platform, command)] = fsm
+        return fsm
+
+    def path(self, platform: str, command: str) -> Optional[str]:
+        '''File of the first template indexed for (platform, command)'''
+        for template_dir, cli_table in self._index():
+            row = cli_table.index.GetRowMatch({'Platform': platform, 'Command': command})
+            if row:
+                return f"{template_dir}/{cli_table.index.index[row]['Template'].split(':')[0]}"
         logger.warning(
             f'No match in ntc_templates index for platform `{platform}` and command `{command}`'
         )
         return None
-    template_name = cli_table.index.index[template_index]['Template']
-    return open(f'{template_dir}/{template_name}', encoding='utf-8')
 
+    def get(self, platform: str, command: str) -> Optional[TextFSM]:
+        key = (platform, command)
+        if key not in self._fsms:
+            path = self.path(platform, command)
+            self._fsms[key] = None
+            if path:
+                with open(path, encoding='utf-8') as template:
+                    self._fsms[key] = TextFSM(template)
+        return self._fsms[key]
+
+    def parse(self, platform: str, command: str, text: str) -> List[dict]:
+        '''Parse command output into dicts with lower case keys, like scrapli'''
+        fsm = self.get(platform, command)
+        if fsm is None:
+            raise Exception(f'No TextFSM template for `{command}` on `{platform}`')
+        # Synchronous, so no other parse can interleave between reset and parse
+        fsm.Reset()
+        return [{ k.lower(): v for k, v in row.items() } for row in fsm.ParseTextToDicts(text)]
+
+
+TEMPLATES = TemplateCache()
+
+
+def get_template(platform: str, command: str) -> Optional[TextIO]:
+    path = TEMPLATES.path(platform, command)
+    return open(path, encoding='utf-8') if path else None
 
-class CommandExecuter(object):
-    def __init__(self, conn):
-        self.conn = conn
 
-    async def run(self, command):
-        return await command.execute(self)
+# Kept under its old name, one executor resolves commands through the shared registry
+CommandExecuter = CommandExecutor
@@ -0,0 +1,168 @@
+'''Run a set of async steps as a dependency graph'''
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+log = logging.getLogger()
+
+
+class PipelineException(Exception):
+    '''Pipeline is not a valid graph'''
+
+
+class Step(object):
+    '''One unit of work in a Pipeline
+
+    fn is called with the named inputs as keyword arguments and returns a
+    dict holding each of its named outputs.  Steps listed in after must
+    finish first even though no value passes between them, e.g. a gate
+    that must succeed before anything is written.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Awaitable[Dict[str, Any]]],
+        inputs: Iterable[str] = (),
+        outputs: Iterable[str] = (),
+        after: Iterable[str] = ()
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+
+
+class Pipeline(object):
+    '''Starts every step as soon as its inputs exist, so a run takes as long
+    as its critical path rather than the sum of its steps.
+
+    On the first failure no further steps are started, steps already in
+    flight are allowed to finish (they may be writes), and the first error
+    is raised.  If the run itself is cancelled, steps in flight are
+    cancelled with it.
+
+    on_step, if given, is called after each step with its name, duration in
+    seconds, outcome ('ok' or 'error') and outputs.
+    '''
+
+    def __init__(
+        self,
+        steps: List[Step],
+        initial: Iterable[str] = (),
+        on_step: Optional[Callable[[str, float, str, Dict[str, Any]], None]] = None
+    ):
+        self.steps = {step.name: step for step in steps}
+        self.on_step = on_step
+        producers = {name: None for name in initial}
+        for step in steps:
+            for output in step.outputs:
+                if output in producers:
+                    raise PipelineException(f'{output} is produced more than once')
+                producers[output] = step.name
+
+        self.depends: Dict[str, set] = {}
+        for step in steps:
+            deps = set(step.after)
+            for name in step.inputs:
+                if name not in producers:
+                    raise PipelineException(f'{step.name} needs {name}, which nothing produces')
+                if producers[name] is not None:
+                    deps.add(producers[name])
+            unknown = deps - self.steps.keys()
+            if unknown:
+                raise PipelineException(f'{step.name} runs after unknown steps {unknown}')
+            self.depends[step.name] = deps
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        done, visiting = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise PipelineException(f'Cycle through {name}')
+            visiting.add(name)
+            for dep in self.depends[name]:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    async def run(
+        self,
+        values: Dict[str, Any],
+        completed: Optional[Dict[str, Dict[str, Any]]] = None,
+        save: Optional[Callable[[str, Dict[str, Any]], Awaitable]] = None
+    ) -> Dict[str, Any]:
+        '''Run every step, returning all values produced
+
+        Steps in completed (name -> outputs, from an earlier attempt) are not
+        run again, their outputs are used as is.  save is awaited with each
+        step's outputs as it succeeds.
+        '''
+        values = dict(values)
+        finished = set()
+        for name, outputs in (completed or {}).items():
+            step = self.steps.get(name)
+            if step is not None and all(x in outputs for x in step.outputs):
+                for output in step.outputs:
+                    values[output] = outputs[output]
+                finished.add(name)
+        if finished:
+            log.info(f"Resuming pipeline, already completed: {', '.join(sorted(finished))}")
+        running: Dict[asyncio.Task, str] = {}
+        error = None
+
+        async def call(step: Step):
+            start = time.monotonic()
+            try:
+                outputs = await step.fn(**{name: values[name] for name in step.inputs})
+            except BaseException:
+                if self.on_step is not None:
+                    self.on_step(step.name, time.monotonic() - start, 'error', {})
+                raise
+            if self.on_step is not None:
+                self.on_step(step.name, time.monotonic() - start, 'ok', outputs or {})
+            if save is not None:
+                await save(step.name, outputs or {})
+            return outputs
+
+        try:
+            while True:
+                if error is None:
+                    for name, step in self.steps.items():
+                        if name in finished or name in running.values():
+                            continue
+                        if self.depends[name] <= finished:
+                            running[asyncio.create_task(call(step), name=name)] = name
+
+                if not running:
+                    break
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    if task.exception() is not None:
+                        log.error(f"Step {name} failed: {task.exception()}")
+                        error = error or task.exception()
+                        continue
+                    outputs = task.result() or {}
+                    for output in self.steps[name].outputs:
+                        values[output] = outputs[output]
+                    finished.add(name)
+        finally:
+            # Only left over if we were cancelled, don't leave steps running unowned
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+        if error is not None:
+            raise error
+        return values
@@ -1,14 +1,86 @@
 import asyncio
 import logging
-import json
 import re
+import time
 from pydantic import BaseModel, Extra
 from aio_pika import Exchange, IncomingMessage
 from httpx import AsyncClient
 from busboy import BaseRpcServer, BaseRpcClient
 
+from .batcher import Batcher
+from .coalesce import Coalescer
+from .deadline import DEADLINE, LatencyWindow, hedged, remaining
+from .checkpoint import CheckpointStore, DEFAULT_CHECKPOINT_PATH, DEFAULT_CHECKPOINT_RETENTION, \
+    DEFAULT_ABANDONED_RETENTION
+from .envelope import Envelope, dumps, loads
+from .metrics import METRICS, RPC_SECONDS, TRACE_ID, new_trace_id, span
+from .pipeline import Pipeline, Step
+from .rpc_cache import RpcCache
+from .scheduler import FairScheduler, SchedulerFull
+from .slack_publisher import SlackPublisher, DEFAULT_INTERVAL, DEFAULT_MAX_PENDING
+
 log = logging.getLogger()
 
+STEP_SECONDS = METRICS.histogram(
+    'provisioner_step_seconds', 'Duration of each provisioning step', ['step', 'site', 'outcome']
+)
+PROVISION_SECONDS = METRICS.histogram(
+    'provisioner_provision_seconds', 'Duration of a whole provisioning run', ['site', 'outcome']
+)
+DUPLICATES = METRICS.counter(
+    'provisioner_duplicate_requests_total', 'Provisioning requests answered by another run', ['kind']
+)
+
+SCHEDULER_WAIT_SECONDS = METRICS.histogram(
+    'provisioner_scheduler_wait_seconds', 'Time a provisioning run waited for a slot', ['site']
+)
+SCHEDULER_REQUEUED = METRICS.counter(
+    'provisioner_scheduler_requeued_total', 'Provisioning requests handed back because their site was full', ['site']
+)
+
+HEDGES = METRICS.counter(
+    'provisioner_rpc_hedges_total', 'Hedged second attempts of idempotent reads', ['routing_key']
+)
+RPC_TIMEOUTS = METRICS.counter(
+    'provisioner_rpc_timeouts_total', 'RPC calls abandoned at their timeout', ['routing_key']
+)
+
+# Time budget for one provisioning run, and the most any one call may take of it
+DEFAULT_PROVISION_DEADLINE = 600.0
+DEFAULT_RPC_TIMEOUT = 30.0
+RPC_TIMEOUTS_BY_KEY = {
+    "rpc.network.get_wave_macs": 60.0,
+    "rpc.network.router.add_cvlan_to_interface_by_arp": 180.0,
+    "rpc.network.router.add_cvlans_to_interfaces_by_arp": 300.0,
+    "rpc.network.send_wave_sm_config": 180.0,
+}
+# Reads that are safe to send twice, the first reply wins
+HEDGED_KEYS = {
+    "rpc.dcim.get_reg_vlan",
+    "rpc.dcim.get_router_ip",
+    "rpc.dcim.get_router_ip_by_ap",
+    "rpc.dcim.get_mgmt_id_by_reg",
+    "rpc.dcim.get_provisioning_context",
+}
+DEFAULT_HEDGE_PERCENTILE = 95.0
+
+# Concurrent provisioning runs, overall and per site
+DEFAULT_MAX_IN_FLIGHT = 10
+DEFAULT_SITE_LIMIT = 2
+# Pause before handing back a message for a full site, so it isn't redelivered straight away
+DEFAULT_BUSY_BACKOFF = 1.0
+
+RPC_CACHE = METRICS.counter(
+    'provisioner_rpc_cache_total', 'RPC response cache lookups', ['routing_key', 'result']
+)
+
+# Bulk mode, off unless bulk_window is set
+DEFAULT_BULK_MAX_BATCH = 50
+
+# Repeated dhcp.lease.reg for the same lease
+DEFAULT_DEDUPE_SIZE = 10000
+DEFAULT_DEDUPE_TTL = 60.0
+
 # The provisioner acts as the locus of driver communication.
 # When interacting with other drivers the provision model consumes their RabbitMQ calls,
 # then publishes RabbitMQ calls to complete the requested operation
@@ -17,127 +89,388 @@ class ProvisionerModel(BaseModel):
     class Config:
         extra = 'allow'
 
+# An error reply from another driver, reported to Slack once per run
+class ProvisionerException(Exception):
+    def __init__(self, call_name, error):
+        super().__init__(f"Error Returned from {call_name} - {error}")
+        self.error = error
+
 class Provisioner(BaseRpcServer, BaseRpcClient):
     name = "provisioner"
     binding_keys = ["dhcp.lease.reg"]
     model = ProvisionerModel
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Progress updates are batched and sent in the background
+        self.slack = SlackPublisher(
+            self.publish,
+            self.config.slack_prov_chan,
+            interval=float(getattr(self.config, 'slack_batch_interval', None) or DEFAULT_INTERVAL),
+            max_pending=int(getattr(self.config, 'slack_max_pending', None) or DEFAULT_MAX_PENDING)
+        )
+        self.duplicates = Coalescer(
+            int(getattr(self.config, 'dedupe_cache_size', None) or DEFAULT_DEDUPE_SIZE),
+            float(getattr(self.config, 'dedupe_ttl', None) or DEFAULT_DEDUPE_TTL),
+            on_hit=self.on_duplicate
+        )
+        # Bulk mode: leases arriving within bulk_window seconds of each other
+        # share Netbox lookups per site and one router change set per router
+        self.bulk_window = float(getattr(self.config, 'bulk_window', None) or 0)
+        bulk_max_batch = int(getattr(self.config, 'bulk_max_batch', None) or DEFAULT_BULK_MAX_BATCH)
+        self.context_batcher = Batcher(self.fetch_contexts, self.bulk_window, bulk_max_batch)
+        self.router_batcher = Batcher(self.config_router_batch, self.bulk_window, bulk_max_batch)
+
+        # The global cap defaults to the consumer prefetch, and no site can
+        # take more than its share.  A site may queue as many runs as it may
+        # run, past that its messages are handed back to RabbitMQ rather than
+        # holding prefetch slots that other sites' messages could use.
+        # A bulk batch needs a whole site in flight at once.
+        site_limit = int(
+            getattr(self.config, 'provision_site_limit', None)
+            or (bulk_max_batch if self.bulk_window else DEFAULT_SITE_LIMIT)
+        )
+        self.scheduler = FairScheduler(
+            int(
+                getattr(self.config, 'provision_max_in_flight', None)
+                or getattr(self.config, 'prefetch_count', None)
+                or DEFAULT_MAX_IN_FLIGHT
+            ),
+            site_limit,
+            int(getattr(self.config, 'provision_site_max_waiting', None) or site_limit)
+        )
+        self.busy_backoff = float(getattr(self.config, 'provision_busy_backoff', None) or DEFAULT_BUSY_BACKOFF)
+        METRICS.gauge('provisioner_queue_depth', 'Provisioning runs waiting for a slot', lambda: self.scheduler.queue_depth)
+        METRICS.gauge('provisioner_in_flight', 'Provisioning runs holding a slot', lambda: self.scheduler.in_flight)
+        self.provision_deadline = float(
+            getattr(self.config, 'provision_deadline', None) or DEFAULT_PROVISION_DEADLINE
+        )
+        # Per routing key overrides, e.g. {"rpc.network.send_wave_sm_config": 300}
+        self.rpc_timeouts = { **RPC_TIMEOUTS_BY_KEY, **(getattr(self.config, 'rpc_timeouts', None) or {}) }
+        # Hedging is opt in, it doubles load on a slow Netbox
+        self.rpc_hedge = bool(getattr(self.config, 'rpc_hedge', False))
+        self.rpc_hedge_percentile = float(
+            getattr(self.config, 'rpc_hedge_percentile', None) or DEFAULT_HEDGE_PERCENTILE
+        )
+        self.rpc_latencies = LatencyWindow()
+        # Policy per routing key, rpc_cache overrides it, e.g.
+        # {"rpc.erp.can_provision": {"ttl": 600}} or {"rpc.erp.can_provision": None} to disable
+        self.rpc_caches = RpcCache(getattr(self.config, 'rpc_cache', None), on_hit=self.rpc_cache_hit)
+        # Completed steps survive a nack, so a redelivery resumes at the failed step
+        checkpoint_path = getattr(self.config, 'checkpoint_path', None)
+        if not checkpoint_path:
+            checkpoint_path = DEFAULT_CHECKPOINT_PATH
+            log.warning(f"checkpoint_path not set, provisioning checkpoints kept in {checkpoint_path}")
+        self.checkpoints = CheckpointStore(
+            checkpoint_path,
+            float(getattr(self.config, 'checkpoint_retention', None) or DEFAULT_CHECKPOINT_RETENTION),
+            float(getattr(self.config, 'checkpoint_abandoned_retention', None) or DEFAULT_ABANDONED_RETENTION)
+        )
+
     async def consume(self, message: IncomingMessage) -> None:
         log.debug("Entered Provisioner")
         if message.routing_key == "dhcp.lease.reg":
             log.info(f"Provision Processing Message: {message.body}")
-            body = json.loads(message.body)
-            await self.publish_provisioner_slackupdate(body, "Received provisioning request.")
-
-            # Provision Authorized Check. Throws an exception (to a .nack) if the provision request is rejected
-            await self.publish_provisioner_slackupdate(body, f"Checking for Scheduled Job on account {body["account_id"]}.")
-            can_prov = json.loads(bytes.decode(await self.rpc_call("rpc.erp.can_provision", message.body)))
-            await self.error_check("Can Provision", can_prov, body)
-
-            log.info(f"Customer can Provision")
-            await self.publish_provisioner_slackupdate(body, f"Account {body["account_id"]} is valid and has a scheduled job today")
-
-            # Get the access point name, as well as additional site info
+            await self.serve_metrics()
+            # Decoded once, steps and payload builders share the envelope
+            body = Envelope.decode(message.body)
+
+            # Renewals and retransmits of a lease join the run already going, or
+            # are acked if one just finished.  A failed run is not remembered.
+            await self.duplicates.run(self.dedupe_key(body), lambda: self.schedule(message, body))
+
+    def on_duplicate(self, key, kind):
+        DUPLICATES.inc(kind=kind)
+        log.info(f"Duplicate provisioning request for {key} ({kind}), not run again")
+
+    # Account, lease IP and whatever MACs the lease carries
+    def dedupe_key(self, body) -> tuple:
+        macs = set()
+        for field in ("mac", "mac_address", "mac_addresses"):
+            value = body.get(field)
+            if isinstance(value, str):
+                macs.add(value.lower())
+            elif isinstance(value, (list, tuple)):
+                macs.update(str(x).lower() for x in value)
+        return (str(body.get("account_id")), body.get("ip"), frozenset(macs))
+
+    # Fetches the lease's provisioning context, which names its site, then
+    # waits for a slot on that site before provisioning.  A lease whose site
+    # already has a full queue is nacked back to RabbitMQ.
+    async def schedule(self, message: IncomingMessage, body) -> None:
+        # The trace ID rides along in every payload built from the body, and
+        # rpc() adds it to the rest so Netbox and Network log child spans
+        body.trace_id = body.get("trace_id") or new_trace_id()
+        TRACE_ID.set(body.trace_id)
+        self.start_deadline(body)
+
+        context_res = await self.fetch_context(body)
+        # A failed lookup still provisions, sharing the "unknown" site's limit,
+        # and the context step reports the error
+        site = self.context_site(context_res.get("res"))
+        try:
+            waited = await self.scheduler.acquire(site)
+        except SchedulerFull:
+            SCHEDULER_REQUEUED.inc(site=site)
+            log.info(f"Site {site} is busy, handing back provisioning request for {body['ip']}")
+            await asyncio.sleep(self.busy_backoff)
+            raise Exception(f"Site {site} is busy, provisioning request for {body['ip']} requeued")
+        try:
+            SCHEDULER_WAIT_SECONDS.observe(waited, site=site)
+            if waited:
+                log.info(f"Provisioning {body['ip']} waited {waited:.3f}s for a slot on site {site}")
+            await self.provision(message, body, context_res)
+        finally:
+            self.scheduler.release(site)
+
+    # Every call gets what is left of this budget, and drivers drop work once it passes
+    def start_deadline(self, body):
+        body.deadline = time.time() + self.provision_deadline
+        DEADLINE.set(body.deadline)
+
+    # Site ID of a provisioning context, "unknown" without one
+    def context_site(self, context) -> str:
+        try:
+            return str(context["reg_vlan"]["prefix_list"][0]["site"]["id"])
+        except (KeyError, IndexError, TypeError):
+            return "unknown"
+
+    async def provision(self, message: IncomingMessage, body, context_res) -> None:
+        # Time spent waiting for a slot doesn't count against the run
+        self.start_deadline(body)
+        self.publish_provisioner_slackupdate(body, "Received provisioning request.")
+
+        # A redelivery keeps its message ID.  Without one there is nothing
+        # telling a redelivery from a new request with the same body, so the
+        # run isn't checkpointed.
+        message_id = message.message_id
+        run_key = None
+        completed = {}
+        if message_id:
+            run_key = self.checkpoints.run_key(body["account_id"], body["ip"], message_id)
             try:
-                reg_vlan_res = json.loads(await self.rpc_call("rpc.dcim.get_reg_vlan", message.body))
-                reg_vlan = reg_vlan_res['res']
-                reg_vlan_name = reg_vlan.get("prefix_list")[0].get("vlan").get("name")
+                completed = await self.checkpoints.start(body["account_id"], body["ip"], message_id)
             except Exception as e:
-                raise Exception(e)
-            await self.error_check("Get Service Mod", reg_vlan_res, body)
+                log.error(f"Failed to load provisioning checkpoint {run_key}: {e}")
+        if completed:
+            self.publish_provisioner_slackupdate(body, f"Resuming provisioning, already completed: {', '.join(completed)}.")
 
-            log.info(f"Access Point Data Acquired: {reg_vlan}")
-            await self.publish_provisioner_slackupdate(body, "AP data acquired.")
-
-            # Get the mgmt vlan ID using the reg vlan name
+        async def save(step, outputs):
+            if run_key is None:
+                return
+            try:
+                await self.checkpoints.save(run_key, step, outputs)
+            except Exception as e:
+                # Losing a checkpoint only costs a re-run of the step
+                log.error(f"Failed to checkpoint {step} for {run_key}: {e}")
+
+        # Each step starts as soon as its inputs exist.  Reads run alongside
+        # the can_provision check, anything that writes waits for it, and the
+        # Netbox and router writes also wait for the inventory check.
+        steps = []
+        pipeline = self.provision_pipeline(
+            on_step=lambda *step: steps.append(step)
+        )
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            await pipeline.run({ "body": body, "context_res": context_res }, completed=completed, save=save)
+            outcome = "ok"
+        except ProvisionerException as e:
+            # Several steps can fail at once, the run reports the first
+            self.publish_provisioner_slackupdate(body, f"PROVISIONER FAILED: {e.error}", flush=True)
+            raise
+        finally:
+            self.record_steps(body, steps, time.monotonic() - start, outcome)
+
+        if run_key is not None:
             try:
-                res = json.loads(await self.rpc_call("rpc.dcim.get_mgmt_id_by_reg", { 'name': reg_vlan_name }))
+                await self.checkpoints.finish(run_key)
             except Exception as e:
-                raise Exception(e)
-
-            await self.error_check("Get mgmt VLAN ID by reg name", res, body)
-            mgmt_id = res['res']
-
-            log.info(f"Got mgmt VLAN ID: {res}")
-            await self.publish_provisioner_slackupdate(body, "Got mgmt VLAN ID")
-
-            # Get the MAC Address list from the SM
-            await self.publish_provisioner_slackupdate(body, f"Acquiring MAC Addresses from {body['ip']}.")
-            mac_res = await self.rpc_call("rpc.network.get_wave_macs", body['ip'])
-            mac_addresses_result = json.loads(mac_res)
-            mac_addresses_data = mac_addresses_result.get("res")
-            await self.error_check("Get MACs", mac_addresses_result, body)
-
-            log.info(f"MAC Addresses Acquired: {mac_addresses_data}")
-            await self.publish_provisioner_slackupdate(body, f"Acquired MAC Addresses from {body['ip']}.")
-
-            # Validate that one of the MAC addresses is an inventory item (Throw to .nack otherwise)
-            # Assign if so
-            mac_message_dict = self.get_sonar_assigninventory_load(message, mac_addresses_data)
-            await self.publish_provisioner_slackupdate(body, "Validating and Assigning MAC Addresses.")
-            sonar_inventory_result = json.loads(await self.rpc_call("rpc.erp.assign_inventory", mac_message_dict))
-            sonar_inventory_data = sonar_inventory_result["res"]
-            await self.error_check("Assign Inventory", sonar_inventory_result, body)
-
-            log.info(f"MAC Address Assigned {sonar_inventory_data}")
-            await self.publish_provisioner_slackupdate(body, f"Assigned SM inventory item {sonar_inventory_data} to account.")
-
-            # Get Tenant
-            tenant_message_dict = self.get_tenant_config_load(message)
-            await self.publish_provisioner_slackupdate(body, "Verifying/Creating Tenant.")
-            verify_tenant_result = json.loads(await self.rpc_call("rpc.dcim.tenant_verification", tenant_message_dict))
+                log.error(f"Failed to mark {run_key} finished: {e}")
+
+        self.publish_provisioner_slackupdate(body, f"Provisioner process completed successfully for account {body['account_id']}", flush=True)
+
+    def provision_pipeline(self, on_step=None) -> Pipeline:
+        return Pipeline([
+            Step("can_provision", self.step_can_provision, inputs=["body"]),
+            Step("context", self.step_context, inputs=["body", "context_res"], outputs=["context"]),
+            Step("macs", self.step_macs, inputs=["body"], outputs=["macs"]),
+            Step("assign_inventory", self.step_assign_inventory,
+                 inputs=["body", "macs"], outputs=["inventory"], after=["can_provision"]),
+            Step("tenant", self.step_tenant,
+                 inputs=["body", "context"], outputs=["tenant"], after=["can_provision", "assign_inventory"]),
+            Step("vlan", self.step_vlan, inputs=["body", "context", "tenant"], outputs=["vlan"]),
+            Step("config_router", self.step_config_router, inputs=["body", "context", "vlan"]),
+            Step("config_sm", self.step_config_sm,
+                 inputs=["body", "context", "vlan"], after=["config_router", "assign_inventory"]),
+        ], initial=["body", "context_res"], on_step=on_step)
+
+    # Steps are recorded once the run is over, so those that ran before the
+    # context arrived are still labelled with the site
+    def record_steps(self, body, steps, duration, outcome):
+        site = "unknown"
+        for name, seconds, step_outcome, outputs in steps:
+            if "context" in outputs:
+                site = self.context_site(outputs["context"])
+        for name, seconds, step_outcome, outputs in steps:
+            STEP_SECONDS.observe(seconds, step=name, site=site, outcome=step_outcome)
+        PROVISION_SECONDS.observe(duration, site=site, outcome=outcome)
+        log.info(
+            f"trace={body.get('trace_id')} provision site={site} outcome={outcome} duration={duration:.3f}s "
+            + " ".join(f"{name}={seconds:.3f}s" for name, seconds, _, _ in steps)
+        )
+
+    # Shutdown: send the Slack lines still batched (failures and completions
+    # included), close the checkpoint store, then the RPC connections
+    async def close(self):
+        await self.slack.close()
+        await self.checkpoints.close()
+        parent = getattr(super(), 'close', None)
+        if parent is not None:
+            await parent()
+
+    async def serve_metrics(self):
+        port = getattr(self.config, 'metrics_port', None)
+        if port:
+            await METRICS.serve(int(port))
+
+    # Provision Authorized Check. Throws an exception (to a .nack) if the provision request is rejected
+    async def step_can_provision(self, body) -> dict:
+        self.publish_provisioner_slackupdate(body, f"Checking for Scheduled Job on account {body['account_id']}.")
+        can_prov = await self.rpc("rpc.erp.can_provision", body.to_dict())
+        self.error_check("Can Provision", can_prov, body)
+
+        log.info(f"Customer can Provision")
+        self.publish_provisioner_slackupdate(body, f"Account {body['account_id']} is valid and has a scheduled job today")
+        return {}
+
+    # Get the reg VLAN/site, mgmt VLAN, tenant and router/AP IPs in one Netbox round trip
+    async def fetch_context(self, body) -> dict:
+        lease = {
+            "ip": body["ip"],
+            "account_id": body["account_id"]
+        }
+        if self.bulk_window:
+            # One batch for every lease in the window, Netbox groups them by site
+            return await self.context_batcher.submit("leases", lease)
+        return await self.rpc("rpc.dcim.get_provisioning_context", lease)
+
+    # The context is fetched before scheduling, as it names the site
+    async def step_context(self, body, context_res) -> dict:
+        self.error_check("Get Provisioning Context", context_res, body)
+        context = context_res['res']
+
+        log.info(f"Provisioning Context Acquired: {context}")
+        self.publish_provisioner_slackupdate(body, "AP data and mgmt VLAN ID acquired.")
+        self.publish_provisioner_slackupdate(body, f"Router IP Acquired: {context['router_ip']}")
+        return { "context": context }
+
+    # Get the MAC Address list from the SM
+    async def step_macs(self, body) -> dict:
+        self.publish_provisioner_slackupdate(body, f"Acquiring MAC Addresses from {body['ip']}.")
+        mac_addresses_result = await self.rpc("rpc.network.get_wave_macs", body['ip'])
+        mac_addresses_data = mac_addresses_result.get("res")
+        self.error_check("Get MACs", mac_addresses_result, body)
+
+        log.info(f"MAC Addresses Acquired: {mac_addresses_data}")
+        self.publish_provisioner_slackupdate(body, f"Acquired MAC Addresses from {body['ip']}.")
+        return { "macs": mac_addresses_data }
+
+    # Validate that one of the MAC addresses is an inventory item (Throw to .nack otherwise)
+    # Assign if so
+    async def step_assign_inventory(self, body, macs) -> dict:
+        mac_message_dict = self.get_sonar_assigninventory_load(body, macs)
+        self.publish_provisioner_slackupdate(body, "Validating and Assigning MAC Addresses.")
+        sonar_inventory_result = await self.rpc("rpc.erp.assign_inventory", mac_message_dict)
+        sonar_inventory_data = sonar_inventory_result["res"]
+        self.error_check("Assign Inventory", sonar_inventory_result, body)
+
+        log.info(f"MAC Address Assigned {sonar_inventory_data}")
+        self.publish_provisioner_slackupdate(body, f"Assigned SM inventory item {sonar_inventory_data} to account.")
+        return { "inventory": sonar_inventory_data }
+
+    # Get Tenant, only creating it when the context didn't already find one
+    async def step_tenant(self, body, context) -> dict:
+        verify_tenant_id = context["tenant"]
+        if verify_tenant_id is None:
+            tenant_message_dict = self.get_tenant_config_load(body)
+            self.publish_provisioner_slackupdate(body, "Verifying/Creating Tenant.")
+            verify_tenant_result = await self.rpc("rpc.dcim.tenant_verification", tenant_message_dict)
             verify_tenant_id = verify_tenant_result["res"]
-            await self.error_check("Tenant Verification", verify_tenant_result, body)
-
-            log.info(f"Verify Tenant Successful: {verify_tenant_id}")
-            await self.publish_provisioner_slackupdate(body, f"Netbox tenant verified: {verify_tenant_id.get("tenant_list")[0].get("id")}")
-
-            # Get VLAN
-            vlan_message_dict = self.get_vlan_config_load(message, verify_tenant_id, reg_vlan)
-            await self.publish_provisioner_slackupdate(body, "Assigning tenant VLAN")
-            get_vlan_result = json.loads(await self.rpc_call("rpc.dcim.assign_tenant_vlan", vlan_message_dict))
-            get_vlan_data = get_vlan_result["res"]
-            await self.error_check("VLAN Verification", get_vlan_result, body)
-
-            log.info(f"Verify VLAN Successful: {get_vlan_data}")
-            await self.publish_provisioner_slackupdate(body, f"Assigned VLAN {get_vlan_data["id"]} to account {body["account_id"]}.")
-
-            #Get Router
-            router_ip_dict = self.get_router_ip_load(message, get_vlan_data["id"], reg_vlan)
-            await self.publish_provisioner_slackupdate(body, "Acquiring router IP address")
-            get_router_ip_result = json.loads(bytes.decode(await self.rpc_call("rpc.dcim.get_router_ip", router_ip_dict)))
-            get_router_ip_data = get_router_ip_result["res"]
-            await self.error_check("Get Router IP", get_router_ip_result, body)
-
-            log.info(f"Get Router IP Successful: {get_router_ip_data}")
-            await self.publish_provisioner_slackupdate(body, f"Router IP Acquired: {get_router_ip_data["router_ip"]}")
-
-            # Configure Router and Switches
-            config_router_dict = self.get_config_router_load(message, get_router_ip_data["router_ip"], get_router_ip_data["access_point_ip"], get_vlan_data["vid"])
-            log.info(f"Entering Router Config: {config_router_dict}")
-            await self.publish_provisioner_slackupdate(body, f"Adding cVLAN ({get_vlan_data["vid"]}) to Interface and Configuring Router/Switches")
-            config_router_result = json.loads(await self.rpc_call("rpc.network.router.add_cvlan_to_interface_by_arp", config_router_dict))
-            await self.error_check("Config Interfaces", config_router_result, body)
-
-            log.info(f"Config Router Successful: {config_router_result['res']}")
-            await self.publish_provisioner_slackupdate(body, "cVLAN Assigned. Router and Switches Configured.")
-
-            wave_config = {
-                "ip_address": body['ip'],
-                "cust_id": body['account_id'],
-                "cust_vlan": get_vlan_data['vid'],
-                "mgmt_vlan": mgmt_id,
-                # Regex cuts off the suffix of the ap name
-                "ap_name": re.sub("-reg$|-mgmt$", "", reg_vlan['prefix_list'][0]['vlan']['name']) 
-            }
-            log.info(f"Entering Service Module Config: {wave_config}")
-            await self.publish_provisioner_slackupdate(body, f"Sending Config File to Service Module")
-            config_sm_result = json.loads(await self.rpc_call("rpc.network.send_wave_sm_config", wave_config))
-            await self.error_check("Account ID", config_sm_result, body)
-
-            log.info(f"Config Service Module Successful: {config_sm_result['res']}")
-            await self.publish_provisioner_slackupdate(body, "Service Module Successfully Configured.")
-            await self.publish_provisioner_slackupdate(body, f"Provisioner process completed successfully for account {body["account_id"]}")
+            self.error_check("Tenant Verification", verify_tenant_result, body)
+
+        log.info(f"Verify Tenant Successful: {verify_tenant_id}")
+        self.publish_provisioner_slackupdate(body, f"Netbox tenant verified: {verify_tenant_id.get('tenant_list')[0].get('id')}")
+        return { "tenant": verify_tenant_id }
+
+    # Get VLAN
+    async def step_vlan(self, body, context, tenant) -> dict:
+        vlan_message_dict = self.get_vlan_config_load(body, tenant, context["reg_vlan"])
+        self.publish_provisioner_slackupdate(body, "Assigning tenant VLAN")
+        get_vlan_result = await self.rpc("rpc.dcim.assign_tenant_vlan", vlan_message_dict)
+        get_vlan_data = get_vlan_result["res"]
+        self.error_check("VLAN Verification", get_vlan_result, body)
+
+        log.info(f"Verify VLAN Successful: {get_vlan_data}")
+        self.publish_provisioner_slackupdate(body, f"Assigned VLAN {get_vlan_data['id']} to account {body['account_id']}.")
+        return { "vlan": get_vlan_data }
+
+    # Configure Router and Switches
+    async def step_config_router(self, body, context, vlan) -> dict:
+        config_router_dict = self.get_config_router_load(body, context["router_ip"], context["access_point_ip"], vlan["vid"])
+        log.info(f"Entering Router Config: {config_router_dict}")
+        self.publish_provisioner_slackupdate(body, f"Adding cVLAN ({vlan['vid']}) to Interface and Configuring Router/Switches")
+        if self.bulk_window:
+            config_router_result = await self.router_batcher.submit(context["router_ip"], {
+                "ip": context["access_point_ip"],
+                "customer_vlan": int(vlan["vid"])
+            })
+        else:
+            config_router_result = await self.rpc("rpc.network.router.add_cvlan_to_interface_by_arp", config_router_dict)
+        self.error_check("Config Interfaces", config_router_result, body)
+
+        log.info(f"Config Router Successful: {config_router_result['res']}")
+        self.publish_provisioner_slackupdate(body, "cVLAN Assigned. Router and Switches Configured.")
+        return {}
+
+    async def step_config_sm(self, body, context, vlan) -> dict:
+        wave_config = {
+            "ip_address": body['ip'],
+            "cust_id": body['account_id'],
+            "cust_vlan": vlan['vid'],
+            "mgmt_vlan": context["mgmt_vid"],
+            # Regex cuts off the suffix of the ap name
+            "ap_name": re.sub("-reg$|-mgmt$", "", context["reg_vlan"]['prefix_list'][0]['vlan']['name'])
+        }
+        log.info(f"Entering Service Module Config: {wave_config}")
+        self.publish_provisioner_slackupdate(body, f"Sending Config File to Service Module")
+        config_sm_result = await self.rpc("rpc.network.send_wave_sm_config", wave_config)
+        self.error_check("Account ID", config_sm_result, body)
+
+        log.info(f"Config Service Module Successful: {config_sm_result['res']}")
+        self.publish_provisioner_slackupdate(body, "Service Module Successfully Configured.")
+        return {}
+
+    # Bulk mode: contexts for every lease in the window
+    async def fetch_contexts(self, key, leases) -> list:
+        log.info(f"Fetching provisioning contexts for {len(leases)} leases")
+        result = await self.rpc("rpc.dcim.get_provisioning_contexts", { "leases": leases })
+        if result["error"] is not None:
+            return [result] * len(leases)
+        return result["res"]
+
+    # Bulk mode: one combined cVLAN change set per router
+    async def config_router_batch(self, router_ip, changes) -> list:
+        log.info(f"Sending {len(changes)} cVLAN changes to router {router_ip}")
+        result = await self.rpc("rpc.network.router.add_cvlans_to_interfaces_by_arp", {
+            "routing_key": "rpc.network.router.add_cvlans_to_interfaces_by_arp",
+            "router_ip": router_ip,
+            "changes": changes
+        })
+        if result["error"] is not None:
+            return [result] * len(changes)
+        return result["res"]
 
     def get_manufacturer_name(self, ap_info) -> str:
         if re.match("^ap-biq", ap_info.get("prefix_list")[0].get("vlan").get("name")):
@@ -155,8 +488,8 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
         raise Exception(f"Could Not Determine Manufacturer for {ap_info.get("prefix_list")[0].get("vlan").get("name")}")
 
     #loads the message parameters for an Ubiquity v8 Wave MAC Address' Request Send
-    def get_sonar_assigninventory_load(self, original_message, mac_addresses) -> dict:
-        mac_message_dict = json.loads(original_message.body)
+    def get_sonar_assigninventory_load(self, body, mac_addresses) -> dict:
+        mac_message_dict = body.to_dict()
         mac_message_dict["routing_key"] = "rpc.erp.assign_inventory"
         mac_message_dict["mac_addresses"] = mac_addresses
 
@@ -165,15 +498,15 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
         return mac_message_dict
 
     #loads the message parameters for an Ubiquity v8 Wave Config Send
-    def get_ubiquity_wave_config_load(self, message, ap_info) -> dict:
-        sm_message_dict = json.loads(message.body)
+    def get_ubiquity_wave_config_load(self, body, ap_info) -> dict:
+        sm_message_dict = body.to_dict()
         sm_message_dict["routing_key"] = "rpc.erp.config"
 
         sm_message_dict["customer_vlan"] = ap_info.get("prefix_list")[0].get("vlan").get("id")
         sm_message_dict["mgmt_vlan"] = re.sub("^.+?(?=/).", "", ap_info.get("prefix_list")[0].get("prefix")) #gets just the VLAN
         sm_message_dict["ap_name"] = re.sub("-reg$|-mgmt$", "", ap_info.get("prefix_list")[0].get("vlan").get("name")) #regex cuts off the suffix of the ap name
         sm_message_dict["snmp_location"] = re.sub("^.+?(?=\.).", "", sm_message_dict["ap_name"]) #Cutoff the tag before the .
-        sm_message_dict["ip_address"] = json.loads(message.body).get("ip")
+        sm_message_dict["ip_address"] = body.get("ip")
         sm_message_dict["ssh_user"] = self.config.ssh_user
         sm_message_dict["ssh_pass"] = self.config.ssh_pass
         sm_message_dict["ssh_wave_pass"] = self.config.ssh_wave_pass
@@ -189,20 +522,18 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
 
         return sm_message_dict
 
-    def get_tenant_config_load(self, message) -> dict:
-        nb_message_dict = json.loads(message.body)
+    def get_tenant_config_load(self, body) -> dict:
+        nb_message_dict = body.to_dict()
         nb_message_dict["routing_key"] = "rpc.dcim.tenant_verification"
 
-        nb_message_dict["account_id"] = json.loads(message.body).get("account_id")
-        nb_message_dict["nb_url"] = re.sub("graphql\/", "", self.config.netbox_api_url) # cuts off the graphql extension
-        nb_message_dict["nb_token"] = self.config.netbox_api_key
+        nb_message_dict["account_id"] = body.get("account_id")
 
         log.info(f"Verify Tenant Configured: {nb_message_dict}")
 
         return nb_message_dict
 
-    def get_vlan_config_load(self, message, verify_tenant_data, reg_vlan) -> dict:
-        nb_message_dict = json.loads(message.body)
+    def get_vlan_config_load(self, body, verify_tenant_data, reg_vlan) -> dict:
+        nb_message_dict = body.to_dict()
         nb_message_dict["routing_key"] = "rpc.dcim.assign_tenant_vlan"
         nb_message_dict["tenant_id"] = verify_tenant_data.get("tenant_list")[0].get("id")
         nb_message_dict["site_id"] = reg_vlan.get("prefix_list")[0].get("site").get("id")
@@ -211,8 +542,8 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
 
         return nb_message_dict
 
-    def get_router_ip_load(self, message, vlan_id, ap_info) -> dict:
-        nb_message_dict = json.loads(message.body)
+    def get_router_ip_load(self, body, vlan_id, ap_info) -> dict:
+        nb_message_dict = body.to_dict()
         nb_message_dict["routing_key"] = "rpc.dcim.get_router_ip"
         nb_message_dict["vlan_id"] = vlan_id
         nb_message_dict["ap_name"] = re.sub("-reg$|-mgmt$", "", ap_info.get("prefix_list")[0].get("vlan").get("name")) #regex cuts off the suffix of the ap name
@@ -221,8 +552,8 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
 
         return nb_message_dict
 
-    def get_config_router_load(self, message, router_ip, ap_ip, vlan_vid) -> dict:
-        nb_message_dict = json.loads(message.body)
+    def get_config_router_load(self, body, router_ip, ap_ip, vlan_vid) -> dict:
+        nb_message_dict = body.to_dict()
         nb_message_dict["routing_key"] = "rpc.erp.config_interface"
         nb_message_dict["router_ip"] = router_ip
         nb_message_dict["ip"] = ap_ip
@@ -235,15 +566,74 @@ class Provisioner(BaseRpcServer, BaseRpcClient):
     def get_routing_key(self, body: dict) -> str:
         return body.get("routing_key")
 
-    # Checks if RPC call replies w/ an error. If so, it posts error to Slack and raises exception to stop execution.
-    async def error_check(self, call_name, result_dictionary, body):
+    # Answers cacheable reads from the response cache (see rpc_cache.py),
+    # concurrent identical calls share one request.  Everything else goes
+    # straight to send_rpc.
+    async def rpc(self, routing_key: str, payload) -> dict:
+        async def call():
+            if self.rpc_caches.cached(routing_key, payload):
+                RPC_CACHE.inc(routing_key=routing_key, result="miss")
+            return await self.send_rpc(routing_key, payload)
+
+        return await self.rpc_caches.run(routing_key, payload, call)
+
+    def rpc_cache_hit(self, routing_key, kind):
+        RPC_CACHE.inc(routing_key=routing_key, result=kind)
+
+    # Sends an RPC with the shared codec and decodes the reply once, timed per
+    # routing key.  Bare strings (e.g. an IP) are sent as is, like before.
+    # A call that outlives its timeout (the routing key's, or what is left of
+    # the provision deadline) is abandoned and answered with an error reply.
+    async def send_rpc(self, routing_key: str, payload) -> dict:
+        trace_id = TRACE_ID.get()
+        deadline = DEADLINE.get()
+        if isinstance(payload, dict):
+            if trace_id and "trace_id" not in payload:
+                payload = { **payload, "trace_id": trace_id }
+            if deadline and "deadline" not in payload:
+                payload = { **payload, "deadline": deadline }
+        if not isinstance(payload, (str, bytes)):
+            payload = dumps(payload)
+
+        timeout = float(self.rpc_timeouts.get(routing_key, DEFAULT_RPC_TIMEOUT))
+        left = remaining(deadline)
+        if left is not None:
+            timeout = min(timeout, left)
+
+        async with span(self.name, routing_key, trace_id, RPC_SECONDS) as current:
+            start = time.monotonic()
+            try:
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                result = loads(await self.call_with_hedge(routing_key, payload, timeout))
+            except asyncio.TimeoutError:
+                RPC_TIMEOUTS.inc(routing_key=routing_key)
+                result = { "error": f"{routing_key} timed out after {max(timeout, 0):.1f}s", "res": None }
+            else:
+                self.rpc_latencies.add(routing_key, time.monotonic() - start)
+            if isinstance(result, dict) and result.get("error") is not None:
+                current.outcome = "error"
+        return result
+
+    # Idempotent reads slower than the usual (a latency percentile) get a
+    # second attempt, whichever replies first is used.
+    async def call_with_hedge(self, routing_key: str, payload, timeout: float):
+        delay = None
+        if self.rpc_hedge and routing_key in HEDGED_KEYS:
+            delay = self.rpc_latencies.percentile(routing_key, self.rpc_hedge_percentile)
+
+        def on_hedge():
+            HEDGES.inc(routing_key=routing_key)
+            log.info(f"{routing_key} slower than {delay:.3f}s, sending a hedged retry")
+
+        return await hedged(lambda: self.rpc_call(routing_key, payload), delay, timeout, on_hedge)
+
+    # Checks if RPC call replies w/ an error. If so, it raises exception to stop execution,
+    # provision() posts the error to Slack.
+    def error_check(self, call_name, result_dictionary, body):
         if result_dictionary["error"] is not None:
-            await self.publish_provisioner_slackupdate(body=body, printout=("PROVISIONER FAILED: " + result_dictionary["error"]))
-            raise Exception(f"Error Returned from {call_name} - {result_dictionary["error"]}")
+            raise ProvisionerException(call_name, result_dictionary["error"])
 
-    async def publish_provisioner_slackupdate(self, body, printout):
-        msg = {
-            "channel": self.config.slack_prov_chan,
-            "text": f"*Acc: {body['account_id']}* - {printout}"
-        }
-        await self.publish("chat.message.post", msg)
+    # Queues a progress line, never waits on Slack. flush sends the account's batch right away.
+    def publish_provisioner_slackupdate(self, body, printout, flush=False):
+        self.slack.post(body['account_id'], printout, flush=flush)
@@ -0,0 +1,90 @@
+'''Reply cache for idempotent RPCs, with a TTL policy per routing key'''
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from .coalesce import Coalescer
+from .envelope import dumps
+
+log = logging.getLogger()
+
+# Replies cached per routing key.  fields picks what the reply depends on,
+# without it the whole payload (less UNCACHED_FIELDS) is the key.  end_of_day
+# also expires entries at local midnight.  Other read-only keys can be added
+# through the rpc_cache config.
+RPC_CACHE_POLICY = {
+    # A scheduled job is valid for the account for the day
+    "rpc.erp.can_provision": { "ttl": 3600.0, "size": 10000, "fields": ["account_id"], "end_of_day": True },
+}
+# Writes, or calls whose reply must be fresh, never cached even if configured
+NEVER_CACHED = {
+    "rpc.erp.assign_inventory",
+    "rpc.dcim.tenant_verification",
+    "rpc.dcim.assign_tenant_vlan",
+    "rpc.dcim.vlan_verification",
+    "rpc.network.get_wave_macs",
+    "rpc.network.router.add_cvlan_to_interface_by_arp",
+    "rpc.network.router.add_cvlans_to_interfaces_by_arp",
+    "rpc.network.send_wave_sm_config",
+}
+UNCACHED_FIELDS = { "trace_id", "deadline" }
+
+
+def seconds_until_midnight() -> float:
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+class RpcCache(object):
+    '''A Coalescer per cacheable routing key
+
+    overrides is the rpc_cache config on top of RPC_CACHE_POLICY, e.g.
+    {"rpc.erp.can_provision": {"ttl": 600}}, or None for a key to disable
+    it.  on_hit is called with the routing key and the Coalescer's hit kind.
+    Error replies are shared with concurrent callers but not remembered.
+    '''
+
+    def __init__(
+        self,
+        overrides: Optional[Dict[str, Optional[dict]]] = None,
+        on_hit: Optional[Callable[[str, str], None]] = None
+    ):
+        policy = { key: dict(value) for key, value in RPC_CACHE_POLICY.items() }
+        for key, value in (overrides or {}).items():
+            if value is None:
+                policy.pop(key, None)
+            else:
+                policy[key] = { **policy.get(key, {}), **value }
+
+        self.caches: Dict[str, Coalescer] = {}
+        self.fields: Dict[str, Optional[List[str]]] = {}
+        for key, value in policy.items():
+            if key in NEVER_CACHED:
+                log.warning(f"Not caching {key}, it is not idempotent")
+                continue
+            ttl = float(value.get("ttl", 60.0))
+            self.caches[key] = Coalescer(
+                int(value.get("size", 1000)),
+                ttl,
+                on_hit=(lambda _, kind, key=key: on_hit(key, kind)) if on_hit is not None else None,
+                keep=lambda result: isinstance(result, dict) and result.get("error") is None,
+                ttl_for=(lambda ttl=ttl: min(ttl, seconds_until_midnight())) if value.get("end_of_day") else None
+            )
+            self.fields[key] = value.get("fields")
+
+    def key(self, routing_key: str, payload: dict) -> Hashable:
+        '''What a reply depends on: the policy's fields, else the whole payload'''
+        fields = self.fields.get(routing_key)
+        if fields:
+            return tuple(str(payload.get(x)) for x in fields)
+        return dumps({ k: v for k, v in sorted(payload.items()) if k not in UNCACHED_FIELDS })
+
+    def cached(self, routing_key: str, payload) -> bool:
+        '''Whether replies to this call go through the cache'''
+        return routing_key in self.caches and isinstance(payload, dict)
+
+    async def run(self, routing_key: str, payload, fn: Callable[[], Awaitable[Any]]) -> Any:
+        '''fn's reply, from the cache when the call is cached'''
+        if not self.cached(routing_key, payload):
+            return await fn()
+        return await self.caches[routing_key].run(self.key(routing_key, payload), fn)
@@ -0,0 +1,107 @@
+'''Bounded concurrency with per-key limits and round-robin fairness'''
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, Optional
+
+
+class SchedulerFull(Exception):
+    '''A key already has as many waiters as it may queue'''
+
+
+class FairScheduler(object):
+    '''At most max_in_flight holders overall and per_key_limit per key
+
+    Waiters queue per key, and freed slots go to keys in turn, so a key
+    with a long queue (e.g. one busy site) can't starve the others.  With
+    max_waiting set, a key with that many waiters already turns further
+    callers away with SchedulerFull rather than queueing them.
+    '''
+
+    def __init__(self, max_in_flight: int = 10, per_key_limit: int = 2, max_waiting: Optional[int] = None):
+        self.max_in_flight = max_in_flight
+        self.per_key_limit = per_key_limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.running: Dict[Hashable, int] = {}
+        self.queues: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self.order: Deque[Hashable] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(x) for x in self.queues.values())
+
+    def _can_start(self, key: Hashable) -> bool:
+        return self.in_flight < self.max_in_flight and self.running.get(key, 0) < self.per_key_limit
+
+    def _take(self, key: Hashable):
+        self.in_flight += 1
+        self.running[key] = self.running.get(key, 0) + 1
+
+    def _release(self, key: Hashable):
+        self.in_flight -= 1
+        self.running[key] -= 1
+        if not self.running[key]:
+            del self.running[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        '''Hand free slots to waiting keys in round-robin order'''
+        while self.order and self.in_flight < self.max_in_flight:
+            for _ in range(len(self.order)):
+                key = self.order[0]
+                self.order.rotate(-1)
+                if self._can_start(key):
+                    break
+            else:
+                return
+            queue = self.queues[key]
+            future = queue.popleft()
+            if not queue:
+                del self.queues[key]
+                self.order.remove(key)
+            self._take(key)
+            future.set_result(None)
+
+    async def acquire(self, key: Hashable) -> float:
+        '''Wait for a slot for key, returning seconds spent waiting.
+        Raises SchedulerFull if key's queue is full.'''
+        if key not in self.queues and self._can_start(key):
+            self._take(key)
+            return 0.0
+
+        if self.max_waiting is not None and len(self.queues.get(key, ())) >= self.max_waiting:
+            raise SchedulerFull(f'{key} already has {self.max_waiting} waiting')
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        if key not in self.queues:
+            self.queues[key] = deque()
+            self.order.append(key)
+        self.queues[key].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled, pass the slot on
+                self._release(key)
+            elif key in self.queues:
+                self.queues[key].remove(future)
+                if not self.queues[key]:
+                    del self.queues[key]
+                    self.order.remove(key)
+            raise
+        return time.monotonic() - start
+
+    def release(self, key: Hashable):
+        self._release(key)
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable):
+        '''Hold a slot for key, yields seconds spent waiting for it'''
+        waited = await self.acquire(key)
+        try:
+            yield waited
+        finally:
+            self.release(key)
@@ -0,0 +1,105 @@
+'''Background publisher that batches provisioning progress lines per account'''
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List
+
+log = logging.getLogger()
+
+DEFAULT_INTERVAL = 5.0     # seconds between batches for one account
+DEFAULT_MAX_PENDING = 500  # progress lines held across all accounts
+
+
+class SlackPublisher(object):
+    '''Coalesces progress lines into one chat.message.post per account per
+    interval, sent from a background task so callers never wait on it.
+
+    Lines posted with flush=True (failures, completion) are never dropped
+    and send the account's batch right away.  Other lines are dropped once
+    max_pending lines are waiting, and the batch says how many were lost.
+    '''
+
+    def __init__(
+        self,
+        publish: Callable[[str, dict], Awaitable],
+        channel: str,
+        interval: float = DEFAULT_INTERVAL,
+        max_pending: int = DEFAULT_MAX_PENDING
+    ):
+        self.publish = publish
+        self.channel = channel
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self.pending: Dict[str, List[str]] = {}
+        self.first_pending: Dict[str, float] = {}
+        self.dropped: Dict[str, int] = {}
+        self.urgent = set()
+        self.count = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closing = False
+
+    def post(self, account_id, text: str, flush: bool = False):
+        '''Queue a line for an account without waiting'''
+        account_id = str(account_id)
+        if not flush and self.count >= self.max_pending:
+            self.dropped[account_id] = self.dropped.get(account_id, 0) + 1
+            return
+
+        self.pending.setdefault(account_id, []).append(text)
+        self.first_pending.setdefault(account_id, time.monotonic())
+        self.count += 1
+        if flush:
+            self.urgent.add(account_id)
+            self.wakeup.set()
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.pending or self.dropped:
+            if not self.closing:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            await self.send_due(everything=self.closing)
+
+    async def send_due(self, everything: bool = False):
+        now = time.monotonic()
+        for account_id in list(self.pending.keys() | self.dropped.keys()):
+            waited = now - self.first_pending.get(account_id, now)
+            if everything or account_id in self.urgent or waited >= self.interval \
+                    or account_id not in self.pending:
+                await self.send(account_id)
+
+    async def send(self, account_id: str):
+        lines = self.pending.pop(account_id, [])
+        self.first_pending.pop(account_id, None)
+        self.urgent.discard(account_id)
+        self.count -= len(lines)
+        dropped = self.dropped.pop(account_id, 0)
+        if dropped:
+            lines.append(f"({dropped} progress updates dropped)")
+
+        msg = {
+            "channel": self.channel,
+            "text": f"*Acc: {account_id}* - " + "\n".join(lines)
+        }
+        try:
+            await self.publish("chat.message.post", msg)
+        except Exception as e:
+            # Chat is best effort, never fail a provision over it
+            log.error(f"Failed to post Slack update for {account_id}: {e}")
+
+    async def close(self):
+        '''Send everything still pending, for shutdown'''
+        self.closing = True
+        self.wakeup.set()
+        if self.task is not None:
+            # Not cancelled, a send in progress has already taken its lines
+            await self.task
+            self.task = None
+        await self.send_due(everything=True)
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from drivers.batcher import Batcher
+
+
+def test_items_within_window_go_in_one_call_per_key():
+    calls = []
+
+    async def fn(key, items):
+        calls.append((key, items))
+        return [f'{key}:{x}' for x in items]
+
+    async def main():
+        batcher = Batcher(fn, window=0.01)
+        return await asyncio.gather(
+            batcher.submit('a', 1), batcher.submit('b', 2), batcher.submit('a', 3)
+        )
+
+    assert asyncio.run(main()) == ['a:1', 'b:2', 'a:3']
+    assert sorted(calls) == [('a', [1, 3]), ('b', [2])]
+
+
+def test_full_group_is_sent_without_waiting():
+    calls = []
+
+    async def fn(key, items):
+        calls.append(items)
+        return items
+
+    async def main():
+        batcher = Batcher(fn, window=60, max_size=2)
+        return await asyncio.wait_for(asyncio.gather(batcher.submit('a', 1), batcher.submit('a', 2)), 1)
+
+    assert asyncio.run(main()) == [1, 2]
+    assert calls == [[1, 2]]
+
+
+def test_failure_reaches_every_item():
+    async def fn(key, items):
+        raise RuntimeError('down')
+
+    async def main():
+        batcher = Batcher(fn, window=0.01)
+        return await asyncio.gather(batcher.submit('a', 1), batcher.submit('a', 2), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(x, RuntimeError) for x in results)
+
+
+def test_wrong_result_count_is_an_error():
+    async def fn(key, items):
+        return []
+
+    async def main():
+        return await Batcher(fn, window=0.01).submit('a', 1)
+
+    with pytest.raises(Exception, match='returned 0 results for 1 items'):
+        asyncio.run(main())
@@ -0,0 +1,39 @@
+from drivers import cache as cache_module
+from drivers.cache import MISSING, TTLCache
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+    cache = TTLCache(ttl=60)
+    cache.set('tenant', 5)
+    # A cached miss, with its own shorter TTL
+    cache.set('missing', None, ttl=10)
+
+    now[0] += 30
+    assert cache.get('tenant') == 5
+    assert cache.get('missing') is MISSING
+    assert cache.get('missing', 'default') == 'default'
+
+    now[0] += 31
+    assert 'tenant' not in cache
+
+
+def test_cached_none_is_told_apart_from_a_miss():
+    cache = TTLCache()
+    cache.set('missing', None)
+
+    assert cache.get('missing') is None
+    assert cache.get('other') is MISSING
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
@@ -0,0 +1,81 @@
+import asyncio
+
+from drivers import checkpoint as checkpoint_module
+from drivers.checkpoint import CheckpointStore
+
+
+def store(tmp_path, **kwargs):
+    return CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'), **kwargs)
+
+
+def test_unfinished_run_resumes_its_steps(tmp_path):
+    async def main():
+        checkpoints = store(tmp_path)
+        run_key = checkpoints.run_key(1, '10.0.0.1', 'm1')
+        assert await checkpoints.start(1, '10.0.0.1', 'm1') == {}
+        await checkpoints.save(run_key, 'vlan', {'vlan': 100})
+        await checkpoints.close()
+
+        # A redelivery after a restart
+        checkpoints = store(tmp_path)
+        completed = await checkpoints.start(1, '10.0.0.1', 'm1')
+        await checkpoints.close()
+        return completed
+
+    assert asyncio.run(main()) == {'vlan': {'vlan': 100}}
+
+
+def test_finished_run_starts_over(tmp_path):
+    async def main():
+        checkpoints = store(tmp_path)
+        run_key = checkpoints.run_key(1, '10.0.0.1', 'm1')
+        await checkpoints.start(1, '10.0.0.1', 'm1')
+        await checkpoints.save(run_key, 'vlan', {'vlan': 100})
+        await checkpoints.finish(run_key)
+
+        first = await checkpoints.start(1, '10.0.0.1', 'm1')
+        # Started over, so it is resumable again until it finishes
+        await checkpoints.save(run_key, 'tenant', {'tenant': 5})
+        second = await checkpoints.start(1, '10.0.0.1', 'm1')
+        await checkpoints.close()
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == {}
+    assert second == {'tenant': {'tenant': 5}}
+
+
+def test_runs_are_kept_apart_by_message(tmp_path):
+    async def main():
+        checkpoints = store(tmp_path)
+        await checkpoints.start(1, '10.0.0.1', 'm1')
+        await checkpoints.save(checkpoints.run_key(1, '10.0.0.1', 'm1'), 'vlan', {'vlan': 100})
+        completed = await checkpoints.start(1, '10.0.0.1', 'm2')
+        await checkpoints.close()
+        return completed
+
+    assert asyncio.run(main()) == {}
+
+
+def test_old_runs_are_pruned(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(checkpoint_module.time, 'time', lambda: now[0])
+
+    async def main():
+        checkpoints = store(tmp_path, retention=100, abandoned_retention=10)
+        await checkpoints.start(1, '10.0.0.1', 'done')
+        await checkpoints.finish(checkpoints.run_key(1, '10.0.0.1', 'done'))
+        await checkpoints.start(1, '10.0.0.1', 'abandoned')
+        await checkpoints.save(checkpoints.run_key(1, '10.0.0.1', 'abandoned'), 'vlan', {'vlan': 100})
+
+        now[0] += 50
+        checkpoints.pruned = None
+        await checkpoints.start(2, '10.0.0.2', 'other')
+        keys = [row[0] for row in checkpoints.db.execute('SELECT run_key FROM runs ORDER BY run_key')]
+        steps = checkpoints.db.execute('SELECT count(*) FROM steps').fetchone()[0]
+        await checkpoints.close()
+        return keys, steps
+
+    keys, steps = asyncio.run(main())
+    assert keys == ['1:10.0.0.1:done', '2:10.0.0.2:other']
+    assert steps == 0
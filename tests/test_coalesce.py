@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from drivers import cache as cache_module
+from drivers.coalesce import Coalescer
+
+
+def counting(result=None, delay=0.01, error=None):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    return fn, calls
+
+
+def test_concurrent_calls_share_one_run():
+    fn, calls = counting('res')
+    hits = []
+    coalescer = Coalescer(ttl=0, on_hit=lambda key, kind: hits.append(kind))
+
+    async def main():
+        return await asyncio.gather(*[coalescer.run('lease', fn) for _ in range(3)])
+
+    assert asyncio.run(main()) == ['res'] * 3
+    assert len(calls) == 1
+    assert hits == ['coalesced', 'coalesced']
+
+
+def test_results_are_remembered_for_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+    fn, calls = counting('res', delay=0)
+    coalescer = Coalescer(ttl=60)
+
+    async def main():
+        await coalescer.run('lease', fn)
+        await coalescer.run('lease', fn)
+        now[0] += 61
+        await coalescer.run('lease', fn)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+    assert coalescer.recent_hits == 1
+
+
+def test_failures_reach_waiters_and_are_not_remembered():
+    fn, calls = counting(error=RuntimeError('down'))
+    coalescer = Coalescer(ttl=60)
+
+    async def main():
+        return await asyncio.gather(coalescer.run('lease', fn), coalescer.run('lease', fn), return_exceptions=True)
+
+    assert all(isinstance(x, RuntimeError) for x in asyncio.run(main()))
+    with pytest.raises(RuntimeError):
+        asyncio.run(coalescer.run('lease', fn))
+    assert len(calls) == 2
+
+
+def test_keep_and_ttl_for_decide_what_is_remembered():
+    coalescer = Coalescer(ttl=60, keep=lambda result: result.get('error') is None, ttl_for=lambda: 5)
+
+    async def main():
+        await coalescer.run('bad', counting({'error': 'x'}, delay=0)[0])
+        await coalescer.run('good', counting({'error': None}, delay=0)[0])
+
+    asyncio.run(main())
+    assert coalescer.recent.get('bad', None) is None
+    assert coalescer.recent.get('good') == {'error': None}
+    assert coalescer.recent._data['good'][0] - cache_module.time.monotonic() <= 5
+
+
+def test_cancelled_waiter_does_not_cancel_the_shared_call():
+    fn, calls = counting('res', delay=0.02)
+    coalescer = Coalescer(ttl=0)
+
+    async def main():
+        first = asyncio.create_task(coalescer.run('lease', fn))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(coalescer.run('lease', fn))
+        await asyncio.sleep(0)
+        second.cancel()
+        return await first
+
+    assert asyncio.run(main()) == 'res'
+    assert len(calls) == 1
@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import pytest
+
+from drivers.network.command import COMMANDS, Command, CommandExecutor, CommandRegistry
+from drivers.network.platforms.cisco_iosxr.arp import Arp
+from drivers.network.platforms.cisco_iosxr.get_configured_interfaces import GetConfiguredInterfaces
+
+
+def test_manifest_resolves_netbox_platform_slugs():
+    registry = CommandRegistry()
+
+    assert registry.get('ios-xr', 'arp') is Arp
+    # Only the listed module was needed
+    assert registry._scanned == set()
+
+
+def test_scan_finds_commands_without_a_manifest(tmp_path):
+    registry = CommandRegistry(tmp_path / 'missing.json')
+
+    assert registry.get('cisco_iosxr', 'get_configured_interfaces') is GetConfiguredInterfaces
+    assert registry._scanned == {'cisco_iosxr'}
+    with pytest.raises(Exception, match='No command missing'):
+        registry.get('cisco_iosxr', 'missing')
+
+
+def test_shipped_manifest_matches_a_scan(tmp_path):
+    registry = CommandRegistry(tmp_path / 'manifest.json')
+    registry.write_manifest()
+
+    assert json.loads((tmp_path / 'manifest.json').read_text()) == COMMANDS.manifest()
+
+
+def test_executor_runs_commands_by_name():
+    class Echo(Command):
+        def __init__(self, value):
+            self.value = value
+
+        async def execute(self, executer):
+            return (executer.platform, self.value)
+
+    COMMANDS.set('test_platform', 'echo', Echo)
+    executor = CommandExecutor(conn=None, platform='test_platform')
+
+    assert asyncio.run(executor.run('echo', 1)) == ('test_platform', 1)
+    assert asyncio.run(executor.run(Echo(2))) == ('test_platform', 2)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+from drivers.deadline import DEADLINE, LatencyWindow, expired, hedged, remaining
+
+
+def attempts(*delays):
+    '''call() whose nth attempt takes delays[n], returning n'''
+    started = []
+
+    async def call():
+        n = len(started)
+        started.append(n)
+        await asyncio.sleep(delays[n])
+        return n
+    return call, started
+
+
+def test_fast_call_is_not_hedged():
+    call, started = attempts(0.0)
+    hedges = []
+
+    assert asyncio.run(hedged(call, 0.05, 1, lambda: hedges.append(1))) == 0
+    assert started == [0]
+    assert hedges == []
+
+
+def test_slow_call_is_hedged_and_first_reply_wins():
+    call, started = attempts(1.0, 0.0)
+    hedges = []
+
+    assert asyncio.run(hedged(call, 0.01, 1, lambda: hedges.append(1))) == 1
+    assert started == [0, 1]
+    assert hedges == [1]
+
+
+def test_timeout_without_and_with_hedging():
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(hedged(attempts(1.0)[0], None, 0.01))
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(hedged(attempts(1.0, 1.0)[0], 0.01, 0.02))
+
+
+def test_latency_window_needs_enough_samples():
+    window = LatencyWindow(size=100, min_samples=10)
+    for latency in range(9):
+        window.add('rpc', latency)
+    assert window.percentile('rpc', 95) is None
+
+    for latency in range(9, 100):
+        window.add('rpc', latency)
+    assert window.percentile('rpc', 95) == 95
+    assert window.percentile('other', 95) is None
+
+
+def test_remaining_and_expired():
+    assert remaining() is None
+    token = DEADLINE.set(time.time() + 10)
+    try:
+        assert 9 < remaining() <= 10
+    finally:
+        DEADLINE.reset(token)
+    assert expired(time.time() - 1)
+    assert not expired(None)
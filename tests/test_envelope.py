@@ -0,0 +1,44 @@
+import pytest
+from pydantic import BaseModel
+
+from drivers.envelope import Envelope, dumps, loads
+
+
+class Reply(BaseModel):
+    id: int
+
+
+def test_codec_round_trips_and_encodes_models():
+    data = {'error': None, 'res': {'vlan': 100, 'name': 'ap1-reg'}}
+
+    assert loads(dumps(data)) == data
+    assert loads(dumps({'res': Reply(id=5)})) == {'res': {'id': 5}}
+
+
+def test_decode_keeps_typed_fields_and_extras():
+    body = Envelope.decode(dumps({'account_id': 42, 'ip': '10.0.0.1', 'vlan_id': 7}))
+
+    assert body.account_id == 42
+    assert body['ip'] == '10.0.0.1'
+    assert body.get('vlan_id') == 7
+    assert body.get('missing', 'default') == 'default'
+    assert 'vlan_id' in body
+    assert 'trace_id' not in body
+    with pytest.raises(KeyError):
+        body['missing']
+
+
+def test_decode_wraps_bare_values_and_empty_bodies():
+    assert Envelope.decode(b'"10.0.0.1"').get('value') == '10.0.0.1'
+    assert Envelope.decode(b'').to_dict() == {}
+
+
+def test_to_dict_keeps_explicit_nulls_only():
+    body = Envelope.decode(dumps({'account_id': 42, 'ip': None, 'extra': None}))
+
+    assert body.to_dict() == {'account_id': 42, 'ip': None, 'extra': None}
+
+
+def test_malformed_bodies_raise():
+    with pytest.raises(Exception):
+        Envelope.decode(b'{not json')
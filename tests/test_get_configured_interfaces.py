@@ -0,0 +1,51 @@
+import asyncio
+
+from drivers.network.platforms.cisco_iosxr.get_configured_interfaces import GetConfiguredInterfaces, cmd
+
+
+class Response(object):
+    def __init__(self, result, failed=False):
+        self.result = result
+        self.failed = failed
+
+
+class FakeConn(object):
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.sent = []
+
+    async def send_command(self, command):
+        self.sent.append(command)
+        return self.outputs[command]
+
+
+class Executer(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+
+FULL = '''interface Bundle-Ether1
+interface Bundle-Ether1.100 l2transport
+interface Bundle-Ether1.1000
+interface preconfigure TenGigE0/0/0/1.200
+'''
+
+
+def test_router_filters_for_the_vlan():
+    conn = FakeConn({
+        f'{cmd} .*\\.100': Response('interface Bundle-Ether1.100 l2transport\ninterface Bundle-Ether1.1000\n'),
+    })
+
+    interfaces = asyncio.run(GetConfiguredInterfaces(100).execute(Executer(conn)))
+
+    assert conn.sent == [f'{cmd} .*\\.100']
+    assert 'Bundle-Ether1.100' in interfaces
+
+
+def test_full_list_when_the_filter_fails_or_misses():
+    conn = FakeConn({f'{cmd} .*\\.200': Response('', failed=True), cmd: Response(FULL)})
+
+    interfaces = asyncio.run(GetConfiguredInterfaces(200).execute(Executer(conn)))
+
+    assert conn.sent == [f'{cmd} .*\\.200', cmd]
+    assert interfaces == ['Bundle-Ether1', 'Bundle-Ether1.100', 'Bundle-Ether1.1000', 'TenGigE0/0/0/1.200']
@@ -0,0 +1,64 @@
+import asyncio
+
+from drivers.netbox import limiter as limiter_module
+from drivers.netbox.limiter import AdaptiveLimiter
+
+
+def test_rate_increases_once_per_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(limiter_module.time, 'monotonic', lambda: now[0])
+    limiter = AdaptiveLimiter(rate=10, increase=1)
+
+    now[0] += limiter_module.INCREASE_INTERVAL
+    asyncio.run(limiter.record(0.1, 200))
+    asyncio.run(limiter.record(0.1, 200))
+    assert limiter.rate == 11
+
+    # However long the idle spell, one step
+    now[0] += 60
+    asyncio.run(limiter.record(0.1, 200))
+    assert limiter.rate == 12
+
+
+def test_rate_halves_on_overload_with_cooldown(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(limiter_module.time, 'monotonic', lambda: now[0])
+    limiter = AdaptiveLimiter(rate=40, min_rate=5)
+
+    asyncio.run(limiter.record(0.1, 503))
+    asyncio.run(limiter.record(0.1, 429))
+    assert limiter.rate == 20
+
+    now[0] += limiter_module.DECREASE_COOLDOWN
+    asyncio.run(limiter.record(0.1, failed=True))
+    assert limiter.rate == 10
+
+    now[0] += limiter_module.DECREASE_COOLDOWN
+    asyncio.run(limiter.record(limiter.latency_threshold + 1, 200))
+    now[0] += limiter_module.DECREASE_COOLDOWN
+    asyncio.run(limiter.record(0.1, 500))
+    assert limiter.rate == 5
+
+
+def test_rate_stays_within_bounds(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(limiter_module.time, 'monotonic', lambda: now[0])
+    limiter = AdaptiveLimiter(rate=10, max_rate=11, increase=5)
+
+    now[0] += limiter_module.INCREASE_INTERVAL
+    asyncio.run(limiter.record(0.1, 200))
+    assert limiter.rate == 11
+
+
+def test_shared_rate_is_seen_by_every_limiter(tmp_path):
+    path = str(tmp_path / 'limiter.json')
+    first = AdaptiveLimiter(rate=40, shared_path=path)
+    second = AdaptiveLimiter(rate=40, shared_path=path)
+
+    asyncio.run(first.record(0.1, 503))
+    # Within the cooldown, so the second backoff is skipped
+    asyncio.run(second.record(0.1, 503))
+    asyncio.run(second.acquire())
+
+    assert first.rate == 20
+    assert second.rate == 20
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from drivers.pipeline import Pipeline, PipelineException, Step
+
+
+def record(order, name, outputs=None, delay=0.0):
+    async def fn(**kwargs):
+        await asyncio.sleep(delay)
+        order.append(name)
+        return outputs or {}
+    return fn
+
+
+def test_steps_run_after_their_inputs_and_after():
+    order = []
+    pipeline = Pipeline([
+        Step('write', record(order, 'write'), inputs=('vlan',), after=('gate',)),
+        Step('vlan', record(order, 'vlan', {'vlan': 100}, delay=0.01), inputs=('ip',), outputs=('vlan',)),
+        Step('gate', record(order, 'gate', delay=0.02)),
+    ], initial=('ip',))
+
+    values = asyncio.run(pipeline.run({'ip': '10.0.0.1'}))
+
+    assert values['vlan'] == 100
+    assert order.index('write') > order.index('vlan')
+    assert order.index('write') > order.index('gate')
+
+
+def test_independent_steps_run_concurrently():
+    order = []
+    pipeline = Pipeline([
+        Step('slow', record(order, 'slow', delay=0.02)),
+        Step('fast', record(order, 'fast')),
+    ])
+
+    asyncio.run(pipeline.run({}))
+
+    assert order == ['fast', 'slow']
+
+
+def test_completed_steps_are_not_run_again():
+    order = []
+    pipeline = Pipeline([
+        Step('vlan', record(order, 'vlan', {'vlan': 100}), outputs=('vlan',)),
+        Step('write', record(order, 'write'), inputs=('vlan',)),
+    ])
+
+    values = asyncio.run(pipeline.run({}, completed={'vlan': {'vlan': 200}}))
+
+    assert order == ['write']
+    assert values['vlan'] == 200
+
+
+def test_failure_stops_dependents():
+    order = []
+
+    async def fail():
+        raise RuntimeError('boom')
+
+    pipeline = Pipeline([
+        Step('fail', fail, outputs=('vlan',)),
+        Step('write', record(order, 'write'), inputs=('vlan',)),
+    ])
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(pipeline.run({}))
+    assert order == []
+
+
+def test_invalid_graphs_are_rejected():
+    with pytest.raises(PipelineException):
+        Pipeline([Step('a', record([], 'a'), inputs=('missing',))])
+    with pytest.raises(PipelineException):
+        Pipeline([Step('a', record([], 'a'), after=('b',)), Step('b', record([], 'b'), after=('a',))])
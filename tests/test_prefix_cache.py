@@ -0,0 +1,38 @@
+import asyncio
+
+from drivers.netbox.prefix_cache import PrefixCache
+
+
+class FakeNetbox(object):
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+        self.calls = 0
+
+    async def execute(self, document):
+        self.calls += 1
+        if isinstance(self.prefixes, Exception):
+            raise self.prefixes
+        return {'prefix_list': [{'prefix': x} for x in self.prefixes]}
+
+
+def test_longest_prefix_wins():
+    cache = PrefixCache(FakeNetbox(['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '2001:db8::/32']))
+    asyncio.run(cache.refresh())
+
+    assert cache.match('10.1.2.3')['prefix'] == '10.1.2.0/24'
+    assert cache.match('10.1.3.3/24')['prefix'] == '10.1.0.0/16'
+    assert cache.match('10.2.0.1')['prefix'] == '10.0.0.0/8'
+    assert cache.match('2001:db8::1')['prefix'] == '2001:db8::/32'
+    assert cache.match('192.168.0.1') is None
+
+
+def test_failed_refresh_is_retried_on_next_lookup():
+    netbox = FakeNetbox(RuntimeError('down'))
+    cache = PrefixCache(netbox)
+
+    assert asyncio.run(cache.lookup('10.0.0.1')) is None
+    assert cache.expired()
+
+    netbox.prefixes = ['10.0.0.0/8']
+    assert asyncio.run(cache.lookup('10.0.0.1'))['prefix'] == '10.0.0.0/8'
+    assert netbox.calls == 2
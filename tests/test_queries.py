@@ -0,0 +1,57 @@
+import json
+
+import pytest
+from graphql import build_schema, graphql_sync, get_introspection_query
+
+from drivers.netbox.queries import QUERIES, QUERY_SITE, NetboxQueryException, QueryRegistry
+
+SCHEMA = '''
+type Site {
+    id: ID!
+    name: String
+}
+
+type Query {
+    site(id: ID!): Site
+}
+'''
+
+
+def test_registered_documents_are_recognised_by_identity():
+    registry = QueryRegistry()
+    document = registry.register('Site', 'query Site($id: ID!) { site(id: $id) { id } }')
+
+    assert document in registry
+    # Same text parsed elsewhere is still ad hoc
+    assert QueryRegistry().register('Site', 'query Site($id: ID!) { site(id: $id) { id } }') not in registry
+    assert QUERY_SITE in QUERIES
+
+
+def test_duplicate_names_are_rejected():
+    registry = QueryRegistry()
+    registry.register('Site', '{ site(id: 1) { id } }')
+
+    with pytest.raises(NetboxQueryException, match='already registered'):
+        registry.register('Site', '{ site(id: 2) { id } }')
+
+
+def test_validate_against_sdl(tmp_path):
+    path = tmp_path / 'schema.graphql'
+    path.write_text(SCHEMA)
+    registry = QueryRegistry()
+    registry.register('Site', 'query Site($id: ID!) { site(id: $id) { id name } }')
+    registry.validate(str(path))
+
+    registry.register('Broken', 'query Broken($id: ID!) { site(id: $id) { slug } }')
+    with pytest.raises(NetboxQueryException, match='Broken: Cannot query field'):
+        registry.validate(str(path))
+
+
+def test_validate_against_introspection(tmp_path):
+    introspection = graphql_sync(build_schema(SCHEMA), get_introspection_query()).data
+    path = tmp_path / 'schema.json'
+    path.write_text(json.dumps({'data': introspection}))
+    registry = QueryRegistry()
+    registry.register('Site', 'query Site($id: ID!) { site(id: $id) { id } }')
+
+    registry.validate(str(path))
@@ -0,0 +1,77 @@
+import asyncio
+
+from drivers import rpc_cache as rpc_cache_module
+from drivers.rpc_cache import RpcCache, seconds_until_midnight
+
+
+def replies(*results):
+    sent = []
+
+    async def send():
+        sent.append(1)
+        return results[min(len(sent), len(results)) - 1]
+    return send, sent
+
+
+def test_policy_keys_on_fields_and_ignores_the_rest():
+    hits = []
+    cache = RpcCache(on_hit=lambda key, kind: hits.append((key, kind)))
+    send, sent = replies({'error': None, 'res': True})
+
+    async def main():
+        await cache.run('rpc.erp.can_provision', {'account_id': 1, 'ip': '10.0.0.1', 'trace_id': 'a'}, send)
+        await cache.run('rpc.erp.can_provision', {'account_id': 1, 'ip': '10.0.0.2', 'trace_id': 'b'}, send)
+        await cache.run('rpc.erp.can_provision', {'account_id': 2}, send)
+
+    asyncio.run(main())
+    assert len(sent) == 2
+    assert hits == [('rpc.erp.can_provision', 'recent')]
+
+
+def test_error_replies_are_not_remembered():
+    cache = RpcCache()
+    send, sent = replies({'error': 'down', 'res': None}, {'error': None, 'res': True})
+
+    async def main():
+        first = await cache.run('rpc.erp.can_provision', {'account_id': 1}, send)
+        second = await cache.run('rpc.erp.can_provision', {'account_id': 1}, send)
+        return first, second
+
+    assert asyncio.run(main()) == ({'error': 'down', 'res': None}, {'error': None, 'res': True})
+    assert len(sent) == 2
+
+
+def test_uncached_calls_go_straight_through():
+    cache = RpcCache()
+    send, sent = replies({'error': None})
+
+    async def main():
+        await cache.run('rpc.dcim.get_reg_vlan', {'ip': '10.0.0.1'}, send)
+        await cache.run('rpc.dcim.get_reg_vlan', {'ip': '10.0.0.1'}, send)
+        # Bare payloads aren't cached
+        await cache.run('rpc.erp.can_provision', '10.0.0.1', send)
+        await cache.run('rpc.erp.can_provision', '10.0.0.1', send)
+
+    asyncio.run(main())
+    assert len(sent) == 4
+
+
+def test_overrides_add_disable_and_refuse_writes():
+    cache = RpcCache({
+        'rpc.erp.can_provision': None,
+        'rpc.dcim.get_reg_vlan': {'ttl': 30},
+        'rpc.dcim.assign_tenant_vlan': {'ttl': 30},
+    })
+
+    assert set(cache.caches) == {'rpc.dcim.get_reg_vlan'}
+    # Without fields the whole payload, less trace_id and deadline, is the key
+    assert cache.key('rpc.dcim.get_reg_vlan', {'ip': '10.0.0.1', 'deadline': 1.0}) == \
+        cache.key('rpc.dcim.get_reg_vlan', {'ip': '10.0.0.1', 'deadline': 2.0})
+
+
+def test_end_of_day_entries_expire_by_midnight(monkeypatch):
+    monkeypatch.setattr(rpc_cache_module, 'seconds_until_midnight', lambda: 10.0)
+    cache = RpcCache()
+
+    assert cache.caches['rpc.erp.can_provision'].ttl_for() == 10.0
+    assert 0 < seconds_until_midnight() <= 24 * 3600
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from drivers.scheduler import FairScheduler, SchedulerFull
+
+
+def test_limits_overall_and_per_key():
+    async def main():
+        scheduler = FairScheduler(max_in_flight=3, per_key_limit=2)
+        peak = {'total': 0, 'a': 0}
+        running = {'total': 0, 'a': 0, 'b': 0}
+
+        async def run(key):
+            async with scheduler.slot(key):
+                running['total'] += 1
+                running[key] += 1
+                peak['total'] = max(peak['total'], running['total'])
+                peak['a'] = max(peak['a'], running['a'])
+                await asyncio.sleep(0.01)
+                running['total'] -= 1
+                running[key] -= 1
+
+        await asyncio.gather(*[run('a') for _ in range(5)], *[run('b') for _ in range(3)])
+        return peak, scheduler
+
+    peak, scheduler = asyncio.run(main())
+    assert peak == {'total': 3, 'a': 2}
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth == 0
+
+
+def test_freed_slots_go_to_keys_in_turn():
+    async def main():
+        scheduler = FairScheduler(max_in_flight=1, per_key_limit=1)
+        order = []
+        await scheduler.acquire('busy')
+
+        async def run(key):
+            await scheduler.acquire(key)
+            order.append(key)
+            scheduler.release(key)
+
+        tasks = [asyncio.create_task(run(key)) for key in ('busy', 'busy', 'quiet', 'busy')]
+        await asyncio.sleep(0)
+        scheduler.release('busy')
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ['busy', 'quiet', 'busy', 'busy']
+
+
+def test_full_queue_turns_callers_away():
+    async def main():
+        scheduler = FairScheduler(max_in_flight=1, per_key_limit=1, max_waiting=1)
+        await scheduler.acquire('a')
+        waiter = asyncio.create_task(scheduler.acquire('a'))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerFull):
+            await scheduler.acquire('a')
+        scheduler.release('a')
+        return await waiter
+
+    assert asyncio.run(main()) >= 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        scheduler = FairScheduler(max_in_flight=1, per_key_limit=1)
+        await scheduler.acquire('a')
+        waiter = asyncio.create_task(scheduler.acquire('a'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        scheduler.release('a')
+        return scheduler
+
+    scheduler = asyncio.run(main())
+    assert scheduler.queue_depth == 0
+    assert scheduler.in_flight == 0
@@ -0,0 +1,42 @@
+import asyncio
+
+from drivers.netbox.site_devices import SiteDeviceIndex
+
+
+def device(name, role, ip=None):
+    return {'name': name, 'role': {'name': role}, 'primary_ip4': {'address': f'{ip}/24'} if ip else None}
+
+
+class FakeNetbox(object):
+    def __init__(self):
+        self.calls = 0
+
+    async def execute(self, document, variable_values=None):
+        self.calls += 1
+        return {'device_list': []}
+
+
+def test_seeded_site_answers_by_device_name_without_queries():
+    netbox = FakeNetbox()
+    index = SiteDeviceIndex(netbox)
+    index.add('7', [device('r1', 'Router', '10.0.0.1'), device('ap1', 'AP', '10.0.0.2')])
+
+    async def main():
+        site_id = await index.site_for_device('ap1')
+        return site_id, await index.site(site_id)
+
+    site_id, site = asyncio.run(main())
+
+    assert site_id == 7
+    assert site.router_ip() == '10.0.0.1'
+    assert site.ip('AP', 'ap1') == '10.0.0.2'
+    assert netbox.calls == 0
+
+
+def test_cache_sizes_are_configurable():
+    index = SiteDeviceIndex(FakeNetbox(), device_cache_size=2, vlan_cache_size=3)
+    index.add(1, [device('a', 'AP'), device('b', 'AP'), device('c', 'AP')])
+
+    assert index.device_sites.maxsize == 2
+    assert index.vlan_sites.maxsize == 3
+    assert len(index.device_sites._data) == 2
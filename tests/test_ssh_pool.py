@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from drivers.network.ssh_pool import SSHSessionPool
+
+
+class FakeConn(object):
+    '''Just the scrapli async calls the pool makes'''
+
+    def __init__(self, prompt='RP/0/RP0/CPU0:rtr#'):
+        self.prompt = prompt
+        self.alive = False
+        self.opened = 0
+        self.closed = 0
+
+    async def open(self):
+        self.opened += 1
+        self.alive = True
+
+    async def close(self):
+        self.closed += 1
+        self.alive = False
+
+    def isalive(self):
+        return self.alive
+
+    async def get_prompt(self):
+        return self.prompt
+
+
+class Factory(object):
+    def __init__(self):
+        self.conns = []
+
+    def __call__(self):
+        self.conns.append(FakeConn())
+        return self.conns[-1]
+
+
+def test_sessions_are_reused():
+    pool = SSHSessionPool()
+    factory = Factory()
+
+    async def main():
+        for _ in range(3):
+            async with pool.session('rtr', factory):
+                pass
+        await pool.close()
+
+    asyncio.run(main())
+    assert len(factory.conns) == 1
+    assert factory.conns[0].closed == 1
+
+
+def test_dead_sessions_are_replaced():
+    pool = SSHSessionPool()
+    factory = Factory()
+
+    async def main():
+        async with pool.session('rtr', factory) as conn:
+            pass
+        conn.alive = False
+        async with pool.session('rtr', factory):
+            pass
+        await pool.close()
+
+    asyncio.run(main())
+    assert len(factory.conns) == 2
+
+
+def test_failed_or_config_mode_sessions_are_closed():
+    pool = SSHSessionPool()
+    factory = Factory()
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            async with pool.session('rtr', factory):
+                raise RuntimeError('command failed')
+        async with pool.session('rtr', factory) as conn:
+            conn.prompt = 'RP/0/RP0/CPU0:rtr(config-if)#'
+        async with pool.session('rtr', factory):
+            pass
+        await pool.close()
+
+    asyncio.run(main())
+    assert len(factory.conns) == 3
+    assert [x.closed for x in factory.conns] == [1, 1, 1]
+
+
+def test_sessions_per_device_are_limited():
+    pool = SSHSessionPool(max_per_device=2)
+    factory = Factory()
+    peak = [0, 0]
+
+    async def use():
+        async with pool.session('rtr', factory):
+            peak[0] += 1
+            peak[1] = max(peak)
+            await asyncio.sleep(0.01)
+            peak[0] -= 1
+
+    async def main():
+        await asyncio.gather(*[use() for _ in range(5)])
+        await pool.close()
+
+    asyncio.run(main())
+    assert peak[1] == 2
+    assert len(factory.conns) == 2
+
+
+def test_closed_pool_refuses_sessions():
+    pool = SSHSessionPool()
+
+    async def main():
+        await pool.close()
+        async with pool.session('rtr', Factory()):
+            pass
+
+    with pytest.raises(Exception, match='closed'):
+        asyncio.run(main())
@@ -0,0 +1,46 @@
+import pytest
+
+from drivers.network import utils
+from drivers.network.utils import TemplateCache
+
+TEMPLATE = r'''Value NAME (\S+)
+Value STATE (up|down)
+
+Start
+  ^${NAME}\s+is\s+${STATE} -> Record
+'''
+
+
+def test_inline_templates_are_compiled_once_and_reused():
+    cache = TemplateCache()
+    fsm = cache.register('test', 'show state', TEMPLATE)
+
+    first = cache.parse('test', 'show state', 'eth0 is up\neth1 is down\n')
+    second = cache.parse('test', 'show state', 'eth2 is up\n')
+
+    assert cache.get('test', 'show state') is fsm
+    assert first == [{'name': 'eth0', 'state': 'up'}, {'name': 'eth1', 'state': 'down'}]
+    # Reset between parses, nothing carried over
+    assert second == [{'name': 'eth2', 'state': 'up'}]
+
+
+def test_indexed_templates_are_read_from_disk(tmp_path, monkeypatch):
+    (tmp_path / 'test_show_state.textfsm').write_text(TEMPLATE)
+    (tmp_path / 'index').write_text(
+        'Template, Hostname, Platform, Command\n\n'
+        'test_show_state.textfsm, .*, test, sh[[ow]] st[[ate]]\n'
+    )
+    monkeypatch.setattr(utils, 'template_dirs', lambda: [str(tmp_path)])
+    cache = TemplateCache()
+
+    assert cache.parse('test', 'show state', 'eth0 is up\n') == [{'name': 'eth0', 'state': 'up'}]
+    assert cache.get('test', 'show state') is cache.get('test', 'show state')
+
+
+def test_missing_template_is_an_error(monkeypatch):
+    monkeypatch.setattr(utils, 'template_dirs', lambda: [])
+    cache = TemplateCache()
+
+    assert cache.get('test', 'show missing') is None
+    with pytest.raises(Exception, match='No TextFSM template'):
+        cache.parse('test', 'show missing', '')
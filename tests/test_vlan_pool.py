@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from drivers.netbox.queries import QUERY_TENANT_VLANS_BY_SITE
+from drivers.netbox.vlan_pool import NetboxVlanPoolException, SiteVlanPool, VlanPoolIndex
+
+
+def vlan(id, vid, site=1, tenant=None):
+    return {'id': id, 'vid': vid, 'site': {'id': site}, 'tenant': tenant}
+
+
+class FakeNetbox(object):
+    def __init__(self, vlans, site=True):
+        self.vlans = vlans
+        self.site = site
+        self.calls = 0
+
+    async def execute(self, document, variable_values=None):
+        self.calls += 1
+        if document is QUERY_TENANT_VLANS_BY_SITE:
+            return {'vlan_list': self.vlans}
+        return {'site': {'id': variable_values['id']} if self.site else None}
+
+
+def test_next_free_is_lowest_unassigned_vid():
+    pool = SiteVlanPool(1, [vlan(10, 1030), vlan(11, 1025, tenant={'id': 5}), vlan(12, 1027)])
+
+    assert pool.next_free() == (12, 1027)
+
+
+def test_mark_used_and_free():
+    pool = SiteVlanPool(1, [vlan(10, 1024), vlan(11, 1025)])
+
+    pool.mark_used(1024)
+    assert pool.next_free() == (11, 1025)
+    pool.mark_used(1025)
+    assert pool.next_free() is None
+
+    pool.mark_free(1025)
+    assert pool.next_free() == (11, 1025)
+    # Not one of the site's VLANs
+    pool.mark_free(1026)
+    assert pool.next_free() == (11, 1025)
+
+
+def test_index_keeps_only_the_sites_tenant_range():
+    netbox = FakeNetbox([vlan(10, 100), vlan(11, 1024, site=2), vlan(12, 1026), {'id': 13, 'vid': 1025, 'site': None}])
+    index = VlanPoolIndex(netbox)
+
+    pool = asyncio.run(index.get(1))
+
+    assert pool.ids == {1026: 12}
+    index.mark_used(12)
+    assert pool.next_free() is None
+    index.mark_free(12)
+    assert pool.next_free() == (12, 1026)
+
+
+def test_concurrent_loads_share_one_query():
+    netbox = FakeNetbox([vlan(10, 1024)])
+    index = VlanPoolIndex(netbox)
+
+    async def main():
+        return await asyncio.gather(index.get(1), index.get(1))
+
+    first, second = asyncio.run(main())
+
+    assert first is second
+    assert netbox.calls == 1
+
+
+def test_missing_site_is_reported():
+    index = VlanPoolIndex(FakeNetbox([], site=False))
+
+    with pytest.raises(NetboxVlanPoolException, match='does not exist'):
+        asyncio.run(index.get(1))